@@ -0,0 +1,328 @@
+import json
+import math
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+# Settings of a benchmark run, a json config file given on the command line overrides any of them
+DEFAULT_CONFIG = {
+    "seed": 1234,                       # seed of the generated meshes and scenes, fixtures are identical on every machine
+    "repeats": 3,                       # every measurement is repeated, the median is reported
+    "mesh_triangles": [1_000, 10_000, 100_000, 1_000_000, 5_000_000],
+    "bvh_max_triangles": 1_000_000,     # larger meshes are only parsed and uploaded
+    "sphere_grids": [4, 8, 16],         # n x n spheres traced by cpuRaytracer
+    "trace_resolution": [160, 90],
+    "platform": "osmesa",               # "egl" or "osmesa" for the GL benchmarks, null to skip them
+    "frame_resolutions": [[320, 180], [640, 360], [1280, 720]],
+    "frames": 10,                       # frames of the sphere shader timed at each resolution
+    "cubemap": ['images/skybox1/right.png', 'images/skybox1/left.png',
+                'images/skybox1/top.png', 'images/skybox1/bottom.png',
+                'images/skybox1/front.png', 'images/skybox1/back.png'],
+    "fixtures": "benchmarks/fixtures",
+    "output": "benchmarks/results.json",
+    "baseline": "benchmarks/baseline.json",
+    "tolerance": 0.15,                  # relative slowdown reported as a regression
+}
+
+
+def load_config(filename=None):
+    config = dict(DEFAULT_CONFIG)
+    if filename is not None:
+        with open(filename) as f:
+            config.update(json.load(f))
+    return config
+
+
+# Writes a height field of n_triangles triangles with positions, texture coordinates and normals to an obj file
+def generate_mesh(filename, n_triangles, seed):
+    rng = np.random.default_rng(seed)
+    n_quads = -(-n_triangles // 2)
+    columns = math.ceil(math.sqrt(n_quads))
+    rows = -(-n_quads // columns)
+
+    u, v = np.meshgrid(np.linspace(0.0, 1.0, columns + 1), np.linspace(0.0, 1.0, rows + 1))
+    heights = rng.normal(0.0, 0.02, size=u.shape)
+    positions = np.stack([u * 2.0 - 1.0, heights, v * 2.0 - 1.0], axis=-1).reshape(-1, 3)
+    dh_dv, dh_du = np.gradient(heights, 2.0 / max(rows, 1), 2.0 / max(columns, 1))
+    normals = np.stack([-dh_du, np.ones_like(heights), -dh_dv], axis=-1).reshape(-1, 3)
+    normals /= np.linalg.norm(normals, axis=1, keepdims=True)
+    uvs = np.stack([u, v], axis=-1).reshape(-1, 2)
+
+    # two triangles per quad, obj indices start at 1
+    corner = (np.arange(rows)[:, None] * (columns + 1) + np.arange(columns)[None, :]).ravel() + 1
+    quads = np.stack([corner, corner + 1, corner + columns + 2, corner + columns + 1], axis=1)
+    triangles = np.concatenate([quads[:, [0, 1, 2]], quads[:, [0, 2, 3]]], axis=1).reshape(-1, 3)[:n_triangles]
+
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    with open(filename + ".tmp", "w") as f:
+        f.write(f"# {n_triangles} triangles, seed {seed}\no mesh\n")
+        np.savetxt(f, positions, fmt="v %.6f %.6f %.6f")
+        np.savetxt(f, uvs, fmt="vt %.6f %.6f")
+        np.savetxt(f, normals, fmt="vn %.6f %.6f %.6f")
+        np.savetxt(f, np.repeat(triangles, 3, axis=1), fmt="f %d/%d/%d %d/%d/%d %d/%d/%d")
+    os.replace(filename + ".tmp", filename)
+
+
+# Path of the generated mesh fixture, written the first time it is needed
+def mesh_fixture(config, n_triangles):
+    filename = os.path.join(config["fixtures"], f"mesh_{n_triangles}_{config['seed']}.obj")
+    if not os.path.exists(filename):
+        generate_mesh(filename, n_triangles, config["seed"])
+    return filename
+
+
+# n x n grid of spheres with random materials, on the ground plane of the default scene
+def sphere_grid_scene(n, seed):
+    import sceneData
+
+    rng = np.random.default_rng(seed)
+    scene = sceneData.Scene()
+    ground = scene.add_material((1.0, 1.0, 1.0), metallic=0.0, roughness=0.0001, mat_type=1)
+    scene.add_plane((1.5, -1.0, 1.5), size=(5.0, 0.0, 5.0), normal=(0.0, 1.0, 0.0), material=ground)
+
+    i, j = np.meshgrid(np.arange(n), np.arange(n), indexing="ij")
+    spacing = 4.0 / n
+    materials = scene.add_materials(rng.uniform(0.0, 1.0, size=(n * n, 3)),
+                                    metallic=rng.uniform(0.0, 1.0, size=n * n),
+                                    roughness=rng.uniform(0.0001, 1.0, size=n * n),
+                                    mat_type=rng.integers(1, 6, size=n * n))
+    centers = np.stack([i.ravel() * spacing, np.full(n * n, -0.75), j.ravel() * spacing], axis=1)
+    scene.add_spheres(centers, radius=spacing / 4.0, material=materials)
+    return scene
+
+
+# Runs function repeats times, returns the durations in seconds and the last result
+def timed(function, repeats):
+    durations = []
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        durations.append(time.perf_counter() - start)
+    return durations, result
+
+
+# Peak of the memory allocated by python and numpy while running function, in bytes
+def peak_memory(function):
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def add_result(results, name, value, unit, better="lower", runs=None):
+    '''
+    :param value:  reported value, the median of runs when there are several
+    :param better: "lower" or "higher", the direction of an improvement, used by compare()
+    '''
+    result = {"value": float(value), "unit": unit, "better": better}
+    if runs is not None:
+        result["runs"] = [float(run) for run in runs]
+    results[name] = result
+    print(f"{name:32} {value:14.6g} {unit}")
+
+
+def benchmark_cpu(config, results):
+    from bvhBuilder import build_bvh, triangles_from_object
+    import cpuRaytracer
+    from objLoaderV4 import ObjLoader
+
+    repeats = config["repeats"]
+    for n_triangles in config["mesh_triangles"]:
+        filename = mesh_fixture(config, n_triangles)
+
+        runs, obj = timed(lambda: ObjLoader(filename, use_cache=False), repeats)
+        add_result(results, f"obj_parse/{n_triangles}", np.median(runs), "s", runs=runs)
+        add_result(results, f"obj_parse_memory/{n_triangles}",
+                   peak_memory(lambda: ObjLoader(filename, use_cache=False)) / 2 ** 20, "MB")
+
+        ObjLoader(filename)     # writes the mesh cache
+        runs, _ = timed(lambda: ObjLoader(filename), repeats)
+        add_result(results, f"obj_load_cached/{n_triangles}", np.median(runs), "s", runs=runs)
+
+        if n_triangles <= config["bvh_max_triangles"]:
+            triangles = triangles_from_object(obj)
+            runs, _ = timed(lambda: build_bvh(triangles), repeats)
+            add_result(results, f"bvh_build/{n_triangles}", np.median(runs), "s", runs=runs)
+
+    width, height = config["trace_resolution"]
+    camera = cpuRaytracer.look_at_camera([0, 0, 3], [0, 0, -1], [0, 1, 0], np.deg2rad(90), (width, height))
+    light = cpuRaytracer.Light([-10, 10, -10], [1.0, 1.0, 1.0], ambient_intensity=0.1)
+    for n in config["sphere_grids"]:
+        scene = sphere_grid_scene(n, config["seed"])
+        runs, _ = timed(lambda: cpuRaytracer.render(scene, camera, light), repeats)
+        # camera rays, each one traced with all its bounces
+        add_result(results, f"cpu_trace_rays_per_second/{n * n}", width * height / np.median(runs), "rays/s",
+                   better="higher", runs=runs)
+
+
+def benchmark_gl(config, results):
+    '''
+    Upload and frame times in an offscreen context of headlessRenderer. The GPU is waited for (glFinish)
+    before every measurement ends, so the times include the GPU work.
+    '''
+    # PyOpenGL picks its platform when OpenGL.GL is first imported
+    os.environ.setdefault("PYOPENGL_PLATFORM", config["platform"])
+    import headlessRenderer
+
+    width, height = np.max(np.asarray(config["frame_resolutions"]), axis=0)
+    try:
+        if os.environ["PYOPENGL_PLATFORM"] == "osmesa":
+            destroy_context = headlessRenderer.create_osmesa_context(int(width), int(height))
+        else:
+            destroy_context = headlessRenderer.create_egl_context(int(width), int(height))
+    except Exception as error:
+        print("GL benchmarks skipped:", error)
+        return None
+
+    from OpenGL.GL import glActiveTexture, glBindTexture, glUseProgram, glDeleteVertexArrays, glDeleteBuffers, \
+        glDeleteProgram, glDeleteTextures, glFinish, glGetString, GL_RENDERER, GL_TEXTURE0, GL_TEXTURE2, \
+        GL_TEXTURE_CUBE_MAP
+    import graphicsLibrary
+    import sceneData
+    import shaderLoaderV3
+    from objLoaderV4 import ObjLoader
+
+    repeats = config["repeats"]
+    renderer = glGetString(GL_RENDERER).decode()
+
+    for n_triangles in config["mesh_triangles"]:
+        obj = ObjLoader(mesh_fixture(config, n_triangles))
+
+        runs = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            vao, vbo, ebo, _ = graphicsLibrary.build_buffers(obj)
+            glFinish()
+            runs.append(time.perf_counter() - start)
+            glDeleteVertexArrays(1, [vao])
+            glDeleteBuffers(1, [vbo])
+            if ebo is not None:
+                glDeleteBuffers(1, [ebo])
+        add_result(results, f"gl_upload/{n_triangles}", np.median(runs), "s", runs=runs)
+
+    shaderProgram_sphere = shaderLoaderV3.ShaderProgram("shaders/sphere/vert.glsl", "shaders/sphere/frag.glsl")
+    frame_uniforms = graphicsLibrary.FrameUniforms()
+    scene_buffers = graphicsLibrary.build_scene_buffers(sceneData.default_scene())
+    quad = ObjLoader("objects/square.obj", indexed=True)
+    vao_quad, vbo_quad, ebo_quad, _ = graphicsLibrary.build_buffers(quad)
+
+    skybox_id, prefiltered_id = graphicsLibrary.load_baked_cubemap(config["cubemap"])
+    glActiveTexture(GL_TEXTURE2)
+    glBindTexture(GL_TEXTURE_CUBE_MAP, prefiltered_id)
+    glActiveTexture(GL_TEXTURE0)
+    glBindTexture(GL_TEXTURE_CUBE_MAP, skybox_id)
+
+    # initial camera and light of main.py
+    frame_uniforms["light_pos"] = [-10.0, 10.0, -10.0, 1.0]
+    frame_uniforms["lightColor"] = [1.0, 1.0, 1.0]
+    frame_uniforms["ambient_intensity"] = 0.1
+    frame_uniforms["fov"] = np.deg2rad(90)
+    frame_uniforms["eye_pos"] = [0.0, 0.0, 3.0]
+    frame_uniforms["cameraU"] = [1.0, 0.0, 0.0]
+    frame_uniforms["cameraV"] = [0.0, 1.0, 0.0]
+    frame_uniforms["cameraW"] = [0.0, 0.0, 1.0]
+    shaderProgram_sphere["model_matrix"] = np.identity(4, dtype=np.float32)
+    shaderProgram_sphere["progressive"] = False
+    shaderProgram_sphere["accumulation"] = 1
+    shaderProgram_sphere["prefilteredTex"] = 2
+    shaderProgram_sphere["use_prefiltered"] = True
+    glUseProgram(shaderProgram_sphere.shader)
+
+    for frame_width, frame_height in config["frame_resolutions"]:
+        target = graphicsLibrary.AccumulationBuffers(frame_width, frame_height)
+        frame_uniforms["resolution"] = [frame_width, frame_height]
+        frame_uniforms.update()
+
+        def frames(n_frames):
+            for _ in range(n_frames):
+                target.begin(texture_unit=1)
+                graphicsLibrary.draw_buffers(vao_quad, quad)
+                target.end()
+            glFinish()
+
+        frames(1)   # first frame also compiles the shader variants in some drivers
+        runs, _ = timed(lambda: frames(config["frames"]), repeats)
+        runs = [run / config["frames"] for run in runs]
+        add_result(results, f"gl_sphere_frame/{frame_width}x{frame_height}", np.median(runs), "s", runs=runs)
+        target.delete()
+
+    frame_uniforms.delete()
+    glDeleteTextures([skybox_id, prefiltered_id])
+    glDeleteVertexArrays(1, [vao_quad])
+    glDeleteBuffers(1, [vbo_quad])
+    if ebo_quad is not None:
+        glDeleteBuffers(1, [ebo_quad])
+    glDeleteBuffers(3, scene_buffers)
+    glDeleteProgram(shaderProgram_sphere.shader)
+    destroy_context()
+    return renderer
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Compare results with a baseline written by an earlier run.
+    :param tolerance: relative change in the wrong direction that counts as a regression (0.15 = 15 %)
+    :return: list of (name, baseline value, value, relative change) of the regressions
+    '''
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get("results", {}).get(name)
+        if reference is None or reference["value"] == 0:
+            continue
+        change = result["value"] / reference["value"] - 1.0
+        if result["better"] == "higher":
+            change = -change
+        if change > tolerance:
+            regressions.append((name, reference["value"], result["value"], change))
+    return regressions
+
+
+def run_benchmarks(config):
+    '''
+    Run the benchmarks of config, write the results to config["output"] and compare them with config["baseline"].
+    :return: the list of regressions (see compare)
+    '''
+    results = {}
+    benchmark_cpu(config, results)
+    renderer = benchmark_gl(config, results) if config["platform"] else None
+
+    report = {"machine": {"platform": platform.platform(), "processor": platform.processor(),
+                          "cpus": os.cpu_count(), "python": platform.python_version(),
+                          "numpy": np.__version__, "gl_renderer": renderer},
+              "config": config,
+              "results": results}
+    os.makedirs(os.path.dirname(config["output"]) or ".", exist_ok=True)
+    with open(config["output"], "w") as f:
+        json.dump(report, f, indent=1)
+
+    regressions = []
+    if config["baseline"] and os.path.exists(config["baseline"]):
+        with open(config["baseline"]) as f:
+            regressions = compare(results, json.load(f), config["tolerance"])
+        for name, reference, value, change in regressions:
+            print(f"Regression {name}: {reference:.6g} -> {value:.6g} ({change:+.1%})")
+        if not regressions:
+            print("No regression against", config["baseline"])
+    return regressions
+
+
+if __name__ == '__main__':
+    '''
+    Usage:
+        python benchmarkSuite.py [config.json]
+
+    Results are written to benchmarks/results.json. Copy them to benchmarks/baseline.json to make them
+    the reference of the next runs, which then exit with status 1 if a measurement regressed.
+
+    Example config of a quick run, without the large meshes and the GL benchmarks:
+        {"mesh_triangles": [1000, 100000], "sphere_grids": [4], "platform": null, "repeats": 5}
+    '''
+    regressions = run_benchmarks(load_config(sys.argv[1] if len(sys.argv) > 1 else None))
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,331 @@
+import time
+
+import numpy as np
+
+# Relative costs of a traversal step and of a ray/triangle test used by the surface area heuristic
+TRAVERSAL_COST = 1.0
+INTERSECTION_COST = 1.0
+
+# std430 layout of one node in a shader storage buffer:
+#     struct BVHNode { vec3 minP; int left_first; vec3 maxP; int count; };
+NODE_DTYPE = np.dtype([("min", "<f4", 3), ("left_first", "<i4"),
+                       ("max", "<f4", 3), ("count", "<i4")])
+
+
+class BVH:
+    def __init__(self, triangles, node_min, node_max, node_left_first, node_count, tri_indices):
+        '''
+        Flattened bounding volume hierarchy over a triangle mesh.
+
+        Nodes are stored as arrays with the root at index 0:
+            node_min, node_max:     (n_nodes, 3) bounding box of each node
+            node_count:             number of triangles of a leaf, 0 for an interior node
+            node_left_first:        interior node: index of the left child, the right child is left_first + 1
+                                    leaf: index in tri_indices of the first triangle of the leaf
+
+        tri_indices lists the triangles of every leaf contiguously, the triangles of a leaf are
+        tri_indices[left_first:left_first + count].
+
+        :param triangles:   (n_triangles, 3, 3) corner positions
+        '''
+        self.triangles = triangles
+        self.node_min = node_min
+        self.node_max = node_max
+        self.node_left_first = node_left_first
+        self.node_count = node_count
+        self.tri_indices = tri_indices
+
+    @property
+    def n_nodes(self):
+        return len(self.node_count)
+
+    def pack_nodes(self):
+        '''
+        Pack the nodes in the std430 layout of NODE_DTYPE, ready for glBufferData on a GL_SHADER_STORAGE_BUFFER
+        :return: structured array of n_nodes elements
+        '''
+        nodes = np.zeros(self.n_nodes, dtype=NODE_DTYPE)
+        nodes["min"] = self.node_min
+        nodes["max"] = self.node_max
+        nodes["left_first"] = self.node_left_first
+        nodes["count"] = self.node_count
+        return nodes
+
+    def pack_triangles(self):
+        '''
+        Triangle corners in leaf order, padded to vec4 for std430
+        :return: (n_triangles, 3, 4) float32 array
+        '''
+        triangles = np.zeros((len(self.tri_indices), 3, 4), dtype=np.float32)
+        triangles[:, :, :3] = self.triangles[self.tri_indices]
+        return triangles
+
+
+# Triangle corner positions of a mesh loaded with ObjLoader (indexed or not)
+def triangles_from_object(object):
+    n_floats = object.stride // object.itemsize
+    positions = np.asarray(object.vertices).reshape(-1, n_floats)[:, :object.size_position]
+    if object.indices is not None:
+        positions = positions[np.asarray(object.indices)]
+    return np.ascontiguousarray(positions.reshape(-1, 3, 3), dtype=np.float32)
+
+
+# Concatenation of the ranges [start, start + count) without a python loop
+def concatenated_ranges(starts, counts):
+    offsets = np.cumsum(counts) - counts
+    return np.arange(int(counts.sum())) - np.repeat(offsets - starts, counts)
+
+
+# Running min/max over the bins (axis 1) of a (3, n_bins, m) array
+# A loop over the few bins is much faster than ufunc.accumulate along a middle axis
+def sweep(ufunc, bins):
+    out = bins.copy()
+    for i in range(1, out.shape[1]):
+        ufunc(out[:, i - 1], out[:, i], out=out[:, i])
+    return out
+
+
+# Surface area of boxes, axis is the axis of the box coordinates
+def surface_area(box_min, box_max, axis=-1):
+    x, y, z = np.moveaxis(np.maximum(box_max - box_min, 0), axis, 0)
+    return 2 * (x * y + y * z + z * x)
+
+
+def build_bvh(triangles, n_bins=16, leaf_size=4, max_leaf_size=16):
+    '''
+    Build a BVH with the binned surface area heuristic.
+
+    The tree is built one level at a time: all the nodes of a level are binned, evaluated and
+    partitioned together with array operations, so the cost per level is a few passes over the
+    triangles instead of python work per node.
+
+    Nodes with at most leaf_size triangles become leaves. Larger nodes are split at the cheapest
+    bin boundary, unless keeping them as a leaf is cheaper and they have at most max_leaf_size
+    triangles. Nodes whose centroids all fall in one bin are split in the middle.
+
+    :param triangles:   (n_triangles, 3, 3) corner positions
+    :return:            BVH
+    '''
+    triangles = np.ascontiguousarray(triangles, dtype=np.float32)
+    n_triangles = len(triangles)
+
+    tri_min = triangles.min(axis=1)
+    tri_max = triangles.max(axis=1)
+    centroids = (tri_min + tri_max) * 0.5
+
+    max_nodes = max(2 * n_triangles - 1, 1)
+    node_min = np.zeros((max_nodes, 3), dtype=np.float32)
+    node_max = np.zeros((max_nodes, 3), dtype=np.float32)
+    node_left_first = np.zeros(max_nodes, dtype=np.int32)
+    node_count = np.zeros(max_nodes, dtype=np.int32)
+    n_nodes = 1
+
+    order = np.arange(n_triangles)
+
+    # nodes of the current level: id, first position in order, number of triangles
+    level_ids = np.array([0])
+    level_starts = np.array([0])
+    level_counts = np.array([n_triangles])
+
+    while len(level_ids) > 0 and n_triangles > 0:
+        m = len(level_ids)
+        positions = concatenated_ranges(level_starts, level_counts)
+        local = np.repeat(np.arange(m), level_counts)
+        offsets = np.cumsum(level_counts) - level_counts
+        tris = order[positions]
+
+        # bounds of every node of the level
+        level_min = tri_min[tris]
+        level_max = tri_max[tris]
+        box_min = np.minimum.reduceat(level_min, offsets, axis=0)
+        box_max = np.maximum.reduceat(level_max, offsets, axis=0)
+        node_min[level_ids] = box_min
+        node_max[level_ids] = box_max
+
+        # bin the centroids of every node on every axis
+        c = centroids[tris]
+        c_min = np.minimum.reduceat(c, offsets, axis=0)
+        c_max = np.maximum.reduceat(c, offsets, axis=0)
+        extent = c_max - c_min
+        scale = np.where(extent > 0, n_bins / np.where(extent > 0, extent, 1), 0)
+        bins = np.clip(((c - c_min[local]) * scale[local]).astype(np.int64), 0, n_bins - 1)
+
+        # SAH cost of every split plane: cost[axis, split, node] for splits between bin s-1 and s
+        # bins are stored bin major (key = bin * m + node) so the sweeps below run over contiguous rows
+        cost = np.full((3, n_bins - 1, m), np.inf)
+        level_min = np.ascontiguousarray(level_min.T)
+        level_max = np.ascontiguousarray(level_max.T)
+        for axis in range(3):
+            key = bins[:, axis] * m + local
+            bin_count = np.bincount(key, minlength=n_bins * m).reshape(n_bins, m)
+            bin_min = np.full((3, n_bins * m), np.inf, dtype=np.float32)
+            bin_max = np.full((3, n_bins * m), -np.inf, dtype=np.float32)
+            for k in range(3):
+                np.minimum.at(bin_min[k], key, level_min[k])
+                np.maximum.at(bin_max[k], key, level_max[k])
+            bin_min = bin_min.reshape(3, n_bins, m)
+            bin_max = bin_max.reshape(3, n_bins, m)
+
+            left_count = np.cumsum(bin_count, axis=0)[:-1]
+            left_area = surface_area(sweep(np.minimum, bin_min), sweep(np.maximum, bin_max), axis=0)[:-1]
+            right_count = np.cumsum(bin_count[::-1], axis=0)[::-1][1:]
+            right_area = surface_area(sweep(np.minimum, bin_min[:, ::-1])[:, ::-1],
+                                      sweep(np.maximum, bin_max[:, ::-1])[:, ::-1], axis=0)[1:]
+
+            valid = (left_count > 0) & (right_count > 0)
+            with np.errstate(invalid="ignore"):
+                cost[axis] = np.where(valid, left_count * left_area + right_count * right_area, np.inf)
+
+        cost = cost.reshape(-1, m)
+        best = cost.argmin(axis=0)
+        best_axis = best // (n_bins - 1)
+        best_split = best % (n_bins - 1) + 1
+        best_cost = cost[best, np.arange(m)]
+
+        node_area = surface_area(box_min, box_max)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            split_cost = TRAVERSAL_COST + INTERSECTION_COST * best_cost / np.where(node_area > 0, node_area, 1)
+        leaf_cost = INTERSECTION_COST * level_counts
+
+        is_leaf = (level_counts <= leaf_size) | ((leaf_cost <= split_cost) & (level_counts <= max_leaf_size))
+        is_median = ~is_leaf & ~np.isfinite(best_cost)
+
+        # leaves keep their triangles where they are
+        node_count[level_ids[is_leaf]] = level_counts[is_leaf]
+        node_left_first[level_ids[is_leaf]] = level_starts[is_leaf]
+
+        splitting = ~is_leaf
+        if not splitting.any():
+            break
+
+        # left or right side of every triangle, stable partition inside each node
+        rank = np.arange(len(tris)) - offsets[local]
+        goes_left = bins[np.arange(len(tris)), best_axis[local]] < best_split[local]
+        median_tri = is_median[local]
+        goes_left[median_tri] = rank[median_tri] < level_counts[local][median_tri] // 2
+        goes_left[is_leaf[local]] = True
+
+        left_before = np.cumsum(goes_left) - goes_left
+        left_rank = left_before - left_before[offsets][local]
+        right_rank = rank - left_rank
+        n_left = np.add.reduceat(goes_left.astype(np.int64), offsets)
+        new_positions = level_starts[local] + np.where(goes_left, left_rank, n_left[local] + right_rank)
+        order[new_positions] = tris
+
+        # children of the split nodes are stored next to each other
+        split_ids = level_ids[splitting]
+        n_split = len(split_ids)
+        left_ids = n_nodes + 2 * np.arange(n_split)
+        node_left_first[split_ids] = left_ids
+        n_nodes += 2 * n_split
+
+        split_starts = level_starts[splitting]
+        split_left = n_left[splitting]
+        level_ids = np.stack([left_ids, left_ids + 1], axis=1).ravel()
+        level_starts = np.stack([split_starts, split_starts + split_left], axis=1).ravel()
+        level_counts = np.stack([split_left, level_counts[splitting] - split_left], axis=1).ravel()
+
+    return BVH(triangles, node_min[:n_nodes], node_max[:n_nodes],
+               node_left_first[:n_nodes], node_count[:n_nodes], order)
+
+
+def intersect_bvh(bvh, origins, directions):
+    '''
+    Closest hit of a batch of rays against the triangles of a BVH.
+
+    The traversal is breadth first over (ray, node) pairs, so every step is a handful of array
+    operations over all the pairs alive: pairs whose box is missed or lies behind the closest
+    hit found so far are dropped, interior nodes are replaced by their two children and leaves
+    by (ray, triangle) tests (Moller-Trumbore).
+
+    :param origins:     (n, 3) ray origins
+    :param directions:  (n, 3) ray directions
+    :return:            (t, triangle) per ray, t is inf and triangle -1 for rays that miss
+    '''
+    origins = np.asarray(origins, dtype=np.float32)
+    directions = np.asarray(directions, dtype=np.float32)
+    n = len(origins)
+    t_best = np.full(n, np.inf, dtype=np.float32)
+    tri_best = np.full(n, -1, dtype=np.int64)
+    if bvh.n_nodes == 0 or len(bvh.tri_indices) == 0:
+        return t_best, tri_best
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inv_directions = 1.0 / directions
+
+    rays = np.arange(n)
+    nodes = np.zeros(n, dtype=np.int64)
+
+    while len(rays) > 0:
+        # slab test against the boxes of the nodes
+        with np.errstate(invalid="ignore"):
+            t0 = (bvh.node_min[nodes] - origins[rays]) * inv_directions[rays]
+            t1 = (bvh.node_max[nodes] - origins[rays]) * inv_directions[rays]
+        t_near = np.nan_to_num(np.minimum(t0, t1), nan=-np.inf).max(axis=1)
+        t_far = np.nan_to_num(np.maximum(t0, t1), nan=np.inf).min(axis=1)
+        hit = (t_near <= t_far) & (t_far >= 0) & (t_near < t_best[rays])
+        rays, nodes = rays[hit], nodes[hit]
+
+        count = bvh.node_count[nodes]
+        leaf = count > 0
+
+        # leaves: test every triangle of the leaf
+        if leaf.any():
+            leaf_rays = np.repeat(rays[leaf], count[leaf])
+            leaf_tris = bvh.tri_indices[concatenated_ranges(bvh.node_left_first[nodes[leaf]], count[leaf])]
+            t, valid = intersect_triangles(bvh.triangles[leaf_tris], origins[leaf_rays], directions[leaf_rays])
+            t = np.where(valid, t, np.inf)
+
+            closer = t < t_best[leaf_rays]
+            leaf_rays, leaf_tris, t = leaf_rays[closer], leaf_tris[closer], t[closer]
+            np.minimum.at(t_best, leaf_rays, t)
+            winner = t == t_best[leaf_rays]
+            tri_best[leaf_rays[winner]] = leaf_tris[winner]
+
+        # interior nodes: continue with both children
+        inner_rays = rays[~leaf]
+        left = bvh.node_left_first[nodes[~leaf]].astype(np.int64)
+        rays = np.concatenate([inner_rays, inner_rays])
+        nodes = np.concatenate([left, left + 1])
+
+    return t_best, tri_best
+
+
+# Moller-Trumbore intersection of rays with triangles, one triangle per ray
+def intersect_triangles(triangles, origins, directions, epsilon=1e-8):
+    edge1 = triangles[:, 1] - triangles[:, 0]
+    edge2 = triangles[:, 2] - triangles[:, 0]
+    p = np.cross(directions, edge2)
+    det = np.einsum("ij,ij->i", edge1, p)
+    valid = np.abs(det) > epsilon
+    inv_det = 1.0 / np.where(valid, det, 1.0)
+
+    s = origins - triangles[:, 0]
+    u = np.einsum("ij,ij->i", s, p) * inv_det
+    q = np.cross(s, edge1)
+    v = np.einsum("ij,ij->i", directions, q) * inv_det
+    t = np.einsum("ij,ij->i", edge2, q) * inv_det
+
+    valid &= (u >= 0) & (v >= 0) & (u + v <= 1) & (t > epsilon)
+    return t, valid
+
+
+if __name__ == '__main__':
+    '''
+    Builds the BVH of an obj file and prints its size and build time
+
+    Example:
+        python bvhBuilder.py objects/raymanModel.obj
+    '''
+    import sys
+    from objLoaderV4 import ObjLoader
+
+    filename = sys.argv[1] if len(sys.argv) > 1 else "objects/square.obj"
+    obj = ObjLoader(filename)
+    triangles = triangles_from_object(obj)
+
+    start = time.time()
+    bvh = build_bvh(triangles)
+    print("Triangles: ", len(triangles))
+    print("Nodes: ", bvh.n_nodes)
+    print("Build time: ", time.time() - start)
@@ -0,0 +1,496 @@
+import time
+
+import numpy as np
+
+import sceneData
+
+# Constants taken from shaders/common/raytracing.glsl so both paths trace the same image
+PI = 3.14159
+INFINITY = 1e5
+NUM_BOUNCES = 10
+MIN_REFLECTION = 1e-3
+SHIFT = 0.0001
+
+# Background used when no cubemap is given (same as glClearColor in main.py)
+CLEAR_COLOR = (0.3, 0.4, 0.5)
+
+# F0 of the metals selected by mat_type in computePBR (index 0 is unused)
+F0_METALS = np.array([[0.00, 0.00, 0.00],
+                      [0.56, 0.57, 0.58],
+                      [0.95, 0.64, 0.54],
+                      [1.00, 0.71, 0.29],
+                      [0.91, 0.92, 0.92],
+                      [0.95, 0.93, 0.88]], dtype=np.float32)
+
+
+class SceneArrays:
+    def __init__(self, scene):
+        '''
+        Contiguous per object arrays of a sceneData.Scene, with the material of every sphere
+        and plane gathered next to it:
+            sphere_center (n, 3), sphere_radius, sphere_color (n, 3), sphere_metallic, sphere_roughness, sphere_mat_type
+            plane_center (n, 3), plane_size (n, 3), plane_normal (n, 3), plane_roughness
+        :param scene:   sceneData.Scene
+        '''
+        spheres = scene.spheres
+        sphere_materials = scene.materials[spheres["material"]]
+        self.sphere_center = np.ascontiguousarray(spheres["center"])
+        self.sphere_radius = np.ascontiguousarray(spheres["radius"])
+        self.sphere_color = np.ascontiguousarray(sphere_materials["color"])
+        self.sphere_metallic = np.ascontiguousarray(sphere_materials["metallic"])
+        self.sphere_roughness = np.ascontiguousarray(sphere_materials["roughness"])
+        self.sphere_mat_type = np.ascontiguousarray(sphere_materials["mat_type"])
+
+        planes = scene.planes
+        self.plane_center = np.ascontiguousarray(planes["center"])
+        self.plane_size = np.ascontiguousarray(planes["size"])
+        self.plane_normal = np.ascontiguousarray(planes["normal"])
+        self.plane_roughness = np.ascontiguousarray(scene.materials[planes["material"]]["roughness"])
+
+    @property
+    def n_spheres(self):
+        return len(self.sphere_radius)
+
+    @property
+    def n_planes(self):
+        return len(self.plane_size)
+
+
+class Camera:
+    def __init__(self, eye, cameraU, cameraV, cameraW, fov, resolution):
+        '''
+        Camera matching the raytracing uniforms of the sphere shader.
+        :param eye:         eye_pos
+        :param cameraU:     right vector (first column of the view matrix)
+        :param cameraV:     up vector (second column of the view matrix)
+        :param cameraW:     backwards vector (third column of the view matrix)
+        :param fov:         vertical field of view in radians
+        :param resolution:  (width, height) in pixels
+        '''
+        self.eye = np.asarray(eye, dtype=np.float32)[:3]
+        self.U = np.asarray(cameraU, dtype=np.float32)
+        self.V = np.asarray(cameraV, dtype=np.float32)
+        self.W = np.asarray(cameraW, dtype=np.float32)
+        self.fov = float(fov)
+        self.resolution = (int(resolution[0]), int(resolution[1]))
+
+
+# Same basis as pyrr.matrix44.create_look_at(eye, eye + forward, up) used in main.py
+def look_at_camera(eye, forward, up, fov, resolution):
+    forward = np.asarray(forward, dtype=np.float32)
+    forward = forward / np.linalg.norm(forward)
+    side = np.cross(forward, up)
+    side = side / np.linalg.norm(side)
+    camera_up = np.cross(side, forward)
+    camera_up = camera_up / np.linalg.norm(camera_up)
+    return Camera(eye, side, camera_up, -forward, fov, resolution)
+
+
+class Light:
+    def __init__(self, light_pos, lightColor=(1.0, 1.0, 1.0), ambient_intensity=0.1):
+        self.pos = np.asarray(light_pos, dtype=np.float32)[:3]
+        self.color = np.asarray(lightColor, dtype=np.float32)
+        self.ambient_intensity = np.float32(ambient_intensity)
+
+
+# Loads the six cubemap faces into a (6, h, w, 3) float array in the order used by load_cubemap_texture
+def load_cubemap(filenames):
+    from utils import load_images
+
+    faces = []
+    for img_data, img_w, img_h in load_images(filenames, format="RGB", flip=False):
+        faces.append(np.frombuffer(img_data, dtype=np.uint8).reshape(img_h, img_w, 3))
+    return np.stack(faces).astype(np.float32) / 255.0
+
+
+# Bilinear lookup of a cubemap for an array of directions (GL cube map face selection rules)
+def sample_cubemap(cubemap, directions):
+    if cubemap is None:
+        return np.broadcast_to(np.array(CLEAR_COLOR, dtype=np.float32), directions.shape).copy()
+
+    x, y, z = directions[:, 0], directions[:, 1], directions[:, 2]
+    ax, ay, az = np.abs(x), np.abs(y), np.abs(z)
+
+    x_major = (ax >= ay) & (ax >= az)
+    y_major = ~x_major & (ay >= az)
+    z_major = ~x_major & ~y_major
+
+    face = np.empty(len(directions), dtype=np.intp)
+    sc = np.empty(len(directions), dtype=np.float32)
+    tc = np.empty(len(directions), dtype=np.float32)
+    ma = np.empty(len(directions), dtype=np.float32)
+
+    face[x_major] = np.where(x[x_major] > 0, 0, 1)
+    sc[x_major] = np.where(x[x_major] > 0, -z[x_major], z[x_major])
+    tc[x_major] = -y[x_major]
+    ma[x_major] = ax[x_major]
+
+    face[y_major] = np.where(y[y_major] > 0, 2, 3)
+    sc[y_major] = x[y_major]
+    tc[y_major] = np.where(y[y_major] > 0, z[y_major], -z[y_major])
+    ma[y_major] = ay[y_major]
+
+    face[z_major] = np.where(z[z_major] > 0, 4, 5)
+    sc[z_major] = np.where(z[z_major] > 0, x[z_major], -x[z_major])
+    tc[z_major] = -y[z_major]
+    ma[z_major] = az[z_major]
+
+    ma = np.maximum(ma, 1e-20)
+    h, w = cubemap.shape[1:3]
+    s = ((sc / ma + 1) * 0.5) * w - 0.5
+    t = ((tc / ma + 1) * 0.5) * h - 0.5
+
+    s0 = np.floor(s)
+    t0 = np.floor(t)
+    fs = (s - s0)[:, None]
+    ft = (t - t0)[:, None]
+    s0 = s0.astype(np.intp)
+    t0 = t0.astype(np.intp)
+    s1 = np.clip(s0 + 1, 0, w - 1)
+    t1 = np.clip(t0 + 1, 0, h - 1)
+    s0 = np.clip(s0, 0, w - 1)
+    t0 = np.clip(t0, 0, h - 1)
+
+    top = cubemap[face, t0, s0] * (1 - fs) + cubemap[face, t0, s1] * fs
+    bottom = cubemap[face, t1, s0] * (1 - fs) + cubemap[face, t1, s1] * fs
+    return (top * (1 - ft) + bottom * ft).astype(np.float32)
+
+
+def dot(a, b):
+    return np.einsum("ij,ij->i", a, b)
+
+
+def normalize(a):
+    return a / np.linalg.norm(a, axis=1, keepdims=True)
+
+
+def reflect(d, n):
+    return d - 2.0 * dot(n, d)[:, None] * n
+
+
+# Equivalent of getRay() for an array of fragment coordinates (gl_FragCoord.xy)
+def generate_rays(camera, pixels):
+    resolution = np.array(camera.resolution, dtype=np.float32)
+    height = 2.0 * np.tan(camera.fov / 2.0)
+    width = height * resolution[0] / resolution[1]
+    window_dim = np.array([width, height], dtype=np.float32)
+    pixel_size = window_dim / resolution
+    delta = -0.5 * window_dim + pixels.astype(np.float32) * pixel_size
+
+    directions = -camera.W + camera.V * delta[:, 1:2] + camera.U * delta[:, 0:1]
+    origins = np.broadcast_to(camera.eye, directions.shape).copy()
+    return origins, directions.astype(np.float32)
+
+
+# Equivalent of sphereIntersectPoint(): returns min(t1, t2) per ray, or -1 on a miss
+def intersect_sphere(origins, directions, a, center, radius):
+    oc = origins - center
+    b = 2.0 * dot(directions, oc)
+    c = dot(oc, oc) - radius * radius
+    delta = b * b - 4.0 * a * c
+    hit = delta > 0
+    t = np.full(len(origins), -1.0, dtype=np.float32)
+    t[hit] = (-b[hit] - np.sqrt(delta[hit])) / (2.0 * a[hit])
+    return t
+
+
+# Returns the nearest positive sphere distance per ray and the index of that sphere (-1 if none)
+def nearest_sphere(scene, origins, directions):
+    a = dot(directions, directions)
+    nearest_d = np.full(len(origins), INFINITY, dtype=np.float32)
+    nearest_idx = np.full(len(origins), -1, dtype=np.intp)
+    for j in range(scene.n_spheres):
+        t = intersect_sphere(origins, directions, a, scene.sphere_center[j], scene.sphere_radius[j])
+        closer = (t > 0) & (t < nearest_d)
+        nearest_d[closer] = t[closer]
+        nearest_idx[closer] = j
+    return nearest_d, nearest_idx
+
+
+# Returns True for every ray that hits any sphere at d >= 0 (shadow test of the ground branch)
+def any_sphere(scene, origins, directions):
+    a = dot(directions, directions)
+    occluded = np.zeros(len(origins), dtype=bool)
+    for j in range(scene.n_spheres):
+        t = intersect_sphere(origins, directions, a, scene.sphere_center[j], scene.sphere_radius[j])
+        occluded |= t >= 0
+    return occluded
+
+
+# Equivalent of planeIntersectPoint(): returns the distance per ray, or -1 on a miss
+def intersect_plane(origins, directions, center, size):
+    t = np.full(len(origins), -1.0, dtype=np.float32)
+    dy = directions[:, 1]
+    valid = dy != 0.0
+    t[valid] = (center[1] - origins[valid, 1]) / dy[valid]
+
+    points = origins + t[:, None] * directions
+    relative_point = np.abs(points - center)
+    outside = (relative_point[:, 0] > size[0]) | (relative_point[:, 2] > size[2])
+    t[valid & outside] = -1.0
+    return t
+
+
+# Returns the nearest positive plane distance per ray (INFINITY if none) and the index of that plane
+def nearest_plane(scene, origins, directions):
+    nearest_d = np.full(len(origins), INFINITY, dtype=np.float32)
+    nearest_idx = np.full(len(origins), -1, dtype=np.intp)
+    for j in range(scene.n_planes):
+        t = intersect_plane(origins, directions, scene.plane_center[j], scene.plane_size[j])
+        closer = (t > 0.0) & (t < nearest_d)
+        nearest_d[closer] = t[closer]
+        nearest_idx[closer] = j
+    return nearest_d, nearest_idx
+
+
+# Vectorized computePBR() (Cook-Torrance with Schlick Fresnel, GGX distribution and Schlick-GGX geometry)
+def compute_pbr(points, normals, color, metallic, roughness, mat_type, light, eye):
+    N = normalize(normals)
+    L = normalize(light.pos - points)
+    V = normalize(eye - points)
+    H = normalize(L + V)
+
+    metallic = metallic[:, None]
+    F0 = 0.04 * (1 - metallic) + F0_METALS[mat_type] * metallic
+    F = F0 + (1 - F0) * (1 - np.clip(dot(H, V), 0, 1))[:, None] ** 5
+
+    alpha = roughness * roughness
+    k = alpha / 2
+    NV = np.clip(dot(N, V), 0, 1)
+    NL = np.clip(dot(N, L), 0, 1)
+    G = (NV / (NV * (1 - k) + k)) * (NL / (NL * (1 - k) + k))
+
+    NH = np.maximum(dot(H, N), 0)
+    D = alpha ** 2 / (PI * (NH ** 2 * (alpha ** 2 - 1) + 1) ** 2)
+
+    microfacet = F * (D * G)[:, None]
+    diffuse = (1 - F) * (1 - metallic) * color * NL[:, None]
+    ambient = light.ambient_intensity * color
+    specular = microfacet * light.color
+
+    return ambient + specular + diffuse
+
+
+def trace(scene, origins, directions, light, eye, cubemap=None, n_bounces=NUM_BOUNCES, rng=None):
+    '''
+    Vectorized pixelColor(): traces a batch of rays through the scene.
+
+    Every ray of the batch runs the same bounce loop as the GLSL version, rays that
+    escape to the skybox or whose reflection falls below MIN_REFLECTION are dropped from
+    the batch so later bounces only work on the rays that are still alive.
+
+    Like the shader, a ground hit that is not in shadow keeps the color of the
+    previous bounce and a shadowed ground hit darkens every later sky lookup by 0.5.
+
+    :param scene:       SceneArrays
+    :param origins:     (n, 3) ray origins
+    :param directions:  (n, 3) ray directions
+    :param light:       Light
+    :param eye:         eye position used for the view vector of the PBR term
+    :param cubemap:     (6, h, w, 3) float array from load_cubemap, or None for a flat background
+    :param n_bounces:   maximum number of bounces
+    :param rng:         np.random.Generator for progressive samples (rough reflections are scattered
+                        like in the progressive mode of the shader), None for the deterministic image
+    :return:            (n, 3) float32 colors
+    '''
+    eye = np.asarray(eye, dtype=np.float32)[:3]
+    n = len(origins)
+    final_color = np.zeros((n, 3), dtype=np.float32)
+
+    alive = np.arange(n)
+    ray_o = np.asarray(origins, dtype=np.float32).copy()
+    ray_d = np.asarray(directions, dtype=np.float32).copy()
+    color = np.zeros((n, 3), dtype=np.float32)
+    reflection = np.ones(n, dtype=np.float32)
+    shadow_factor = np.ones(n, dtype=np.float32)
+
+    for _ in range(n_bounces):
+        if len(alive) == 0:
+            break
+
+        sphere_d, sphere_idx = nearest_sphere(scene, ray_o, ray_d)
+        closest_d, plane_idx = nearest_plane(scene, ray_o, ray_d)
+
+        hit_sphere = sphere_d < closest_d
+        closest_d = np.where(hit_sphere, sphere_d, closest_d)
+        hit_ground = ~hit_sphere & (closest_d != INFINITY)
+        miss = closest_d == INFINITY
+
+        # Rays that escaped the scene sample the skybox and stop bouncing
+        if miss.any():
+            sky = sample_cubemap(cubemap, ray_d[miss])
+            final_color[alive[miss]] += sky * (shadow_factor[miss] * reflection[miss])[:, None]
+
+        keep = ~miss
+        alive = alive[keep]
+        ray_o, ray_d = ray_o[keep], ray_d[keep]
+        color, reflection, shadow_factor = color[keep], reflection[keep], shadow_factor[keep]
+        closest_d, sphere_idx, plane_idx = closest_d[keep], sphere_idx[keep], plane_idx[keep]
+        hit_sphere, hit_ground = hit_sphere[keep], hit_ground[keep]
+        if len(alive) == 0:
+            break
+
+        points = ray_o + closest_d[:, None] * ray_d
+        normals = np.empty_like(points)
+        plane_hits = plane_idx[hit_ground]
+        normals[hit_ground] = scene.plane_normal[plane_hits]
+        sphere_hits = sphere_idx[hit_sphere]
+        normals[hit_sphere] = normalize(points[hit_sphere] - scene.sphere_center[sphere_hits])
+
+        # Slight delta added to hit point to avoid the sphere from hitting itself on next raycast
+        shifted_points = points + normals * SHIFT
+
+        # Ground: shadow rays towards the light against every sphere
+        if hit_ground.any():
+            shadow_o = shifted_points[hit_ground]
+            shadow_d = normalize(light.pos - shadow_o)
+            shadowed = np.flatnonzero(hit_ground)[any_sphere(scene, shadow_o, shadow_d)]
+            color[shadowed] = 0.0
+            shadow_factor[shadowed] = 0.5
+
+        # Spheres: PBR shading
+        if hit_sphere.any():
+            color[hit_sphere] = compute_pbr(points[hit_sphere], normals[hit_sphere],
+                                            scene.sphere_color[sphere_hits],
+                                            scene.sphere_metallic[sphere_hits],
+                                            scene.sphere_roughness[sphere_hits],
+                                            scene.sphere_mat_type[sphere_hits],
+                                            light, eye)
+
+        final_color[alive] += color * reflection[:, None]
+
+        roughness = np.empty(len(alive), dtype=np.float32)
+        roughness[hit_ground] = scene.plane_roughness[plane_hits]
+        roughness[hit_sphere] = scene.sphere_roughness[sphere_hits]
+        reflection *= 1 - roughness
+
+        # Setting up the next ray
+        ray_o = shifted_points
+        ray_d = reflect(ray_d, normals)
+
+        # Rays whose remaining contribution is negligible stop bouncing
+        keep = reflection > MIN_REFLECTION
+        if not keep.all():
+            alive = alive[keep]
+            ray_o, ray_d, normals = ray_o[keep], ray_d[keep], normals[keep]
+            color, reflection, shadow_factor, roughness = color[keep], reflection[keep], shadow_factor[keep], roughness[keep]
+
+        # Progressive samples scatter rough reflections around the mirror direction
+        if rng is not None:
+            jitter = rng.uniform(-1.0, 1.0, size=ray_d.shape).astype(np.float32)
+            ray_d = normalize(normalize(ray_d) + roughness[:, None] * jitter)
+            below = dot(ray_d, normals) < 0.0
+            ray_d[below] = reflect(ray_d[below], normals[below])
+
+    return final_color
+
+
+# Fragment coordinates (pixel centers, origin at the bottom left) of a rectangle of the image
+def pixel_grid(x0, y0, x1, y1):
+    xs = np.arange(x0, x1, dtype=np.float32) + 0.5
+    ys = np.arange(y0, y1, dtype=np.float32) + 0.5
+    px, py = np.meshgrid(xs, ys)
+    return np.stack([px.ravel(), py.ravel()], axis=1)
+
+
+def render(scene, camera, light, cubemap=None, rect=None, n_bounces=NUM_BOUNCES, rng=None):
+    '''
+    Render the scene (or a rectangle of it) on the CPU.
+    :param scene:   sceneData.Scene
+    :param rect:    (x0, y0, x1, y1) in pixels with y going up like gl_FragCoord, None for the full frame
+    :param rng:     np.random.Generator to render one jittered progressive sample, None for the deterministic image
+    :return:        (rows, columns, 3) float32 image, bottom row first like glReadPixels
+    '''
+    width, height = camera.resolution
+    x0, y0, x1, y1 = rect if rect is not None else (0, 0, width, height)
+
+    pixels = pixel_grid(x0, y0, x1, y1)
+    if rng is not None:
+        pixels += rng.uniform(-0.5, 0.5, size=pixels.shape).astype(np.float32)
+
+    origins, directions = generate_rays(camera, pixels)
+    colors = trace(SceneArrays(scene), origins, directions, light, camera.eye, cubemap, n_bounces, rng)
+    return colors.reshape(y1 - y0, x1 - x0, 3)
+
+
+# Vectorized shaders/gbuffer/frag.glsl: first hit of the camera ray of every pixel, bottom row first
+# Returns the position (rows, columns, 4: hit point, hit type 0 escaped / 1 sphere / 2 ground) and
+# normal (rows, columns, 4: normal, material index) buffers
+def first_hits(scene, camera):
+    width, height = camera.resolution
+    arrays = SceneArrays(scene)
+    origins, directions = generate_rays(camera, pixel_grid(0, 0, width, height))
+
+    sphere_d, sphere_idx = nearest_sphere(arrays, origins, directions)
+    closest_d, plane_idx = nearest_plane(arrays, origins, directions)
+    hit_sphere = sphere_d < closest_d
+    closest_d = np.where(hit_sphere, sphere_d, closest_d)
+    hit_ground = ~hit_sphere & (closest_d != INFINITY)
+    points = origins + closest_d[:, None] * directions
+
+    position = np.zeros((len(origins), 4), dtype=np.float32)
+    normal = np.zeros((len(origins), 4), dtype=np.float32)
+    sphere_hits = sphere_idx[hit_sphere]
+    plane_hits = plane_idx[hit_ground]
+    position[hit_sphere] = np.concatenate([points[hit_sphere], np.ones((len(sphere_hits), 1))], axis=1)
+    position[hit_ground] = np.concatenate([points[hit_ground], np.full((len(plane_hits), 1), 2.0)], axis=1)
+    normal[hit_sphere, :3] = normalize(points[hit_sphere] - arrays.sphere_center[sphere_hits])
+    normal[hit_sphere, 3] = scene.spheres["material"][sphere_hits]
+    normal[hit_ground, :3] = arrays.plane_normal[plane_hits]
+    normal[hit_ground, 3] = scene.planes["material"][plane_hits]
+    return position.reshape(height, width, 4), normal.reshape(height, width, 4)
+
+
+class Accumulator:
+    def __init__(self, resolution):
+        '''
+        Running mean of progressive samples, the CPU counterpart of graphicsLibrary.AccumulationBuffers.
+        :param resolution:  (width, height) in pixels
+        '''
+        self.image = np.zeros((resolution[1], resolution[0], 3), dtype=np.float32)
+        self.n_samples = 0
+
+    def reset(self):
+        self.n_samples = 0
+
+    def add(self, sample):
+        self.n_samples += 1
+        self.image += (sample - self.image) / self.n_samples
+
+
+# Adds one jittered sample per pixel to the accumulator and returns the running mean
+def render_progressive(scene, camera, light, accumulator, cubemap=None, rng=None, n_bounces=NUM_BOUNCES):
+    rng = rng if rng is not None else np.random.default_rng()
+    accumulator.add(render(scene, camera, light, cubemap, n_bounces=n_bounces, rng=rng))
+    return accumulator.image
+
+
+# Converts a rendered float image to top-row-first RGB bytes, clamped like an 8 bit framebuffer
+def to_rgb_bytes(image):
+    img = np.clip(image[::-1], 0.0, 1.0)
+    return (img * 255.0 + 0.5).astype(np.uint8).tobytes()
+
+
+if __name__ == '__main__':
+    '''
+    Renders the default scene with the initial camera and light of main.py and saves it to cpu_render.png
+
+    The image can be compared against a glReadPixels capture of the sphere shader.
+    '''
+    from utils import save_image
+
+    width, height = 1920, 1080
+    cube_map_images = ['images/skybox1/right.png', 'images/skybox1/left.png',
+                       'images/skybox1/top.png', 'images/skybox1/bottom.png',
+                       'images/skybox1/front.png', 'images/skybox1/back.png']
+
+    scene = sceneData.default_scene()
+    camera = look_at_camera([0, 0, 3], [0, 0, -1], [0, 1, 0], np.deg2rad(90), (width, height))
+    light = Light([-10, 10, -10], [1.0, 1.0, 1.0], ambient_intensity=0.1)
+    cubemap = load_cubemap(cube_map_images)
+
+    start = time.time()
+    image = render(scene, camera, light, cubemap)
+    print("Render time: ", time.time() - start)
+
+    save_image("cpu_render.png", to_rgb_bytes(image), width, height)
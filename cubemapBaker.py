@@ -0,0 +1,309 @@
+import json
+import os
+import struct
+import sys
+import time
+
+import numpy as np
+
+import cpuRaytracer
+
+# Baked cubemap container:
+#     magic (8 bytes) | header size (uint32) | json header, padded to DATA_ALIGNMENT | level data
+# The header lists the textures, each with its format, size and levels. A level is the 6 faces one after
+# the other (GL face order), face_nbytes each, starting at offset bytes from the start of the file.
+# Every level starts on a multiple of DATA_ALIGNMENT so the whole file can be memory-mapped and the
+# faces handed to glCompressedTexSubImage2D / glTexSubImage2D as they are.
+MAGIC = b"CUBEMAP1"
+DATA_ALIGNMENT = 16
+
+# Roughness-prefiltered texture: base size, number of levels (roughness 0 to 1) and GGX samples per texel
+PREFILTERED_SIZE = 128
+PREFILTERED_LEVELS = 6
+PREFILTERED_SAMPLES = 128
+
+
+# File of the baked cubemap of a set of faces, next to the directory of the images
+def baked_path(filenames):
+    return os.path.dirname(os.path.abspath(filenames[0])) + ".cubemap"
+
+
+# Identifies the source images, a baked cubemap is only used if it was made from the same files
+def source_key(filenames):
+    key = []
+    for filename in filenames:
+        stat = os.stat(filename)
+        key.append([os.path.abspath(filename), stat.st_size, stat.st_mtime_ns])
+    return key
+
+
+# Averages 2x2 texels, (6, n, n, 3) -> (6, n / 2, n / 2, 3)
+def downsample(faces):
+    n = faces.shape[1] // 2
+    return faces.reshape(6, n, 2, n, 2, 3).mean(axis=(2, 4), dtype=np.float32)
+
+
+# Directions of the texel centers of the 6 faces of an n x n cubemap, (6, n, n, 3), inverse of the GL face selection
+def face_directions(n):
+    coords = (np.arange(n, dtype=np.float32) + 0.5) / n * 2.0 - 1.0
+    t, s = np.meshgrid(coords, coords, indexing="ij")
+    one = np.ones_like(s)
+    directions = np.stack([np.stack([one, -t, -s], axis=-1),
+                           np.stack([-one, -t, s], axis=-1),
+                           np.stack([s, one, t], axis=-1),
+                           np.stack([s, -one, -t], axis=-1),
+                           np.stack([s, -t, one], axis=-1),
+                           np.stack([-s, -t, -one], axis=-1)])
+    return directions / np.linalg.norm(directions, axis=-1, keepdims=True)
+
+
+# Hammersley points, a low discrepancy set of n samples in [0, 1)^2
+def hammersley(n):
+    i = np.arange(n, dtype=np.uint32)
+    bits = i.copy()
+    bits = ((bits << 16) | (bits >> 16)) & 0xFFFFFFFF
+    bits = ((bits & 0x55555555) << 1) | ((bits & 0xAAAAAAAA) >> 1)
+    bits = ((bits & 0x33333333) << 2) | ((bits & 0xCCCCCCCC) >> 2)
+    bits = ((bits & 0x0F0F0F0F) << 4) | ((bits & 0xF0F0F0F0) >> 4)
+    bits = ((bits & 0x00FF00FF) << 8) | ((bits & 0xFF00FF00) >> 8)
+    return np.stack([i / n, bits.astype(np.float64) / 2.0 ** 32], axis=1)
+
+
+def prefilter_ggx(mips, size, roughness, n_samples=PREFILTERED_SAMPLES):
+    '''
+    Convolve the environment with the GGX lobe of a roughness, for a view along the normal (N = V = R).
+    Same alpha = roughness^2 as microfacet_distribution in the shader.
+
+    Every sample is read from the mip level whose texels cover about the solid angle of the sample
+    (filtered importance sampling), so a few samples are enough without aliasing bright spots.
+
+    :param mips:    list of (6, n, n, 3) float levels of the environment, largest first
+    :param size:    size of the faces of the result
+    :return:        (6, size, size, 3) float32
+    '''
+    normals = face_directions(size).reshape(-1, 3)
+    if roughness == 0.0:
+        level = min(int(np.log2(mips[0].shape[1] / size)), len(mips) - 1)
+        return cpuRaytracer.sample_cubemap(mips[level], normals).reshape(6, size, size, 3).astype(np.float32)
+
+    # Tangent frame around every normal
+    up = np.where(np.abs(normals[:, 2:3]) < 0.999, [[0.0, 0.0, 1.0]], [[1.0, 0.0, 0.0]]).astype(np.float32)
+    tangent_x = cpuRaytracer.normalize(np.cross(up, normals))
+    tangent_y = np.cross(normals, tangent_x)
+
+    alpha = roughness ** 2
+    texel_solid_angle = 4.0 * np.pi / (6.0 * mips[0].shape[1] ** 2)
+
+    color = np.zeros_like(normals)
+    weight = 0.0
+    for u, v in hammersley(n_samples):
+        # GGX importance sample of the half vector, in the tangent frame
+        cos_theta = np.sqrt((1.0 - v) / (1.0 + (alpha ** 2 - 1.0) * v))
+        sin_theta = np.sqrt(1.0 - cos_theta ** 2)
+        phi = 2.0 * np.pi * u
+        h = (tangent_x * (sin_theta * np.cos(phi)) + tangent_y * (sin_theta * np.sin(phi))
+             + normals * cos_theta).astype(np.float32)
+
+        # With V = N, the reflected direction and its weight only depend on the sample, not on the texel
+        n_dot_l = 2.0 * cos_theta ** 2 - 1.0
+        if n_dot_l <= 0.0:
+            continue
+        directions = 2.0 * cos_theta * h - normals
+
+        d = alpha ** 2 / (np.pi * (cos_theta ** 2 * (alpha ** 2 - 1.0) + 1.0) ** 2)
+        pdf = d / 4.0
+        sample_solid_angle = 1.0 / (n_samples * pdf + 1e-6)
+        level = int(np.clip(np.round(0.5 * np.log2(sample_solid_angle / texel_solid_angle)), 0, len(mips) - 1))
+
+        color += cpuRaytracer.sample_cubemap(mips[level], directions) * n_dot_l
+        weight += n_dot_l
+
+    return (color / weight).reshape(6, size, size, 3).astype(np.float32)
+
+
+def encode_bc1(image):
+    '''
+    Compress an RGB image to BC1 (DXT1), 8 bytes per 4x4 block.
+    The endpoints of every block are the extreme colors along its principal axis, and each
+    texel takes the closest of the 4 colors interpolated between them.
+    :param image:   (h, w, 3) uint8, padded to multiples of 4 by repeating the edges
+    :return:        bytes of the blocks, rows of blocks from the top
+    '''
+    h, w = image.shape[:2]
+    bh, bw = -(-h // 4), -(-w // 4)
+    image = np.pad(image, ((0, bh * 4 - h), (0, bw * 4 - w), (0, 0)), mode="edge")
+    blocks = image.reshape(bh, 4, bw, 4, 3).transpose(0, 2, 1, 3, 4).reshape(-1, 16, 3).astype(np.float32)
+
+    # Principal axis of the colors of every block, by power iteration on the covariance
+    mean = blocks.mean(axis=1, keepdims=True)
+    centered = blocks - mean
+    covariance = np.einsum("nki,nkj->nij", centered, centered)
+    axis = blocks.max(axis=1) - blocks.min(axis=1) + 1e-3
+    for _ in range(4):
+        axis = np.einsum("nij,nj->ni", covariance, axis)
+        axis /= np.maximum(np.abs(axis).max(axis=1, keepdims=True), 1e-12)
+    projection = np.einsum("nki,ni->nk", centered, axis)
+    block_index = np.arange(len(blocks))
+    color0 = blocks[block_index, projection.argmax(axis=1)]
+    color1 = blocks[block_index, projection.argmin(axis=1)]
+
+    # RGB 565 endpoints, color0 > color1 selects the 4 color mode
+    def to_565(color):
+        c = np.round(color * [31 / 255, 63 / 255, 31 / 255]).astype(np.uint16)
+        return (c[:, 0] << 11) | (c[:, 1] << 5) | c[:, 2]
+
+    def from_565(c):
+        return np.stack([(c >> 11) & 31, (c >> 5) & 63, c & 31], axis=1) * np.array([255 / 31, 255 / 63, 255 / 31],
+                                                                                   dtype=np.float32)
+
+    c0 = to_565(color0)
+    c1 = to_565(color1)
+    swap = c0 < c1
+    c0[swap], c1[swap] = c1[swap], c0[swap].copy()
+    p0 = from_565(c0)
+    p1 = from_565(c1)
+
+    # The 4 colors are p0, p1, 2/3 p0 + 1/3 p1, 1/3 p0 + 2/3 p1, all on the segment p0 -> p1:
+    # the closest is found from the position of the texel along the segment
+    segment = p1 - p0
+    length = np.maximum(np.einsum("ni,ni->n", segment, segment), 1e-12)
+    t = np.einsum("nki,ni->nk", blocks - p0[:, None], segment) / length[:, None]
+    indices = np.select([t < 1 / 6, t < 1 / 2, t < 5 / 6], [0, 2, 3], default=1).astype(np.uint32)
+    indices[c0 == c1] = 0
+
+    bits = np.bitwise_or.reduce(indices << (2 * np.arange(16, dtype=np.uint32)), axis=1)
+    packed = np.empty(len(blocks), dtype=[("c0", "<u2"), ("c1", "<u2"), ("bits", "<u4")])
+    packed["c0"] = c0
+    packed["c1"] = c1
+    packed["bits"] = bits
+    return packed.tobytes()
+
+
+def to_bytes(faces):
+    return np.clip(np.round(faces * 255.0), 0, 255).astype(np.uint8)
+
+
+def bake(filenames, output=None, compress=True):
+    '''
+    Decode the 6 faces of a cubemap once and write everything the renderer needs to one file:
+        skybox:         the faces and their whole mip chain (box filtered), BC1 compressed or RGB8
+        prefiltered:    PREFILTERED_LEVELS levels starting at PREFILTERED_SIZE, level k convolved with
+                        the GGX lobe of roughness k / (PREFILTERED_LEVELS - 1), RGB8
+    :param filenames:   faces in GL order (+x, -x, +y, -y, +z, -z)
+    :return:            name of the written file
+    '''
+    from utils import load_images
+
+    output = output or baked_path(filenames)
+
+    faces = []
+    for img_data, img_w, img_h in load_images(filenames, format="RGB", flip=False):
+        faces.append(np.frombuffer(img_data, dtype=np.uint8).reshape(img_h, img_w, 3))
+    faces = np.stack(faces)
+    size = faces.shape[1]
+    if faces.shape[1] != faces.shape[2] or size & (size - 1):
+        raise ValueError(f"Cubemap faces must be square with a power of two size, not {faces.shape[2]}x{faces.shape[1]}")
+
+    # Float mip chain, also the source of the prefiltering
+    mips = [faces.astype(np.float32) / 255.0]
+    while mips[-1].shape[1] > 1:
+        mips.append(downsample(mips[-1]))
+
+    skybox_format = "BC1" if compress else "RGB8"
+    skybox_levels = []
+    for level, mip in enumerate(mips):
+        data = to_bytes(mip) if level > 0 else faces
+        if compress:
+            skybox_levels.append([encode_bc1(face) for face in data])
+        else:
+            skybox_levels.append([face.tobytes() for face in data])
+
+    prefiltered_levels = []
+    roughness_levels = np.linspace(0.0, 1.0, PREFILTERED_LEVELS)
+    for level, roughness in enumerate(roughness_levels):
+        level_size = max(PREFILTERED_SIZE >> level, 1)
+        prefiltered = prefilter_ggx(mips, level_size, float(roughness))
+        prefiltered_levels.append([face.tobytes() for face in to_bytes(prefiltered)])
+
+    # Lay out the levels one after the other, then place them after the header (whose size depends on their offsets)
+    textures = {"skybox": {"format": skybox_format, "size": size, "levels": skybox_levels},
+                "prefiltered": {"format": "RGB8", "size": PREFILTERED_SIZE, "levels": prefiltered_levels,
+                                "roughness": roughness_levels.tolist()}}
+    header = {"source": source_key(filenames), "textures": {}}
+    chunks = []
+    relative_offsets = []
+    data_size = 0
+    for name, texture in textures.items():
+        levels = []
+        for level, level_faces in enumerate(texture["levels"]):
+            levels.append({"size": max(texture["size"] >> level, 1), "face_nbytes": len(level_faces[0])})
+            chunk = b"".join(level_faces)
+            chunk += b"\0" * (-len(chunk) % DATA_ALIGNMENT)
+            chunks.append(chunk)
+            relative_offsets.append(data_size)
+            data_size += len(chunk)
+        header["textures"][name] = dict(texture, levels=levels)
+
+    data_start = 0
+    while True:
+        all_levels = [level for texture in header["textures"].values() for level in texture["levels"]]
+        for level, relative_offset in zip(all_levels, relative_offsets):
+            level["offset"] = data_start + relative_offset
+        header_bytes = json.dumps(header).encode()
+        header_end = len(MAGIC) + 4 + len(header_bytes)
+        if header_end <= data_start:
+            break
+        data_start = header_end + (-header_end % DATA_ALIGNMENT)
+
+    with open(output + ".tmp", "wb") as file:
+        file.write(MAGIC)
+        file.write(struct.pack("<I", len(header_bytes)))
+        file.write(header_bytes)
+        file.write(b"\0" * (data_start - header_end))
+        for chunk in chunks:
+            file.write(chunk)
+    os.replace(output + ".tmp", output)
+    return output
+
+
+def read_baked(filename, filenames=None):
+    '''
+    Open a baked cubemap without reading its data.
+    :param filenames:   source images, the file is rejected if it was baked from other or modified files
+    :return:            (header, data) with data a read-only uint8 memmap of the whole file,
+                        or None if the file is missing, invalid or out of date
+    '''
+    try:
+        with open(filename, "rb") as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                return None
+            header_size, = struct.unpack("<I", file.read(4))
+            header = json.loads(file.read(header_size))
+        if filenames is not None and header["source"] != source_key(filenames):
+            return None
+        return header, np.memmap(filename, dtype=np.uint8, mode="r")
+    except (OSError, ValueError, KeyError, struct.error):
+        return None
+
+
+# Face bytes of a level of a texture of a baked cubemap, views of the memmap
+def level_faces(data, level):
+    start = level["offset"]
+    n = level["face_nbytes"]
+    return [data[start + face * n: start + (face + 1) * n] for face in range(6)]
+
+
+if __name__ == '__main__':
+    '''
+    Usage:
+        python cubemapBaker.py [right.png left.png top.png bottom.png front.png back.png]
+
+    Bakes images/skybox1 by default. main.py bakes it on its first start if the file is missing.
+    '''
+    cube_map_images = sys.argv[1:7] if len(sys.argv) >= 7 else [
+        'images/skybox1/right.png', 'images/skybox1/left.png',
+        'images/skybox1/top.png', 'images/skybox1/bottom.png',
+        'images/skybox1/front.png', 'images/skybox1/back.png']
+    start = time.time()
+    output = bake(cube_map_images)
+    print("Baked", output, "in", time.time() - start, "s")
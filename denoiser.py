@@ -0,0 +1,201 @@
+import time
+
+import numpy as np
+
+# 5 taps of the B3 spline kernel of the a-trous filter, the 5x5 kernel is their outer product
+KERNEL = np.array([1.0 / 16.0, 1.0 / 4.0, 3.0 / 8.0, 1.0 / 4.0, 1.0 / 16.0], dtype=np.float32)
+
+# Default filter settings, the same values are set on the denoise shaders by graphicsLibrary.Denoiser
+N_ITERATIONS = 3                # step sizes 1, 2, 4: a 29 x 29 pixels footprint
+MAX_HISTORY = 16.0              # frames blended by the temporal pass, at most
+POSITION_TOLERANCE = 0.01       # distance between the reprojected hits, relative to their distance to the eye
+SIGMA_COLOR = 0.2
+SIGMA_NORMAL = 64.0
+SIGMA_DEPTH = 0.05
+SIGMA_ALBEDO = 0.2
+
+
+# Albedo guide of every pixel, from the material index of the G-buffer normals (1 for the sky)
+def albedo_buffer(materials, position, normal):
+    albedo = np.ones(position.shape[:2] + (3,), dtype=np.float32)
+    hit = position[..., 3] != 0.0
+    albedo[hit] = materials["color"][normal[hit, 3].astype(np.intp)]
+    return albedo
+
+
+def reproject(color, position, history_color, history_length, history_position, previous_view_projection, eye,
+              max_history=MAX_HISTORY, position_tolerance=POSITION_TOLERANCE):
+    '''
+    Temporal pass of the denoiser, same as shaders/denoise/temporal.glsl.
+    Each pixel looks up where its first hit was in the previous frame and blends its new sample with the
+    history found there, if the history pixel saw the same surface.
+
+    :param color:                       (h, w, 3) new samples
+    :param position:                    (h, w, 4) G-buffer positions (xyz hit point, w hit type)
+    :param history_color:               (h, w, 3) running mean of the previous frame
+    :param history_length:              (h, w) number of frames in the running mean
+    :param history_position:            (h, w, 4) G-buffer positions of the previous frame
+    :param previous_view_projection:    pyrr view @ projection matrix of the previous frame
+    :param eye:                         eye position of the current frame
+    :return: the new running mean (h, w, 3) and its number of frames (h, w)
+    '''
+    height, width = color.shape[:2]
+    points = position[..., :3].reshape(-1, 3)
+    hit = position[..., 3].ravel() != 0.0
+
+    clip = np.concatenate([points, np.ones((len(points), 1), dtype=np.float32)], axis=1) @ previous_view_projection
+    w = clip[:, 3]
+    safe_w = np.where(w > 0.0, w, 1.0)
+    uv = clip[:, :2] / safe_w[:, None] * 0.5 + 0.5
+    valid = hit & (w > 0.0) & np.all((uv >= 0.0) & (uv < 1.0), axis=1)
+
+    texels = np.clip((uv * (width, height)).astype(np.intp), 0, (width - 1, height - 1))
+    previous_position = history_position[texels[:, 1], texels[:, 0]]
+    tolerance = position_tolerance * np.maximum(1.0, np.linalg.norm(points - eye, axis=1))
+    valid &= (previous_position[:, 3] == position[..., 3].ravel()) & \
+             (np.linalg.norm(previous_position[:, :3] - points, axis=1) < tolerance)
+
+    n_frames = np.ones(len(points), dtype=np.float32)
+    n_frames[valid] = np.minimum(history_length[texels[valid, 1], texels[valid, 0]] + 1.0, max_history)
+    result = color.reshape(-1, 3).copy()
+    history = history_color[texels[valid, 1], texels[valid, 0]]
+    result[valid] = history + (result[valid] - history) / n_frames[valid, None]
+    return result.reshape(height, width, 3), n_frames.reshape(height, width)
+
+
+def atrous_iteration(color, n_frames, position, normal, albedo, depth, step_size,
+                     sigma_color=SIGMA_COLOR, sigma_normal=SIGMA_NORMAL, sigma_depth=SIGMA_DEPTH,
+                     sigma_albedo=SIGMA_ALBEDO):
+    '''
+    One iteration of the edge-aware a-trous filter, same as shaders/denoise/atrous.glsl:
+    a 5x5 B3 spline kernel with holes of step_size pixels, where each neighbor is weighted down when its
+    normal, depth, albedo or color differ from the center pixel. Sky pixels are kept as they are.
+    :return: the filtered (h, w, 3) color
+    '''
+    height, width = color.shape[:2]
+    hit = position[..., 3]
+    color_sigma = sigma_color / np.sqrt(np.maximum(n_frames, 1.0))
+
+    total = np.zeros_like(color)
+    weight_sum = np.zeros((height, width), dtype=np.float32)
+    for dy in range(-2, 3):
+        rows = np.clip(np.arange(height) + dy * step_size, 0, height - 1)
+        for dx in range(-2, 3):
+            columns = np.clip(np.arange(width) + dx * step_size, 0, width - 1)
+            q_color = color[rows][:, columns]
+            q_albedo = albedo[rows][:, columns]
+
+            normal_weight = np.maximum(np.sum(normal[..., :3] * normal[rows][:, columns, :3], axis=-1), 0.0) ** sigma_normal
+            depth_weight = np.exp(-np.abs(depth[rows][:, columns] - depth) / (sigma_depth * depth + 1e-4))
+            albedo_weight = np.exp(-np.sum((q_albedo - albedo) ** 2, axis=-1) / sigma_albedo ** 2)
+            color_weight = np.exp(-np.sum((q_color - color) ** 2, axis=-1) / color_sigma ** 2)
+            weight = KERNEL[dx + 2] * KERNEL[dy + 2] * normal_weight * depth_weight * albedo_weight * color_weight
+            weight = np.where(hit[rows][:, columns] == hit, weight, 0.0)
+
+            total += q_color * weight[..., None]
+            weight_sum += weight
+
+    sky = hit == 0.0
+    filtered = total / np.where(sky, 1.0, weight_sum)[..., None]
+    filtered[sky] = color[sky]
+    return filtered.astype(np.float32)
+
+
+def atrous_filter(color, n_frames, position, normal, albedo, eye, n_iterations=N_ITERATIONS, **sigmas):
+    # Iterations with step sizes 1, 2, 4, ... the guides stay the same, only the color is filtered again
+    depth = np.linalg.norm(position[..., :3] - np.asarray(eye, dtype=np.float32)[:3], axis=-1)
+    for iteration in range(n_iterations):
+        color = atrous_iteration(color, n_frames, position, normal, albedo, depth, 2 ** iteration, **sigmas)
+    return color
+
+
+class Denoiser:
+    def __init__(self, n_iterations=N_ITERATIONS, max_history=MAX_HISTORY, position_tolerance=POSITION_TOLERANCE,
+                 **sigmas):
+        '''
+        Spatiotemporal denoiser of 1 sample per pixel frames, the NumPy version of graphicsLibrary.Denoiser:
+
+            denoiser = Denoiser()
+            position, normal = cpuRaytracer.first_hits(scene, camera)
+            albedo = albedo_buffer(scene.materials, position, normal)
+            for frame in range(n_frames):
+                sample = cpuRaytracer.render(scene, camera, light, rng=rng)
+                image = denoiser.denoise(sample, position, normal, albedo, camera.eye, view_projection)
+
+        Every frame is first blended with the reprojected history of the previous frames (reproject), then
+        filtered by n_iterations of the a-trous filter guided by the G-buffer (atrous_filter).
+        The unfiltered running mean is kept as the history of the next frame.
+        '''
+        self.n_iterations = n_iterations
+        self.max_history = max_history
+        self.position_tolerance = position_tolerance
+        self.sigmas = sigmas
+        self.reset()
+
+    def reset(self):
+        self.history = None         # (color, n_frames, position) of the previous frame
+        self.previous_view_projection = None
+
+    def denoise(self, color, position, normal, albedo, eye, view_projection):
+        '''
+        :param color:           (h, w, 3) new frame
+        :param position:        (h, w, 4) G-buffer positions
+        :param normal:          (h, w, 4) G-buffer normals
+        :param albedo:          (h, w, 3) see albedo_buffer
+        :param eye:             eye position
+        :param view_projection: pyrr view @ projection matrix of this frame
+        :return: the denoised (h, w, 3) frame
+        '''
+        # clamped to the displayed range, a single bright sample would otherwise stay in the history for many frames
+        color = np.clip(np.asarray(color, dtype=np.float32), 0.0, 1.0)
+        eye = np.asarray(eye, dtype=np.float32)[:3]
+        if self.history is None:
+            n_frames = np.ones(color.shape[:2], dtype=np.float32)
+        else:
+            history_color, history_length, history_position = self.history
+            color, n_frames = reproject(color, position, history_color, history_length, history_position,
+                                        self.previous_view_projection, eye, self.max_history,
+                                        self.position_tolerance)
+        self.history = (color, n_frames, position)
+        self.previous_view_projection = np.asarray(view_projection, dtype=np.float32)
+
+        return atrous_filter(color, n_frames, position, normal, albedo, eye, self.n_iterations, **self.sigmas)
+
+
+if __name__ == '__main__':
+    '''
+    Denoises 1 sample per pixel CPU renders of the default scene with a still camera and compares
+    them with a 64 samples reference:
+
+        python denoiser.py
+    '''
+    import pyrr
+
+    import cpuRaytracer
+    import sceneData
+
+    width, height = 320, 180
+    scene = sceneData.default_scene()
+    eye, forward, up = np.array([0, 0, 3], dtype=np.float32), np.array([0, 0, -1], dtype=np.float32), [0, 1, 0]
+    camera = cpuRaytracer.look_at_camera(eye, forward, up, np.deg2rad(90), (width, height))
+    light = cpuRaytracer.Light([-10, 10, -10], [1.0, 1.0, 1.0], ambient_intensity=0.1)
+    view_projection = pyrr.matrix44.create_look_at(eye, eye + forward, up) @ \
+                      pyrr.matrix44.create_perspective_projection_matrix(90, width / height, 0.1, 100)
+
+    rng = np.random.default_rng(0)
+    reference = cpuRaytracer.Accumulator((width, height))
+    for _ in range(64):
+        cpuRaytracer.render_progressive(scene, camera, light, reference, rng=rng)
+
+    position, normal = cpuRaytracer.first_hits(scene, camera)
+    albedo = albedo_buffer(scene.materials, position, normal)
+    denoiser = Denoiser()
+    for frame in range(8):
+        sample = cpuRaytracer.render(scene, camera, light, rng=rng)
+        start = time.time()
+        image = denoiser.denoise(sample, position, normal, albedo, eye, view_projection)
+        # errors of the displayed colors, clamped like the 8 bit framebuffer
+        target = np.clip(reference.image, 0.0, 1.0)
+        print(f"Frame {frame}: denoise {time.time() - start:.3f} s, "
+              f"RMSE 1 spp {np.sqrt(np.mean((np.clip(sample, 0.0, 1.0) - target) ** 2)):.4f}, "
+              f"denoised {np.sqrt(np.mean((np.clip(image, 0.0, 1.0) - target) ** 2)):.4f}")
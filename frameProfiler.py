@@ -0,0 +1,135 @@
+import collections
+import contextlib
+import csv
+import json
+import time
+
+import numpy as np
+
+from OpenGL.GL import *
+
+# Percentiles shown by the report
+PERCENTILES = (50, 95, 99)
+
+
+class FrameProfiler:
+    def __init__(self, window=240, n_query_buffers=3, trace=False):
+        '''
+        Times the stages of the render loop, on the CPU and on the GPU:
+
+            with profiler.cpu("input"):
+                input_handler()
+            with profiler.gpu("sphere"):
+                graphicsLibrary.draw_buffers(vao_obj, obj)
+            profiler.end_frame()
+
+        CPU scopes use time.perf_counter and can be nested. GPU scopes use GL_TIME_ELAPSED queries,
+        which can not be nested or overlap. The queries of a frame are only read n_query_buffers - 1
+        frames later, when the GPU is done with them, so reading them never stalls the pipeline.
+
+        :param window:          number of frames the rolling percentiles are computed over
+        :param n_query_buffers: number of frames of queries in flight
+        :param trace:           keep every sample, for dump()
+        '''
+        self.window = window
+        self.samples = {}                       # ("cpu" or "gpu", stage) -> deque of the last durations in ms
+        self.trace = [] if trace else None      # (frame, "cpu" or "gpu", stage, ms)
+        self.n_frames = 0
+        self.n_dropped_queries = 0
+        self.current = collections.defaultdict(float)
+        self.last_frame_end = None
+
+        self.query_pool = []
+        self.query_buffers = [[] for _ in range(n_query_buffers)]   # (frame, stage, query) issued in each frame slot
+
+    @contextlib.contextmanager
+    def cpu(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.current[stage] += (time.perf_counter() - start) * 1000.0
+
+    @contextlib.contextmanager
+    def gpu(self, stage):
+        query = self.query_pool.pop() if self.query_pool else glGenQueries(1)
+        glBeginQuery(GL_TIME_ELAPSED, query)
+        try:
+            yield
+        finally:
+            glEndQuery(GL_TIME_ELAPSED)
+            self.query_buffers[self.n_frames % len(self.query_buffers)].append((self.n_frames, stage, query))
+
+    def end_frame(self):
+        now = time.perf_counter()
+        if self.last_frame_end is not None:
+            self.current["frame"] = (now - self.last_frame_end) * 1000.0
+        self.last_frame_end = now
+
+        for stage, ms in self.current.items():
+            self.add_sample(self.n_frames, "cpu", stage, ms)
+        self.current = collections.defaultdict(float)
+
+        self.n_frames += 1
+        # The slot about to be reused holds the queries of the oldest frame in flight
+        self.collect_queries(self.query_buffers[self.n_frames % len(self.query_buffers)])
+
+    def collect_queries(self, queries):
+        for frame, stage, query in queries:
+            if glGetQueryObjectiv(query, GL_QUERY_RESULT_AVAILABLE):
+                nanoseconds = glGetQueryObjectui64v(query, GL_QUERY_RESULT)
+                self.add_sample(frame, "gpu", stage, nanoseconds / 1e6)
+            else:
+                # Still not done after several frames, drop it instead of waiting
+                self.n_dropped_queries += 1
+            self.query_pool.append(query)
+        queries.clear()
+
+    def add_sample(self, frame, kind, stage, ms):
+        key = (kind, stage)
+        if key not in self.samples:
+            self.samples[key] = collections.deque(maxlen=self.window)
+        self.samples[key].append(ms)
+        if self.trace is not None:
+            self.trace.append((frame, kind, stage, ms))
+
+    def percentiles(self):
+        '''
+        :return: dict of (kind, stage) -> array of the PERCENTILES of its durations in ms, over the rolling window
+        '''
+        return {key: np.percentile(np.fromiter(values, dtype=np.float64), PERCENTILES)
+                for key, values in self.samples.items() if values}
+
+    def report(self):
+        # Table of the rolling percentiles, one line per stage
+        lines = [f"{'':4} {'stage':12}" + "".join(f"{'p' + str(p):>9}" for p in PERCENTILES) + "   (ms)"]
+        for (kind, stage), values in sorted(self.percentiles().items()):
+            lines.append(f"{kind:4} {stage:12}" + "".join(f"{value:9.3f}" for value in values))
+        if self.n_dropped_queries:
+            lines.append(f"{self.n_dropped_queries} GPU queries dropped")
+        return "\n".join(lines)
+
+    def dump(self, filename):
+        '''
+        Write every sample kept since the start (trace=True) to a .json or .csv file,
+        one record (frame, kind, stage, ms) per sample.
+        '''
+        if self.trace is None:
+            raise ValueError("The profiler was created without trace=True")
+
+        if filename.endswith(".json"):
+            with open(filename, "w") as f:
+                json.dump({"percentiles": {f"{kind}/{stage}": dict(zip(map(str, PERCENTILES), values.tolist()))
+                                           for (kind, stage), values in self.percentiles().items()},
+                           "samples": [dict(zip(("frame", "kind", "stage", "ms"), sample)) for sample in self.trace]},
+                          f, indent=1)
+        else:
+            with open(filename, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(("frame", "kind", "stage", "ms"))
+                writer.writerows(self.trace)
+
+    def delete(self):
+        queries = self.query_pool + [query for buffer in self.query_buffers for _, _, query in buffer]
+        if queries:
+            glDeleteQueries(len(queries), queries)
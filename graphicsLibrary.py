@@ -1,7 +1,16 @@
+import collections
+
 import numpy as np
 
 from OpenGL.GL import *
-from utils import load_image
+from OpenGL.GL.EXT.texture_compression_s3tc import GL_COMPRESSED_RGB_S3TC_DXT1_EXT
+from utils import iter_load_images
+import cubemapBaker
+import denoiser
+
+# GL formats of the texture formats of baked cubemaps: (internal format, pixel format or None if compressed)
+BAKED_FORMATS = {"BC1": (GL_COMPRESSED_RGB_S3TC_DXT1_EXT, None),
+                 "RGB8": (GL_RGB8, GL_RGB)}
 
 
 # Loads textures
@@ -24,9 +33,9 @@ def load_cubemap_texture(filenames):
              GL_TEXTURE_CUBE_MAP_POSITIVE_Y, GL_TEXTURE_CUBE_MAP_NEGATIVE_Y,
              GL_TEXTURE_CUBE_MAP_POSITIVE_Z, GL_TEXTURE_CUBE_MAP_NEGATIVE_Z]
 
-    # Load and bind images to the corresponding faces
-    for i in range(6):
-        img_data, img_w, img_h = load_image(filenames[i], format="RGB", flip=False)
+    # Load and bind images to the corresponding faces.
+    # The faces are decoded at the same time on other threads, each one is uploaded here as soon as it is ready
+    for i, (img_data, img_w, img_h) in iter_load_images(filenames, format="RGB", flip=False):
         glTexImage2D(faces[i], 0, GL_RGB, img_w, img_h, 0, GL_RGB, GL_UNSIGNED_BYTE, img_data)
 
     # Generate mipmaps
@@ -37,6 +46,68 @@ def load_cubemap_texture(filenames):
 
     return texture_id
 
+# Loads 2D textures (e.g. material textures) with their mipmaps, decoding the images in parallel.
+# The uploads stay on the calling thread, which owns the GL context
+# Returns the texture ids in the order of filenames
+def load_textures(filenames, format="RGBA"):
+    pixel_format = {"RGB": GL_RGB, "RGBA": GL_RGBA}[format]
+    texture_ids = [glGenTextures(1) for _ in filenames]
+
+    glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+    for i, (img_data, img_w, img_h) in iter_load_images(filenames, format=format, flip=True):
+        glBindTexture(GL_TEXTURE_2D, texture_ids[i])
+        glTexImage2D(GL_TEXTURE_2D, 0, pixel_format, img_w, img_h, 0, pixel_format, GL_UNSIGNED_BYTE, img_data)
+        glGenerateMipmap(GL_TEXTURE_2D)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+    glPixelStorei(GL_UNPACK_ALIGNMENT, 4)
+
+    glBindTexture(GL_TEXTURE_2D, 0)
+    return texture_ids
+
+# Loads a cubemap baked by cubemapBaker, baking it first if it is missing or older than the images
+# Returns the ids of the skybox texture (full mip chain) and of the roughness-prefiltered texture
+def load_baked_cubemap(filenames):
+    baked = cubemapBaker.read_baked(cubemapBaker.baked_path(filenames), filenames)
+    if baked is None:
+        cubemapBaker.bake(filenames)
+        baked = cubemapBaker.read_baked(cubemapBaker.baked_path(filenames), filenames)
+    header, data = baked
+
+    glEnable(GL_TEXTURE_CUBE_MAP_SEAMLESS)
+    glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+
+    texture_ids = []
+    for name in ("skybox", "prefiltered"):
+        texture = header["textures"][name]
+        internal_format, pixel_format = BAKED_FORMATS[texture["format"]]
+
+        texture_id = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_CUBE_MAP, texture_id)
+        glTexStorage2D(GL_TEXTURE_CUBE_MAP, len(texture["levels"]), internal_format, texture["size"], texture["size"])
+
+        # The faces go straight from the mapped file to the texture, nothing is decoded
+        for level, level_info in enumerate(texture["levels"]):
+            size = level_info["size"]
+            for face, face_data in enumerate(cubemapBaker.level_faces(data, level_info)):
+                target = GL_TEXTURE_CUBE_MAP_POSITIVE_X + face
+                if pixel_format is None:
+                    glCompressedTexSubImage2D(target, level, 0, 0, size, size, internal_format, face_data.nbytes, face_data)
+                else:
+                    glTexSubImage2D(target, level, 0, 0, size, size, pixel_format, GL_UNSIGNED_BYTE, face_data)
+
+        glTexParameteri(GL_TEXTURE_CUBE_MAP, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+        glTexParameteri(GL_TEXTURE_CUBE_MAP, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+        glTexParameteri(GL_TEXTURE_CUBE_MAP, GL_TEXTURE_WRAP_R, GL_CLAMP_TO_EDGE)
+        glTexParameteri(GL_TEXTURE_CUBE_MAP, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR)
+        glTexParameteri(GL_TEXTURE_CUBE_MAP, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        texture_ids.append(texture_id)
+
+    glBindTexture(GL_TEXTURE_CUBE_MAP, 0)
+    glPixelStorei(GL_UNPACK_ALIGNMENT, 4)
+
+    return texture_ids[0], texture_ids[1]
+
 # Does all the vao/vbo related stuff in a function
 # Can use this to bind all the buffers for any object drawn in the scene
 # Call this one time for each object i.e. a single sphere
@@ -45,21 +116,653 @@ def build_buffers(object):
     glBindVertexArray(vao)
     vbo = glGenBuffers(1)
     glBindBuffer(GL_ARRAY_BUFFER, vbo)
+    # vertices may be a read-only memmap of the mesh cache, it is passed as is so the upload reads the mapped file directly
     glBufferData(GL_ARRAY_BUFFER, object.vertices.nbytes, object.vertices, GL_STATIC_DRAW)
 
     position_loc = 0
     tex_loc = 1
     normal_loc = 2
 
-    glVertexAttribPointer(position_loc, object.size_position, GL_FLOAT, GL_FALSE, object.stride, ctypes.c_void_p(object.offset_position))
-    glVertexAttribPointer(tex_loc, object.size_position, GL_FLOAT, GL_FALSE, object.stride, ctypes.c_void_p(object.offset_texture))
-    glVertexAttribPointer(normal_loc, object.size_position, GL_FLOAT, GL_FALSE, object.stride, ctypes.c_void_p(object.offset_normal))
+    # Meshes without texture coordinates or normals (size 0) leave those attributes disabled,
+    # the shader then reads their constant default value instead of reading past the vertex
+    attributes = ((position_loc, object.size_position, object.offset_position),
+                  (tex_loc, object.size_texture, object.offset_texture),
+                  (normal_loc, object.size_normal, object.offset_normal))
+    for location, size, offset in attributes:
+        if size > 0:
+            glVertexAttribPointer(location, size, GL_FLOAT, GL_FALSE, object.stride, ctypes.c_void_p(offset))
+            glEnableVertexAttribArray(location)
+
+    # Indexed meshes also get an element buffer, which stays bound to the vao
+    ebo = None
+    if object.indices is not None:
+        ebo = glGenBuffers(1)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, ebo)
+        glBufferData(GL_ELEMENT_ARRAY_BUFFER, object.indices.nbytes, object.indices, GL_STATIC_DRAW)
+
+    glBindVertexArray(0)
+
+    return vao, vbo, ebo, object.n_vertices
+
+# Draws an object set up with build_buffers, with glDrawElements if it is indexed
+def draw_buffers(vao, object):
+    glBindVertexArray(vao)
+    if object.indices is not None:
+        index_type = GL_UNSIGNED_SHORT if object.indices.dtype == np.uint16 else GL_UNSIGNED_INT
+        glDrawElements(GL_TRIANGLES, object.n_indices, index_type, ctypes.c_void_p(0))
+    else:
+        glDrawArrays(GL_TRIANGLES, 0, object.n_vertices)
+
+# First attribute location of the per-instance model matrix, which takes 4 locations (one per column)
+INSTANCE_MATRIX_LOC = 3
+
+# Planes (a, b, c, d) of the view frustum, inside where a x + b y + c z + d >= 0, as a (6, 4) array.
+# view_projection is a pyrr matrix (row vectors: clip = [x, y, z, 1] @ view_projection)
+def frustum_planes(view_projection):
+    m = np.asarray(view_projection, dtype=np.float32)
+    planes = np.stack([m[:, 3] + m[:, 0], m[:, 3] - m[:, 0],      # left, right
+                       m[:, 3] + m[:, 1], m[:, 3] - m[:, 1],      # bottom, top
+                       m[:, 3] + m[:, 2], m[:, 3] - m[:, 2]])     # near, far
+    return planes / np.linalg.norm(planes[:, :3], axis=1, keepdims=True)
+
+# Mask of the boxes (box_min, box_max in object space) moved by transforms (n, 4, 4) that are at least partly
+# inside the frustum planes, all the instances tested at once.
+# Conservative: a box near a corner of the frustum can be kept although it is outside
+def cull_boxes(planes, box_min, box_max, transforms):
+    center = (np.asarray(box_min, dtype=np.float32) + np.asarray(box_max, dtype=np.float32)) / 2
+    half_size = (np.asarray(box_max, dtype=np.float32) - np.asarray(box_min, dtype=np.float32)) / 2
+    rotations = transforms[:, :3, :3]
+    # world space bounding box of each transformed box
+    centers = center @ rotations + transforms[:, 3, :3]
+    half_sizes = half_size @ np.abs(rotations)
+    distances = centers @ planes[:, :3].T + planes[:, 3]
+    radii = half_sizes @ np.abs(planes[:, :3]).T
+    return np.all(distances + radii >= 0, axis=1)
+
+class InstancedMesh:
+    def __init__(self, object):
+        '''
+        Many copies of one mesh, drawn with a single instanced draw call.
+        draw() culls self.transforms against the view frustum and draws the visible instances, whose model
+        matrices the vertex shader reads at INSTANCE_MATRIX_LOC (see shaders/instanced/vert.glsl).
+        :param object: mesh loaded with ObjLoader
+        '''
+        self.object = object
+        self.vao, self.vbo, self.ebo, self.n_vertices = build_buffers(object)
+        self.transforms = np.zeros((0, 4, 4), dtype=np.float32)
+        self.n_visible = 0
+
+        # mat4 attribute: 4 vec4 columns, advanced once per instance
+        self.instance_vbo = glGenBuffers(1)
+        glBindVertexArray(self.vao)
+        glBindBuffer(GL_ARRAY_BUFFER, self.instance_vbo)
+        for column in range(4):
+            glVertexAttribPointer(INSTANCE_MATRIX_LOC + column, 4, GL_FLOAT, GL_FALSE, 64, ctypes.c_void_p(16 * column))
+            glEnableVertexAttribArray(INSTANCE_MATRIX_LOC + column)
+            glVertexAttribDivisor(INSTANCE_MATRIX_LOC + column, 1)
+        glBindVertexArray(0)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    def add(self, transforms):
+        '''
+        Add instances in bulk
+        :param transforms: (n, 4, 4) or (4, 4) model matrices
+        :return: indices of the new instances in self.transforms
+        '''
+        transforms = np.asarray(transforms, dtype=np.float32).reshape(-1, 4, 4)
+        first = len(self.transforms)
+        self.transforms = np.concatenate([self.transforms, transforms])
+        return np.arange(first, len(self.transforms))
+
+    def remove(self, indices):
+        self.transforms = np.delete(self.transforms, indices, axis=0)
+
+    def visible(self, view_projection):
+        '''
+        :return: indices of the instances inside the view frustum
+        '''
+        if len(self.transforms) == 0:
+            return np.zeros(0, dtype=np.intp)
+        mask = cull_boxes(frustum_planes(view_projection), self.object.min, self.object.max, self.transforms)
+        return np.flatnonzero(mask)
+
+    def draw(self, view_projection=None):
+        '''
+        Draw the instances in the view frustum, all of them if view_projection is None.
+        The program reading the instance matrices must be in use.
+        '''
+        if view_projection is None:
+            transforms = self.transforms
+        else:
+            transforms = self.transforms[self.visible(view_projection)]
+        self.n_visible = len(transforms)
+        if self.n_visible == 0:
+            return
+
+        # New storage every frame, so the GL does not wait for the draw of the previous frame to finish reading it
+        glBindBuffer(GL_ARRAY_BUFFER, self.instance_vbo)
+        glBufferData(GL_ARRAY_BUFFER, transforms.nbytes, np.ascontiguousarray(transforms), GL_STREAM_DRAW)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+        glBindVertexArray(self.vao)
+        if self.object.indices is not None:
+            index_type = GL_UNSIGNED_SHORT if self.object.indices.dtype == np.uint16 else GL_UNSIGNED_INT
+            glDrawElementsInstanced(GL_TRIANGLES, self.object.n_indices, index_type, ctypes.c_void_p(0), self.n_visible)
+        else:
+            glDrawArraysInstanced(GL_TRIANGLES, 0, self.n_vertices, self.n_visible)
+
+    def delete(self):
+        glDeleteVertexArrays(1, [self.vao])
+        buffers = [self.vbo, self.instance_vbo] + ([self.ebo] if self.ebo is not None else [])
+        glDeleteBuffers(len(buffers), buffers)
+
+# Binding points of the scene buffers declared in shaders/common/raytracing.glsl
+MATERIAL_BINDING = 1
+SPHERE_BINDING = 2
+PLANE_BINDING = 3
+
+# Creates the shader storage buffers of a sceneData.Scene and binds them to their binding points
+# Call this one time, then update_scene_buffers whenever the scene changes
+def build_scene_buffers(scene):
+    ssbos = glGenBuffers(3)
+    update_scene_buffers(ssbos, scene)
+
+    for binding, ssbo in zip((MATERIAL_BINDING, SPHERE_BINDING, PLANE_BINDING), ssbos):
+        glBindBufferBase(GL_SHADER_STORAGE_BUFFER, binding, ssbo)
+
+    return ssbos
+
+# Uploads the scene to its buffers, only if it changed since the last upload
+def update_scene_buffers(ssbos, scene):
+    if not scene.dirty:
+        return
+
+    for ssbo, data in zip(ssbos, scene.buffers()):
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, ssbo)
+        glBufferData(GL_SHADER_STORAGE_BUFFER, data.nbytes, data, GL_DYNAMIC_DRAW)
+    glBindBuffer(GL_SHADER_STORAGE_BUFFER, 0)
+
+    scene.dirty = False
+
+# Uniform buffer binding point of the per-frame state, the same in every shader
+FRAME_BINDING = 0
+
+# std140 layout of the Frame uniform block declared in shaders/common/frame.glsl, included by every shader reading it.
+# vec3 members are aligned to 16 bytes, so the floats are packed in their padding.
+#
+#     layout (std140, binding = 0) uniform Frame {
+#         mat4 inViewProjectionMatrix;                  0
+#         vec4 light_pos;                               64
+#         vec3 eye_pos;      float fov;                 80, 92
+#         vec3 cameraU;      float ambient_intensity;   96, 108
+#         vec3 cameraV;                                 112
+#         vec3 cameraW;                                 128
+#         vec3 lightColor;                              144
+#         vec2 resolution;                              160
+#     };                                                176 bytes
+FRAME_DTYPE = np.dtype({"names": ["inViewProjectionMatrix", "light_pos", "eye_pos", "fov", "cameraU",
+                                  "ambient_intensity", "cameraV", "cameraW", "lightColor", "resolution"],
+                        "formats": [("<f4", (4, 4)), ("<f4", 4), ("<f4", 3), "<f4", ("<f4", 3),
+                                    "<f4", ("<f4", 3), ("<f4", 3), ("<f4", 3), ("<f4", 2)],
+                        "offsets": [0, 64, 80, 92, 96, 108, 112, 128, 144, 160],
+                        "itemsize": 176})
+
+class FrameUniforms:
+    def __init__(self, binding=FRAME_BINDING):
+        '''
+        Uniform buffer holding the camera and light state shared by all the programs.
+        Set the fields of FRAME_DTYPE during the frame, then call update() once:
+            frame["eye_pos"] = eye
+            frame.update()
+
+        Matrices are stored like glUniformMatrix4fv(..., GL_FALSE, matrix) would upload them.
+        '''
+        self.data = np.zeros(1, dtype=FRAME_DTYPE)
+        self.last = None
+        self.ubo = glGenBuffers(1)
+
+        glBindBuffer(GL_UNIFORM_BUFFER, self.ubo)
+        glBufferData(GL_UNIFORM_BUFFER, self.data.nbytes, None, GL_DYNAMIC_DRAW)
+        glBindBuffer(GL_UNIFORM_BUFFER, 0)
+        glBindBufferBase(GL_UNIFORM_BUFFER, binding, self.ubo)
+
+    def __getitem__(self, key):
+        return self.data[key][0]
+
+    def __setitem__(self, key, value):
+        self.data[key][0] = value
+
+    def update(self):
+        # One upload for the whole frame, skipped when nothing changed since the last one
+        data_bytes = self.data.tobytes()
+        if data_bytes == self.last:
+            return
+        self.last = data_bytes
+
+        glBindBuffer(GL_UNIFORM_BUFFER, self.ubo)
+        glBufferSubData(GL_UNIFORM_BUFFER, 0, self.data.nbytes, self.data)
+        glBindBuffer(GL_UNIFORM_BUFFER, 0)
+
+    def delete(self):
+        glDeleteBuffers(1, [self.ubo])
+
+# Framebuffer with n_textures float color attachments of width x height, all drawn to
+# Returns the framebuffer and its textures
+def create_float_targets(width, height, n_textures):
+    fbo = glGenFramebuffers(1)
+    textures = [glGenTextures(1) for _ in range(n_textures)]
+    glBindFramebuffer(GL_FRAMEBUFFER, fbo)
+    for attachment, texture in enumerate(textures):
+        glBindTexture(GL_TEXTURE_2D, texture)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA32F, width, height, 0, GL_RGBA, GL_FLOAT, None)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+        glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0 + attachment, GL_TEXTURE_2D, texture, 0)
+    glDrawBuffers(n_textures, [GL_COLOR_ATTACHMENT0 + i for i in range(n_textures)])
+    glBindTexture(GL_TEXTURE_2D, 0)
+    glBindFramebuffer(GL_FRAMEBUFFER, 0)
+    return fbo, textures
+
+class AccumulationBuffers:
+    def __init__(self, width, height):
+        '''
+        Two float framebuffers used in turn (ping-pong) to accumulate samples:
+        each frame renders into one while reading the running mean of the previous frames from the other.
+        '''
+        self.width = width
+        self.height = height
+        targets = [create_float_targets(width, height, 1) for _ in range(2)]
+        self.fbos = [fbo for fbo, _ in targets]
+        self.textures = [texture for _, (texture,) in targets]
+        self.current = 0        # buffer holding the latest running mean
+        self.n_samples = 0
+
+    def reset(self):
+        self.n_samples = 0
+
+    def begin(self, texture_unit):
+        # Render into the other buffer, with the current running mean bound to texture_unit
+        glActiveTexture(GL_TEXTURE0 + texture_unit)
+        glBindTexture(GL_TEXTURE_2D, self.textures[self.current])
+        glBindFramebuffer(GL_FRAMEBUFFER, self.fbos[1 - self.current])
+        glViewport(0, 0, self.width, self.height)
+
+    def end(self):
+        self.current = 1 - self.current
+        self.n_samples += 1
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+
+    def present(self, width, height):
+        # Copy the running mean to the window
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, self.fbos[self.current])
+        glBindFramebuffer(GL_DRAW_FRAMEBUFFER, 0)
+        glBlitFramebuffer(0, 0, self.width, self.height, 0, 0, width, height, GL_COLOR_BUFFER_BIT, GL_NEAREST)
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, 0)
 
-    glEnableVertexAttribArray(position_loc)
-    glEnableVertexAttribArray(tex_loc)
-    glEnableVertexAttribArray(normal_loc)
+    def delete(self):
+        glDeleteFramebuffers(2, self.fbos)
+        glDeleteTextures(self.textures)
 
-    return vao, vbo, object.n_vertices
+class GBuffer:
+    def __init__(self, width, height):
+        '''
+        First hit of the camera ray of every pixel, written by shaders/gbuffer/frag.glsl:
+            texture 0: hit point and hit type (0 escaped, 1 sphere, 2 ground)
+            texture 1: normal and material index
+
+        The hits only depend on the camera and the scene, not on the light: while they do not change,
+        the sphere shader (use_gbuffer) shades the cached hits instead of tracing the camera rays again.
+        Set valid = False to render the hits again on the next begin().
+        '''
+        self.width = width
+        self.height = height
+        self.fbo, self.textures = create_float_targets(width, height, 2)
+        self.valid = False
+
+    def begin(self):
+        # Render the hits into the textures, with the gbuffer program in use
+        glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+        glViewport(0, 0, self.width, self.height)
+
+    def end(self):
+        self.valid = True
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+
+    def bind(self, texture_unit):
+        # Bind the hit textures to texture_unit and texture_unit + 1 for the shading pass
+        for i, texture in enumerate(self.textures):
+            glActiveTexture(GL_TEXTURE0 + texture_unit + i)
+            glBindTexture(GL_TEXTURE_2D, texture)
+
+    def delete(self):
+        glDeleteFramebuffers(1, [self.fbo])
+        glDeleteTextures(self.textures)
+
+# Texture units read by the denoise passes, after the G-buffer textures bound to 3 and 4
+DENOISE_INPUT_UNIT = 5
+DENOISE_HISTORY_UNIT = 6        # history color, the history positions are on the next unit
+
+class Denoiser:
+    def __init__(self, width, height, temporal_program, atrous_program, n_iterations=denoiser.N_ITERATIONS):
+        '''
+        Denoise stage for frames of 1 jittered sample per pixel: a temporal pass blending the frame with the
+        reprojected history, then the edge-aware a-trous filter guided by the G-buffer bound to units 3 and 4.
+        denoiser.py is the NumPy version of the same passes, with the same default settings.
+        :param temporal_program:    ShaderProgram of shaders/denoise/temporal.glsl
+        :param atrous_program:      ShaderProgram of shaders/denoise/atrous.glsl
+        :param n_iterations:        a-trous iterations (step sizes 1, 2, 4, ...), 0 shows the temporal result
+        '''
+        self.width = width
+        self.height = height
+        self.temporal_program = temporal_program
+        self.atrous_program = atrous_program
+        self.n_iterations = n_iterations
+        self.previous_view_projection = None
+
+        self.frame_fbo, (self.frame_texture,) = create_float_targets(width, height, 1)
+        # history color and positions, ping-pong between the previous and the current frame
+        self.history = [create_float_targets(width, height, 2) for _ in range(2)]
+        self.current_history = 0
+        # ping-pong of the filter iterations
+        self.filtered = [create_float_targets(width, height, 1) for _ in range(2)]
+        self.output = 0
+
+        temporal_program["current_color"] = DENOISE_INPUT_UNIT
+        temporal_program["history_color"] = DENOISE_HISTORY_UNIT
+        temporal_program["history_position"] = DENOISE_HISTORY_UNIT + 1
+        temporal_program["gbuffer_position"] = 3
+        temporal_program["max_history"] = denoiser.MAX_HISTORY
+        temporal_program["position_tolerance"] = denoiser.POSITION_TOLERANCE
+        atrous_program["color_input"] = DENOISE_INPUT_UNIT
+        atrous_program["gbuffer_position"] = 3
+        atrous_program["gbuffer_normal"] = 4
+        atrous_program["sigma_color"] = denoiser.SIGMA_COLOR
+        atrous_program["sigma_normal"] = denoiser.SIGMA_NORMAL
+        atrous_program["sigma_depth"] = denoiser.SIGMA_DEPTH
+        atrous_program["sigma_albedo"] = denoiser.SIGMA_ALBEDO
+
+    def reset(self):
+        # Drop the history, e.g. after the shaders changed
+        self.previous_view_projection = None
+
+    def begin(self):
+        # Render the noisy frame into the input of the denoiser
+        glBindFramebuffer(GL_FRAMEBUFFER, self.frame_fbo)
+        glViewport(0, 0, self.width, self.height)
+
+    def end(self):
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+
+    def apply(self, vao, object, view_projection):
+        '''
+        Denoise the frame rendered between begin() and end(), drawing the full screen quad of vao and object.
+        :param view_projection: pyrr view @ projection matrix of the frame, used to reproject the next frame
+        '''
+        glViewport(0, 0, self.width, self.height)
+
+        # Temporal pass: new history from the frame and the previous history
+        previous, current = self.current_history, 1 - self.current_history
+        glActiveTexture(GL_TEXTURE0 + DENOISE_INPUT_UNIT)
+        glBindTexture(GL_TEXTURE_2D, self.frame_texture)
+        for i, texture in enumerate(self.history[previous][1]):
+            glActiveTexture(GL_TEXTURE0 + DENOISE_HISTORY_UNIT + i)
+            glBindTexture(GL_TEXTURE_2D, texture)
+        self.temporal_program["history_valid"] = self.previous_view_projection is not None
+        if self.previous_view_projection is not None:
+            self.temporal_program["previous_view_projection"] = self.previous_view_projection
+        glUseProgram(self.temporal_program.shader)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.history[current][0])
+        draw_buffers(vao, object)
+        self.current_history = current
+        self.previous_view_projection = np.asarray(view_projection, dtype=np.float32)
+
+        # Spatial passes: a-trous iterations with step sizes 1, 2, 4, ...
+        source = self.history[current][1][0]
+        glUseProgram(self.atrous_program.shader)
+        for iteration in range(self.n_iterations):
+            self.output = iteration % 2
+            self.atrous_program["step_size"] = 2 ** iteration
+            glActiveTexture(GL_TEXTURE0 + DENOISE_INPUT_UNIT)
+            glBindTexture(GL_TEXTURE_2D, source)
+            glBindFramebuffer(GL_FRAMEBUFFER, self.filtered[self.output][0])
+            draw_buffers(vao, object)
+            source = self.filtered[self.output][1][0]
+
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        glActiveTexture(GL_TEXTURE0)
+
+    def present(self, width, height):
+        # Copy the denoised frame to the window, the temporal result if the filter is off (n_iterations = 0).
+        # The history color is the first attachment of its framebuffer, the one read by the blit
+        if self.n_iterations > 0:
+            fbo = self.filtered[self.output][0]
+        else:
+            fbo = self.history[self.current_history][0]
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, fbo)
+        glBindFramebuffer(GL_DRAW_FRAMEBUFFER, 0)
+        glBlitFramebuffer(0, 0, self.width, self.height, 0, 0, width, height, GL_COLOR_BUFFER_BIT, GL_NEAREST)
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, 0)
+
+    def delete(self):
+        targets = [(self.frame_fbo, [self.frame_texture])] + self.history + self.filtered
+        glDeleteFramebuffers(len(targets), [fbo for fbo, _ in targets])
+        glDeleteTextures([texture for _, textures in targets for texture in textures])
+
+class ScaledRenderTarget:
+    def __init__(self, width, height):
+        '''
+        Framebuffer to render at a fraction of the window resolution.
+        It is allocated at full size once, only its lower left scale * (width, height) corner is rendered
+        and then stretched to the window with bilinear filtering, so the scale can change every frame.
+        '''
+        self.width = width
+        self.height = height
+        self.scale = 1.0
+
+        self.texture = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_2D, self.texture)
+        glTexStorage2D(GL_TEXTURE_2D, 1, GL_RGBA8, width, height)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        glBindTexture(GL_TEXTURE_2D, 0)
+
+        self.fbo = glGenFramebuffers(1)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+        glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, self.texture, 0)
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+
+    def size(self):
+        return max(int(self.width * self.scale), 1), max(int(self.height * self.scale), 1)
+
+    def begin(self):
+        glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+        glViewport(0, 0, *self.size())
+
+    def end(self):
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        glViewport(0, 0, self.width, self.height)
+
+    def present(self, width, height):
+        # Upsample the rendered corner to the window
+        render_width, render_height = self.size()
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, self.fbo)
+        glBindFramebuffer(GL_DRAW_FRAMEBUFFER, 0)
+        glBlitFramebuffer(0, 0, render_width, render_height, 0, 0, width, height, GL_COLOR_BUFFER_BIT, GL_LINEAR)
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, 0)
+
+    def delete(self):
+        glDeleteFramebuffers(1, [self.fbo])
+        glDeleteTextures([self.texture])
+
+class ResolutionScaler:
+    def __init__(self, target_frame_time=1 / 30, min_scale=0.25, max_scale=1.0, step=0.05, smoothing=0.1):
+        '''
+        Controller of the render scale holding the frame time near target_frame_time (seconds).
+        The cost of the raytracing is proportional to the number of pixels, so the scale is corrected by
+        sqrt(target / frame time), measured on a running average. It only changes by multiples of step,
+        which keeps it from flickering between close values.
+        '''
+        self.target_frame_time = target_frame_time
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self.step = step
+        self.smoothing = smoothing
+        self.scale = max_scale
+        self.average = None
+
+    def update(self, frame_time):
+        if frame_time <= 0:
+            return self.scale
+        if self.average is None:
+            self.average = frame_time
+        self.average += self.smoothing * (frame_time - self.average)
+
+        wanted = self.scale * np.sqrt(self.target_frame_time / self.average)
+        wanted = np.clip(np.round(wanted / self.step) * self.step, self.min_scale, self.max_scale)
+        if wanted != self.scale:
+            # Expected frame time at the new scale, until it is measured
+            self.average *= (wanted / self.scale) ** 2
+            self.scale = float(wanted)
+
+        return self.scale
+
+class ComputeImage:
+    def __init__(self, width, height):
+        '''
+        Float image written by the compute raytracer (image_output in shaders/ComputeShader/Raytracer.glsl).
+        The progressive samples are averaged in the image itself, n_samples counts them like AccumulationBuffers.
+        '''
+        self.width = width
+        self.height = height
+        self.n_samples = 0
+
+        self.texture = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_2D, self.texture)
+        glTexStorage2D(GL_TEXTURE_2D, 1, GL_RGBA32F, width, height)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+        glBindTexture(GL_TEXTURE_2D, 0)
+
+        # Only used to blit the image to the window
+        self.fbo = glGenFramebuffers(1)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+        glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, self.texture, 0)
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+
+    def reset(self):
+        self.n_samples = 0
+
+    def begin(self, image_unit=0):
+        glBindImageTexture(image_unit, self.texture, 0, GL_FALSE, 0, GL_READ_WRITE, GL_RGBA32F)
+
+    def end(self):
+        self.n_samples += 1
+
+    def present(self, width, height):
+        # Copy the image to the window
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, self.fbo)
+        glBindFramebuffer(GL_DRAW_FRAMEBUFFER, 0)
+        glBlitFramebuffer(0, 0, self.width, self.height, 0, 0, width, height, GL_COLOR_BUFFER_BIT, GL_NEAREST)
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, 0)
+
+    def delete(self):
+        glDeleteFramebuffers(1, [self.fbo])
+        glDeleteTextures([self.texture])
+
+class PixelReadback:
+    def __init__(self, width, height, n_buffers=3):
+        '''
+        Ring of pixel pack buffers to read rendered frames back without stalling on glReadPixels.
+        read() only queues the copy of a framebuffer into the next free buffer, the GPU does it in the background.
+        collect() maps the buffers whose copy is finished (checked with a fence) and returns their pixels,
+        so a frame is usually collected while the following ones are being rendered.
+        :param n_buffers:   number of frames that can be in flight, read() waits for the oldest one when all are used
+        '''
+        self.width = width
+        self.height = height
+        self.size = width * height * 4
+        self.pbos = list(glGenBuffers(n_buffers)) if n_buffers > 1 else [glGenBuffers(1)]
+        self.free = list(self.pbos)
+        self.pending = collections.deque()     # (pbo, fence, tag) in the order they were read
+        self.ready = []                         # (tag, pixels) collected while waiting for a free buffer
+
+        for pbo in self.pbos:
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+            glBufferData(GL_PIXEL_PACK_BUFFER, self.size, None, GL_STREAM_READ)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+
+    def read(self, fbo, tag):
+        # Queue the copy of the color attachment of fbo, tag is returned with the pixels by collect
+        if not self.free:
+            self.ready.append(self.finish(*self.pending.popleft()))
+        pbo = self.free.pop()
+
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, fbo)
+        glReadBuffer(GL_COLOR_ATTACHMENT0)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        glReadPixels(0, 0, self.width, self.height, GL_RGBA, GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+        fence = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, 0)
+
+        self.pending.append((pbo, fence, tag))
+
+    def collect(self, wait=False):
+        '''
+        :param wait:    wait for all the queued copies instead of only taking the finished ones
+        :return:        list of (tag, pixels), pixels is a (height, width, 4) uint8 array with the bottom row first
+        '''
+        collected, self.ready = self.ready, []
+        while self.pending:
+            pbo, fence, tag = self.pending[0]
+            if not wait and glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT, 0) == GL_TIMEOUT_EXPIRED:
+                break
+            collected.append(self.finish(*self.pending.popleft()))
+        return collected
+
+    def finish(self, pbo, fence, tag):
+        # Wait for the copy into pbo and take its pixels out
+        while glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT, 1000000000) == GL_TIMEOUT_EXPIRED:
+            pass
+        glDeleteSync(fence)
+
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+        pointer = glMapBufferRange(GL_PIXEL_PACK_BUFFER, 0, self.size, GL_MAP_READ_BIT)
+        mapped = ctypes.cast(pointer, ctypes.POINTER(ctypes.c_ubyte * self.size)).contents
+        pixels = np.frombuffer(mapped, dtype=np.uint8).reshape(self.height, self.width, 4).copy()
+        glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+
+        self.free.append(pbo)
+        return tag, pixels
+
+    def delete(self):
+        for _, fence, _ in self.pending:
+            glDeleteSync(fence)
+        glDeleteBuffers(len(self.pbos), self.pbos)
 
 class GraphicsLibrary:
-    None
\ No newline at end of file
+    None
+
+
+if __name__ == '__main__':
+    '''
+    Usage of the draw helpers, from a render loop with a GL context (see main.py).
+
+    Many copies of one mesh, culled and drawn with one instanced draw call:
+
+        rocks = graphicsLibrary.InstancedMesh(ObjLoader("objects/rock.obj"))
+        rocks.add(model_matrices)                 # (n, 4, 4) pyrr matrices, editable in rocks.transforms
+        ...
+        rocks.draw(view_mat @ projection_mat)     # culls, streams the visible matrices and draws them
+
+    Denoise stage, with the G-buffer bound to texture units 3 and 4 and the sphere program set to
+    progressive and single_sample:
+
+        denoise_stage.begin()
+        graphicsLibrary.draw_buffers(vao_obj, obj)
+        denoise_stage.end()
+        denoise_stage.apply(vao_obj, obj, view_mat @ projection_mat)
+        denoise_stage.present(width, height)
+    '''
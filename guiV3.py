@@ -1,24 +1,40 @@
+import time
 import tkinter as tk
 import tkinter.colorchooser as tkcolorchooser
 
-class Slider:
-    def __init__(self, root, label_text, min_value, max_value, initial_value, resolution=0.01):
+class Control:
+    # Base of the widgets: the current value is cached in self.value by the Tk callbacks,
+    # so reading it does not touch Tk. Tk itself only runs when SimpleGUI.update() is called
+    def __init__(self, root, value):
         self.root = root
-        self.label = tk.Label(self.root, text=label_text)
+        self.value = value
+        self.callbacks = []
+
+    def get_value(self):
+        return self.value
+
+    def on_change(self, callback):
+        # callback(value) is called every time the value is changed from the GUI
+        self.callbacks.append(callback)
+
+    def set_cached(self, value):
+        self.value = value
+        for callback in self.callbacks:
+            callback(value)
+
+class Slider(Control):
+    def __init__(self, root, label_text, min_value, max_value, initial_value, resolution=0.01):
+        super().__init__(root, initial_value)
+        self.label = tk.Label(root, text=label_text)
         self.label.pack(padx=10, pady=5, anchor="w")
         # Create a Tkinter Scale widget (slider)
-        self.slider = tk.Scale(self.root, from_=min_value, to=max_value, orient="horizontal", resolution=resolution)
+        self.slider = tk.Scale(root, from_=min_value, to=max_value, orient="horizontal", resolution=resolution,
+                               command=lambda _: self.set_cached(self.slider.get()))
         self.slider.set(initial_value)  # Set the initial scale value
         self.slider.pack()
+        self.value = self.slider.get()     # rounded to the resolution
 
-    def get_value(self):
-        # Get the slider value
-        value = self.slider.get()
-        self.root.update_idletasks()
-        self.root.update()
-        return value
-
-class ColorPicker:
+class ColorPicker(Control):
     def __init__(self, root, label_text, initial_color=(0,0,0)):
         '''
 
@@ -26,7 +42,7 @@ class ColorPicker:
         :param label_text:
         :param initial_color: tuple of 3 floats RGB between 0 and 1
         '''
-        self.root = root
+        super().__init__(root, initial_color)
         self.label = tk.Label(self.root, text=label_text)
         self.label.pack(padx=10, pady=5, anchor="w")
         self.color_norm = initial_color
@@ -44,11 +60,10 @@ class ColorPicker:
             self.color_norm = tuple([i/255 for i in color_rgb])
 
             self.color_button.config(background=color_hex)  # Update button color
-        self.root.update_idletasks()
-        self.root.update()
+            self.set_cached(self.color_norm)
 
     def get_color(self):
-        return self.color_norm
+        return self.value
 
     def rgb_to_hex(self, rgb):
         """translates an rgb tuple of int to a tkinter friendly color code
@@ -56,48 +71,61 @@ class ColorPicker:
         return "#%02x%02x%02x" % rgb
 
 
-class RadioButton:
+class RadioButton(Control):
     def __init__(self, root, label_text, options_dict, initial_option=None):
-        self.root = root
-        self.label = tk.Label(self.root, text=label_text)
+        self.label = tk.Label(root, text=label_text)
         self.label.pack(padx=10, pady=5, anchor="w")
         if initial_option is None:
             initial_option = list(options_dict.keys())[0]
 
         initial_value = options_dict[initial_option]
         self.option_var = tk.StringVar(value=initial_value)
+        super().__init__(root, self.option_var.get())
+        self.option_var.trace_add("write", lambda *_: self.set_cached(self.option_var.get()))
 
         for key, value in options_dict.items():
-            self.button = tk.Radiobutton(self.root, text=key, variable=self.option_var, value=value)
+            self.button = tk.Radiobutton(root, text=key, variable=self.option_var, value=value)
             self.button.pack()
 
 
-    def get_value(self):
-        # get the value of the selected radio button using var.get()
-        value = self.option_var.get()
-        self.root.update_idletasks()
-        self.root.update()
-        return value
-
-
-class CheckBox:
+class CheckBox(Control):
     def __init__(self, root, label_text, initial_state=False):
-        self.root = root
         self.var = tk.BooleanVar(value=initial_state)
-        self.checkbox = tk.Checkbutton(self.root, text=label_text, variable=self.var)
+        super().__init__(root, self.var.get())
+        self.var.trace_add("write", lambda *_: self.set_cached(self.var.get()))
+        self.checkbox = tk.Checkbutton(root, text=label_text, variable=self.var)
         self.checkbox.pack(padx=10, pady=5, anchor="w")
 
-    def get_value(self):
-        self.root.update_idletasks()
-        self.root.update()
-        return self.var.get()
-
 
 class SimpleGUI:
-    def __init__(self, title):
+    def __init__(self, title, min_interval=1 / 60):
+        '''
+        Control panel in its own Tk window.
+        Tk does not run by itself: call update() once per frame to process its events, the values
+        of the controls are then read from their value attribute (or get_value()) without calling Tk.
+
+        :param min_interval: minimum time in seconds between two updates of Tk, calls to update() in between do nothing
+        '''
         # Create a Tkinter root window for the slider
         self.root = tk.Tk()
         self.root.title(title)
+        self.min_interval = min_interval
+        self.last_update = 0.0
+        self.closed = False
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
+
+    def update(self):
+        now = time.perf_counter()
+        if self.closed or now - self.last_update < self.min_interval:
+            return
+        self.last_update = now
+        self.root.update_idletasks()
+        self.root.update()
+
+    def close(self):
+        # The controls keep their last values
+        self.closed = True
+        self.root.destroy()
 
     def add_slider(self, label_text, min_value, max_value, initial_value, resolution=0.01):
         slider = Slider(self.root, label_text, min_value, max_value, initial_value, resolution)
@@ -135,10 +163,14 @@ if __name__ == '__main__':
 
     checkbox = gui.add_checkbox("Enable Feature", initial_state=True)
 
-    # warning: this is an infinite loop. You need to close the window to stop the program. Ignore the error at the end.
-    while True:
-        print("Slider value: ", slider.get_value())
-        print("Color value: ", color_picker.get_color())
-        print("Radio button value: ", radio_button.get_value())
-        print("Checkbox value: ", checkbox.get_value())
+    slider.on_change(lambda value: print("Slider changed: ", value))
+
+    # Close the window to stop the program
+    while not gui.closed:
+        gui.update()
+        print("Slider value: ", slider.value)
+        print("Color value: ", color_picker.value)
+        print("Radio button value: ", radio_button.value)
+        print("Checkbox value: ", checkbox.value)
+        time.sleep(1 / 60)
 
@@ -0,0 +1,257 @@
+import ctypes
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Settings of a batch render, a json config file given on the command line overrides any of them
+DEFAULT_CONFIG = {
+    "platform": "egl",                  # "egl" or "osmesa", both work with the llvmpipe software renderer
+    "width": 1920,
+    "height": 1080,
+    "samples": 16,                      # progressive samples accumulated for every frame
+    "frames": 60,
+    "fov": 90,
+    # either {"turntable": {"center": [x, y, z], "radius": r, "height": h}}
+    # or {"keyframes": [{"eye": [x, y, z], "target": [x, y, z]}, ...]}, interpolated over the frames
+    "camera": {"turntable": {"center": [1.5, -0.75, 1.5], "radius": 4.0, "height": 1.5}},
+    "up": [0.0, 1.0, 0.0],
+    "light_pos": [-10.0, 10.0, -10.0, 1.0],
+    "light_color": [1.0, 1.0, 1.0],
+    "ambient_intensity": 0.1,
+    "cubemap": ['images/skybox1/right.png', 'images/skybox1/left.png',
+                'images/skybox1/top.png', 'images/skybox1/bottom.png',
+                'images/skybox1/front.png', 'images/skybox1/back.png'],
+    "output": "frames/frame_{:04d}.png",
+}
+
+
+def load_config(filename=None):
+    config = dict(DEFAULT_CONFIG)
+    if filename is not None:
+        with open(filename) as f:
+            config.update(json.load(f))
+    return config
+
+
+# Eye and target positions of every frame, as two (frames, 3) arrays
+def camera_path(camera, n_frames):
+    if "turntable" in camera:
+        turntable = camera["turntable"]
+        center = np.asarray(turntable["center"], dtype=np.float32)
+        angles = 2 * np.pi * np.arange(n_frames) / n_frames
+        offsets = np.stack([np.cos(angles), np.zeros(n_frames), np.sin(angles)], axis=1) * turntable["radius"]
+        offsets[:, 1] = turntable.get("height", 0.0)
+        eyes = center + offsets
+        targets = np.tile(center, (n_frames, 1))
+        return eyes.astype(np.float32), targets
+
+    # Linear interpolation between the keyframes, spread evenly over the frames
+    eye_keys = np.array([key["eye"] for key in camera["keyframes"]], dtype=np.float32)
+    target_keys = np.array([key["target"] for key in camera["keyframes"]], dtype=np.float32)
+    t = np.linspace(0, len(eye_keys) - 1, n_frames)
+    i = np.minimum(t.astype(int), len(eye_keys) - 2) if len(eye_keys) > 1 else np.zeros(n_frames, dtype=int)
+    f = (t - i)[:, None]
+    j = np.minimum(i + 1, len(eye_keys) - 1)
+    eyes = eye_keys[i] * (1 - f) + eye_keys[j] * f
+    targets = target_keys[i] * (1 - f) + target_keys[j] * f
+    return eyes.astype(np.float32), targets.astype(np.float32)
+
+
+# Creates an OpenGL 4.3 core context on an EGL pbuffer, without any display
+# Returns a function that destroys it
+def create_egl_context(width, height):
+    from OpenGL import EGL
+
+    display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+    major, minor = EGL.EGLint(), EGL.EGLint()
+    if not EGL.eglInitialize(display, ctypes.pointer(major), ctypes.pointer(minor)):
+        raise RuntimeError("Could not initialize EGL")
+
+    config_attributes = [EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+                         EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+                         EGL.EGL_RED_SIZE, 8, EGL.EGL_GREEN_SIZE, 8, EGL.EGL_BLUE_SIZE, 8,
+                         EGL.EGL_DEPTH_SIZE, 24,
+                         EGL.EGL_NONE]
+    config = EGL.EGLConfig()
+    n_configs = EGL.EGLint()
+    EGL.eglChooseConfig(display, (EGL.EGLint * len(config_attributes))(*config_attributes),
+                        ctypes.pointer(config), 1, ctypes.pointer(n_configs))
+    if n_configs.value == 0:
+        raise RuntimeError("No EGL config with OpenGL pbuffer support")
+
+    surface_attributes = [EGL.EGL_WIDTH, width, EGL.EGL_HEIGHT, height, EGL.EGL_NONE]
+    surface = EGL.eglCreatePbufferSurface(display, config,
+                                          (EGL.EGLint * len(surface_attributes))(*surface_attributes))
+
+    EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+    context_attributes = [EGL.EGL_CONTEXT_MAJOR_VERSION, 4,
+                          EGL.EGL_CONTEXT_MINOR_VERSION, 3,
+                          EGL.EGL_CONTEXT_OPENGL_PROFILE_MASK, EGL.EGL_CONTEXT_OPENGL_CORE_PROFILE_BIT,
+                          EGL.EGL_NONE]
+    context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT,
+                                   (EGL.EGLint * len(context_attributes))(*context_attributes))
+    if not context or not EGL.eglMakeCurrent(display, surface, surface, context):
+        raise RuntimeError("Could not create an OpenGL 4.3 EGL context")
+
+    def destroy():
+        EGL.eglMakeCurrent(display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, EGL.EGL_NO_CONTEXT)
+        EGL.eglDestroySurface(display, surface)
+        EGL.eglDestroyContext(display, context)
+        EGL.eglTerminate(display)
+
+    return destroy
+
+
+# Creates an OpenGL 4.3 core context rendered in memory by OSMesa
+# Returns a function that destroys it
+def create_osmesa_context(width, height):
+    from OpenGL import osmesa, arrays
+    from OpenGL.GL import GL_UNSIGNED_BYTE
+
+    attributes = [osmesa.OSMESA_FORMAT, osmesa.OSMESA_RGBA,
+                  osmesa.OSMESA_DEPTH_BITS, 24,
+                  osmesa.OSMESA_PROFILE, osmesa.OSMESA_CORE_PROFILE,
+                  osmesa.OSMESA_CONTEXT_MAJOR_VERSION, 4,
+                  osmesa.OSMESA_CONTEXT_MINOR_VERSION, 3,
+                  0]
+    context = osmesa.OSMesaCreateContextAttribs(attributes, None)
+    # The default framebuffer is not used, the frames are rendered into framebuffer objects
+    buffer = arrays.GLubyteArray.zeros((height, width, 4))
+    if not context or not osmesa.OSMesaMakeCurrent(context, buffer, GL_UNSIGNED_BYTE, width, height):
+        raise RuntimeError("Could not create an OpenGL 4.3 OSMesa context")
+
+    def destroy():
+        osmesa.OSMesaDestroyContext(context)
+
+    return destroy
+
+
+def save_frame(filename, pixels):
+    from utils import save_image
+
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    height, width = pixels.shape[:2]
+    # glReadPixels gives the bottom row first
+    save_image(filename, np.ascontiguousarray(pixels[::-1, :, :3]).tobytes(), width, height)
+
+
+def render_frames(config):
+    '''
+    Render the camera path of config with the raytracing shader, without opening any window,
+    and write every frame to config["output"].
+
+    Frames are accumulated in float framebuffers like the progressive mode of main.py, then read back
+    through a ring of pixel buffers so the GPU keeps rendering the next frames while the previous
+    ones are copied out, and written to disk on a separate thread.
+    '''
+    # PyOpenGL picks its platform when OpenGL.GL is first imported, so it must be set before
+    # importing the modules that use it
+    os.environ.setdefault("PYOPENGL_PLATFORM", config["platform"])
+
+    width, height = config["width"], config["height"]
+    if os.environ["PYOPENGL_PLATFORM"] == "osmesa":
+        destroy_context = create_osmesa_context(width, height)
+    else:
+        destroy_context = create_egl_context(width, height)
+
+    from OpenGL.GL import glActiveTexture, glBindTexture, glUseProgram, glDeleteVertexArrays, glDeleteBuffers, \
+        glDeleteProgram, glDeleteTextures, glFinish, GL_TEXTURE0, GL_TEXTURE2, GL_TEXTURE_CUBE_MAP
+    import pyrr
+    import graphicsLibrary
+    import sceneData
+    import shaderLoaderV3
+    from objLoaderV4 import ObjLoader
+
+    shaderProgram_sphere = shaderLoaderV3.ShaderProgram("shaders/sphere/vert.glsl", "shaders/sphere/frag.glsl")
+    frame_uniforms = graphicsLibrary.FrameUniforms()
+
+    scene = sceneData.default_scene()
+    scene_buffers = graphicsLibrary.build_scene_buffers(scene)
+
+    obj = ObjLoader("objects/square.obj", indexed=True)
+    vao_obj, vbo_obj, ebo_obj, n_vertices_obj = graphicsLibrary.build_buffers(obj)
+
+    skybox_id, prefiltered_id = graphicsLibrary.load_baked_cubemap(config["cubemap"])
+    glActiveTexture(GL_TEXTURE2)
+    glBindTexture(GL_TEXTURE_CUBE_MAP, prefiltered_id)
+    glActiveTexture(GL_TEXTURE0)
+    glBindTexture(GL_TEXTURE_CUBE_MAP, skybox_id)
+
+    accumulation = graphicsLibrary.AccumulationBuffers(width, height)
+    readback = graphicsLibrary.PixelReadback(width, height)
+
+    samples = max(int(config["samples"]), 1)
+    up = np.asarray(config["up"], dtype=np.float32)
+    eyes, targets = camera_path(config["camera"], config["frames"])
+
+    frame_uniforms["light_pos"] = config["light_pos"]
+    frame_uniforms["lightColor"] = config["light_color"]
+    frame_uniforms["ambient_intensity"] = config["ambient_intensity"]
+    frame_uniforms["fov"] = np.deg2rad(config["fov"])
+    frame_uniforms["resolution"] = [width, height]
+
+    shaderProgram_sphere["model_matrix"] = np.identity(4, dtype=np.float32)
+    shaderProgram_sphere["progressive"] = samples > 1
+    shaderProgram_sphere["accumulation"] = 1
+    shaderProgram_sphere["prefilteredTex"] = 2
+    shaderProgram_sphere["use_prefiltered"] = True
+    glUseProgram(shaderProgram_sphere.shader)
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=2) as writer:
+        for frame, (eye, target) in enumerate(zip(eyes, targets)):
+            view_mat = pyrr.matrix44.create_look_at(eye, target, up)
+            frame_uniforms["eye_pos"] = eye
+            frame_uniforms["cameraU"] = [view_mat[0][0], view_mat[1][0], view_mat[2][0]]
+            frame_uniforms["cameraV"] = [view_mat[0][1], view_mat[1][1], view_mat[2][1]]
+            frame_uniforms["cameraW"] = [view_mat[0][2], view_mat[1][2], view_mat[2][2]]
+            frame_uniforms.update()
+
+            accumulation.reset()
+            for _ in range(samples):
+                shaderProgram_sphere["sample_index"] = accumulation.n_samples
+                accumulation.begin(texture_unit=1)
+                graphicsLibrary.draw_buffers(vao_obj, obj)
+                accumulation.end()
+
+            readback.read(accumulation.fbos[accumulation.current], frame)
+            for index, pixels in readback.collect():
+                writer.submit(save_frame, config["output"].format(index), pixels)
+
+        for index, pixels in readback.collect(wait=True):
+            writer.submit(save_frame, config["output"].format(index), pixels)
+
+    glFinish()
+    print("Rendered", len(eyes), "frames of", width, "x", height, "with", samples, "samples in",
+          time.time() - start, "s")
+
+    # Cleanup
+    readback.delete()
+    accumulation.delete()
+    frame_uniforms.delete()
+    glDeleteTextures([skybox_id, prefiltered_id])
+    glDeleteVertexArrays(1, [vao_obj])
+    glDeleteBuffers(1, [vbo_obj])
+    if ebo_obj is not None:
+        glDeleteBuffers(1, [ebo_obj])
+    glDeleteBuffers(3, scene_buffers)
+    glDeleteProgram(shaderProgram_sphere.shader)
+    destroy_context()
+
+
+if __name__ == '__main__':
+    '''
+    Usage:
+        python headlessRenderer.py [config.json]
+
+    Example config, rendering 4 samples per frame along two keyframes with the software renderer:
+        {"platform": "osmesa", "width": 640, "height": 360, "samples": 4, "frames": 24,
+         "camera": {"keyframes": [{"eye": [0, 0, 3], "target": [0, 0, 0]},
+                                  {"eye": [3, 1, 3], "target": [1.5, -0.75, 1.5]}]},
+         "output": "frames/keys_{:04d}.png"}
+    '''
+    render_frames(load_config(sys.argv[1] if len(sys.argv) > 1 else None))
@@ -3,14 +3,18 @@ import pygame as pg
 import pygame.mouse
 from OpenGL.GL import *
 import numpy as np
+import os
 import time
 import graphicsLibrary
 
 from guiV3 import SimpleGUI
 from objLoaderV4 import ObjLoader
 import shaderLoaderV3
+import sceneData
+from sceneGraph import SceneGraph
+from frameProfiler import FrameProfiler
 import pyrr
-from utils import load_image
+from utils import load_image, ChangeTracker
 
 # Handles keyboard inputs
 # Increments or decrements camera rotation inputs
@@ -80,7 +84,7 @@ def input_handler():
 pg.init()
 
 # Set up OpenGL context version
-pg.display.gl_set_attribute(pg.GL_CONTEXT_MAJOR_VERSION, 3)
+pg.display.gl_set_attribute(pg.GL_CONTEXT_MAJOR_VERSION, 4)
 pg.display.gl_set_attribute(pg.GL_CONTEXT_MINOR_VERSION, 3)
 pg.display.gl_set_attribute(pg.GL_STENCIL_SIZE, 8)
 
@@ -102,6 +106,16 @@ glEnable(GL_DEPTH_TEST)
 shaderProgram = shaderLoaderV3.ShaderProgram("shaders/obj/vert.glsl", "shaders/obj/frag.glsl")
 shaderProgram_skybox = shaderLoaderV3.ShaderProgram("shaders/skybox/vert.glsl", "shaders/skybox/frag.glsl")
 shaderProgram_sphere = shaderLoaderV3.ShaderProgram("shaders/sphere/vert.glsl", "shaders/sphere/frag.glsl")
+# Writes the first hits of the camera rays, reused by the sphere program while the camera and scene stay still
+shaderProgram_gbuffer = shaderLoaderV3.ShaderProgram("shaders/sphere/vert.glsl", "shaders/gbuffer/frag.glsl")
+# Temporal and spatial passes of the denoiser
+shaderProgram_temporal = shaderLoaderV3.ShaderProgram("shaders/sphere/vert.glsl", "shaders/denoise/temporal.glsl")
+shaderProgram_atrous = shaderLoaderV3.ShaderProgram("shaders/sphere/vert.glsl", "shaders/denoise/atrous.glsl")
+# Same raytracer as the sphere program, run as a compute shader writing into an image
+shaderProgram_compute = shaderLoaderV3.ComputeProgram("shaders/ComputeShader/Raytracer.glsl")
+
+# Camera and light state read by all three programs, uploaded once per frame
+frame_uniforms = graphicsLibrary.FrameUniforms()
 
 # Camera parameters
 eye = np.array([0,0,3], dtype=np.float32)
@@ -145,9 +159,18 @@ cube_map_images = ['images/skybox1/right.png', 'images/skybox1/left.png',
                    'images/skybox1/top.png', 'images/skybox1/bottom.png',
                    'images/skybox1/front.png', 'images/skybox1/back.png']
 
-skybox_id = graphicsLibrary.load_cubemap_texture(cube_map_images)
+# Skybox with its mip chain and the roughness-prefiltered version used by rough reflections,
+# baked once to images/skybox1.cubemap (see cubemapBaker.py)
+skybox_id, prefiltered_id = graphicsLibrary.load_baked_cubemap(cube_map_images)
 
 shaderProgram_skybox['cubeMapTex'] = 0
+for program in (shaderProgram_sphere, shaderProgram_compute):
+    program["prefilteredTex"] = 2
+    program["use_prefiltered"] = True
+
+# Spheres, planes and materials of the raytraced scene, uploaded once to shader storage buffers
+scene = sceneData.default_scene()
+scene_buffers = graphicsLibrary.build_scene_buffers(scene)
 
 # light and material properties
 material_color = (1.0, 0.1, 0.1)
@@ -155,12 +178,22 @@ light_pos = np.array([-10, 10, -10, None], dtype=np.float32)
 # last component is for light type (0: directional, 1: point) which is changed by radio button
 # *************************************************************************
 # Obj and attributes
-obj = ObjLoader("objects/square.obj")
-vao_obj, vbo_obj, n_vertices_obj = graphicsLibrary.build_buffers(obj)
+obj = ObjLoader("objects/square.obj", indexed=True)
+vao_obj, vbo_obj, ebo_obj, n_vertices_obj = graphicsLibrary.build_buffers(obj)
 
 # matrices
-scaling_mat = pyrr.matrix44.create_from_scale(pyrr.Vector3([0.5, 0.5, 0.5]))
-model_mat = scaling_mat
+# Transforms of the objects, world = local @ world of the parent (see sceneGraph.py)
+scene_graph = SceneGraph()
+obj_node = scene_graph.add_node(local=pyrr.matrix44.create_from_scale(pyrr.Vector3([0.5, 0.5, 0.5])))
+scene_graph.update()
+model_mat = scene_graph.world[obj_node]
+
+# min and max bounds (coordinates) of Axis Aligned Bounding Box, from the extent of the object in world space
+box_corners = np.array([[x, y, z, 1.0] for x in (obj.min[0], obj.max[0])
+                                       for y in (obj.min[1], obj.max[1])
+                                       for z in (obj.min[2], obj.max[2])], dtype=np.float32) @ model_mat
+min_bound = box_corners[:, :3].min(axis=0)
+max_bound = box_corners[:, :3].max(axis=0)
 
 
 # *************************************************************************
@@ -171,93 +204,253 @@ gui = SimpleGUI("Raytracing")
 fov_slider = gui.add_slider("fov", 25, 90, 90, resolution=1)
 light_rot_check = gui.add_checkbox("Light Movement", initial_state=True)
 ambient_intensity_slider = gui.add_slider("Ambient Intensity", 0, 1, 0.1, resolution=0.1)
+progressive_check = gui.add_checkbox("Progressive", initial_state=False)
+compute_check = gui.add_checkbox("Compute Shader", initial_state=False)
+dynamic_resolution_check = gui.add_checkbox("Dynamic Resolution", initial_state=False)
+cached_visibility_check = gui.add_checkbox("Cached Visibility", initial_state=True)
+denoise_check = gui.add_checkbox("Denoise", initial_state=False)
+target_frame_time_slider = gui.add_slider("Target Frame Time (ms)", 10, 100, 33, resolution=1)
+
+# Progressive rendering: samples are accumulated while the camera and light stay still
+accumulation = graphicsLibrary.AccumulationBuffers(width, height)
+accumulation_state = ChangeTracker()
+compute_image = graphicsLibrary.ComputeImage(width, height)
+
+# Cached visibility: first hits of the camera rays, rendered again only when the camera or the scene changes
+gbuffer = graphicsLibrary.GBuffer(width, height)
+gbuffer_state = ChangeTracker()
+
+# Denoising: 1 jittered sample per frame, accumulated over time and filtered with the G-buffer as guide
+denoise_stage = graphicsLibrary.Denoiser(width, height, shaderProgram_temporal, shaderProgram_atrous)
+denoise_frame = 0
+
+# Dynamic resolution: the raytracing pass is rendered smaller when frames take longer than the target
+scaled_target = graphicsLibrary.ScaledRenderTarget(width, height)
+resolution_scaler = graphicsLibrary.ResolutionScaler()
 
 # timing
 deltaTime = 0.0
 lastFrame = 0.0
 timer = 0.0
 
+# Stage timings, printed every few seconds. Set PROFILE_TRACE to a .csv or .json file to save every sample on exit
+profile_trace = os.environ.get("PROFILE_TRACE")
+profiler = FrameProfiler(trace=profile_trace is not None)
+last_report = time.time()
+
+# Shader files saved while running are relinked without restarting
+shader_watcher = shaderLoaderV3.ShaderWatcher([shaderProgram, shaderProgram_skybox, shaderProgram_sphere,
+                                               shaderProgram_gbuffer, shaderProgram_temporal, shaderProgram_atrous,
+                                               shaderProgram_compute])
+
 # Run a loop to keep the program running
 draw = True
 while draw:
-    for event in pg.event.get():
-        if event.type == pg.QUIT:
-            draw = False
-
-    # Clear color buffer and depth buffer before drawing each frame
-    glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
-
-    # Rotates light and camera
-    currentFrame = time.time()
-    deltaTime = currentFrame - lastFrame
-    lastFrame = currentFrame
-
-    input_handler()
-
-    view_mat = pyrr.matrix44.create_look_at(eye, eye + camera_forward, up)
-    projection_mat = pyrr.matrix44.create_perspective_projection_matrix(fov_slider.get_value(), aspect, near,  far)
-
-    view_mat_without_translation = view_mat.copy()
-    view_mat_without_translation[3][:3] = [0, 0, 0]
-
-    inverseViewProjection_mat = pyrr.matrix44.inverse(pyrr.matrix44.multiply(view_mat_without_translation, projection_mat))
-
-    # Rotates light around scene
-    if (light_rot_check.get_value()):
-        timer += 0.01;
-        light_pos[0] = 20 * np.sin(timer * 0.1)
-        light_pos[2] = 20 * np.cos(timer * 0.1)
-
-    # Set uniforms
-    # Set the uniform variables
-    shaderProgram_sphere["model_matrix"] = model_mat
-    shaderProgram_sphere["light_pos"] = light_pos
-    shaderProgram_sphere["eye_pos"] = eye
-    shaderProgram_sphere["fov"] = np.deg2rad(fov_slider.get_value())
-
-    # min and max bounds (coordinates) of Axis Aligned Bounding Box
-    shaderProgram_sphere["minBound"] = (-0.5, -0.5, -0.5)
-    shaderProgram_sphere["maxBound"] = (0.5, 0.5, 0.5)
-
-    shaderProgram_sphere["cameraU"] = pyrr.Vector3([view_mat[0][0], view_mat[1][0], view_mat[2][0]])
-    shaderProgram_sphere["cameraV"] = pyrr.Vector3([view_mat[0][1], view_mat[1][1], view_mat[2][1]])
-    shaderProgram_sphere["cameraW"] = pyrr.Vector3([view_mat[0][2], view_mat[1][2], view_mat[2][2]])
-
-    shaderProgram_sphere["resolution"] = np.array([width, height], dtype=np.float32)
-
-    shaderProgram_sphere["ambient_intensity"] = ambient_intensity_slider.get_value()
-    shaderProgram_sphere["lightColor"] = [1.0, 1.0, 1.0]
-
+    with profiler.cpu("input"):
+        for event in pg.event.get():
+            if event.type == pg.QUIT:
+                draw = False
+
+        # Rotates light and camera
+        currentFrame = time.time()
+        deltaTime = currentFrame - lastFrame
+        lastFrame = currentFrame
+
+        input_handler()
+
+        if shader_watcher.poll():
+            # samples of the old shaders are not accumulated with the new ones
+            accumulation.reset()
+            compute_image.reset()
+            gbuffer.valid = False
+            denoise_stage.reset()
+
+    # Process the GUI events once per frame, the controls then hold their current values
+    with profiler.cpu("gui"):
+        gui.update()
+        fov_value = fov_slider.value
+        light_rotation = light_rot_check.value
+        ambient_intensity = ambient_intensity_slider.value
+        progressive = progressive_check.value
+        use_compute = compute_check.value
+        dynamic_resolution = dynamic_resolution_check.value and not (use_compute or progressive)
+        denoise = denoise_check.value and not (use_compute or progressive or dynamic_resolution)
+        cached_visibility = cached_visibility_check.value and not (use_compute or progressive or dynamic_resolution or denoise)
+        resolution_scaler.target_frame_time = target_frame_time_slider.value / 1000.0
+
+    # Camera, light and uniform updates
+    with profiler.cpu("uniforms"):
+        # Clear color buffer and depth buffer before drawing each frame
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+
+        view_mat = pyrr.matrix44.create_look_at(eye, eye + camera_forward, up)
+        projection_mat = pyrr.matrix44.create_perspective_projection_matrix(fov_value, aspect, near,  far)
+
+        view_mat_without_translation = view_mat.copy()
+        view_mat_without_translation[3][:3] = [0, 0, 0]
+
+        inverseViewProjection_mat = pyrr.matrix44.inverse(pyrr.matrix44.multiply(view_mat_without_translation, projection_mat))
+
+        # Rotates light around scene
+        if (light_rotation):
+            timer += 0.01;
+            light_pos[0] = 20 * np.sin(timer * 0.1)
+            light_pos[2] = 20 * np.cos(timer * 0.1)
+
+        # Set the per-frame uniforms, shared by all the programs
+        frame_uniforms["light_pos"] = light_pos
+        frame_uniforms["eye_pos"] = eye
+        frame_uniforms["fov"] = np.deg2rad(fov_value)
+
+        frame_uniforms["cameraU"] = [view_mat[0][0], view_mat[1][0], view_mat[2][0]]
+        frame_uniforms["cameraV"] = [view_mat[0][1], view_mat[1][1], view_mat[2][1]]
+        frame_uniforms["cameraW"] = [view_mat[0][2], view_mat[1][2], view_mat[2][2]]
+
+        frame_uniforms["resolution"] = [width, height]
+        if dynamic_resolution:
+            # the first frame time includes the setup, it is skipped
+            if lastFrame - deltaTime > 0:
+                scaled_target.scale = resolution_scaler.update(deltaTime)
+            frame_uniforms["resolution"] = scaled_target.size()
+
+        frame_uniforms["ambient_intensity"] = ambient_intensity
+        frame_uniforms["lightColor"] = [1.0, 1.0, 1.0]
+        frame_uniforms["inViewProjectionMatrix"] = inverseViewProjection_mat
+        frame_uniforms.update()
+
+        # Set the uniform variables of the sphere program
+        scene_graph.update()
+        shaderProgram_sphere["model_matrix"] = scene_graph.world[obj_node]
+
+        # min and max bounds (coordinates) of Axis Aligned Bounding Box
+        shaderProgram_sphere["minBound"] = min_bound
+        shaderProgram_sphere["maxBound"] = max_bound
+
+        # Start a new accumulation when the view or the light moved
+        if accumulation_state.changed(eye, camera_forward, fov_value, light_pos) or not progressive:
+            accumulation.reset()
+            compute_image.reset()
+        shaderProgram_sphere["progressive"] = progressive or denoise
+        shaderProgram_sphere["single_sample"] = denoise
+        if denoise:
+            # a new random sample every frame, the denoiser does the accumulation
+            denoise_frame += 1
+            shaderProgram_sphere["sample_index"] = denoise_frame
+        else:
+            shaderProgram_sphere["sample_index"] = accumulation.n_samples
+        shaderProgram_sphere["accumulation"] = 1
+
+        # The cached first hits are stale when the camera or the scene moved.
+        # Checked before the upload, which clears scene.dirty
+        if gbuffer_state.changed(eye, camera_forward, fov_value) or scene.dirty:
+            gbuffer.valid = False
+
+        # Re-upload the scene only if it was changed
+        graphicsLibrary.update_scene_buffers(scene_buffers, scene)
+        shaderProgram_sphere["use_gbuffer"] = cached_visibility
+        shaderProgram_sphere["gbuffer_position"] = 3
+        shaderProgram_sphere["gbuffer_normal"] = 4
+
+    glActiveTexture(GL_TEXTURE2)
+    glBindTexture(GL_TEXTURE_CUBE_MAP, prefiltered_id)
     glActiveTexture(GL_TEXTURE0)
     glBindTexture(GL_TEXTURE_CUBE_MAP, skybox_id)
 
+    if cached_visibility or denoise:
+        # Trace the camera rays only when the camera or the scene moved, the light alone only needs shading
+        if not gbuffer.valid:
+            with profiler.cpu("gbuffer"), profiler.gpu("gbuffer"):
+                glUseProgram(shaderProgram_gbuffer.shader)
+                gbuffer.begin()
+                graphicsLibrary.draw_buffers(vao_obj, obj)
+                gbuffer.end()
+        gbuffer.bind(texture_unit=3)
+
+    # The raytraced image covers the whole window, only the direct path (last branch) draws the skybox pass too
     glUseProgram(shaderProgram_sphere.shader)
-    glBindVertexArray(vao_obj)
-    glDrawArrays(GL_TRIANGLES, 0, obj.n_vertices)      # draw the object
-
+    if use_compute:
+        # One invocation per pixel writes image_output, which is then copied to the window
+        with profiler.cpu("compute"), profiler.gpu("compute"):
+            shaderProgram_compute["progressive"] = progressive
+            shaderProgram_compute["sample_index"] = compute_image.n_samples
+            compute_image.begin(image_unit=0)
+            shaderProgram_compute.dispatch(width, height)
+            compute_image.end()
+            compute_image.present(width, height)
+    elif dynamic_resolution:
+        # Raytrace into the smaller framebuffer and stretch it to the window
+        with profiler.cpu("sphere"), profiler.gpu("sphere"):
+            scaled_target.begin()
+            graphicsLibrary.draw_buffers(vao_obj, obj)
+            scaled_target.end()
+            scaled_target.present(width, height)
+    elif progressive:
+        # Blend this frame's sample into the float accumulation buffers and show the running mean
+        with profiler.cpu("sphere"), profiler.gpu("sphere"):
+            accumulation.begin(texture_unit=1)
+            graphicsLibrary.draw_buffers(vao_obj, obj)
+            accumulation.end()
+            accumulation.present(width, height)
+    elif denoise:
+        # One sample per pixel, then reprojected history and edge-aware filtering
+        with profiler.cpu("sphere"), profiler.gpu("sphere"):
+            denoise_stage.begin()
+            graphicsLibrary.draw_buffers(vao_obj, obj)
+            denoise_stage.end()
+        with profiler.cpu("denoise"), profiler.gpu("denoise"):
+            denoise_stage.apply(vao_obj, obj, view_mat @ projection_mat)
+            denoise_stage.present(width, height)
+    else:
+        with profiler.cpu("sphere"), profiler.gpu("sphere"):
+            graphicsLibrary.draw_buffers(vao_obj, obj)      # draw the object
 
-    glDepthFunc(GL_LEQUAL)
-    glUseProgram(shaderProgram_skybox.shader)
-    shaderProgram_skybox["inViewProjectionMatrix"] = inverseViewProjection_mat
-    glBindVertexArray(vao_quad)
-    glDrawArrays(GL_TRIANGLES, 0, quad_n_vertices)
+        with profiler.cpu("skybox"), profiler.gpu("skybox"):
+            glDepthFunc(GL_LEQUAL)
+            glUseProgram(shaderProgram_skybox.shader)
+            glBindVertexArray(vao_quad)
+            glDrawArrays(GL_TRIANGLES, 0, quad_n_vertices)
 
-    glDepthFunc(GL_LESS)
+            glDepthFunc(GL_LESS)
 
 
     # ****************************************************************************************************
 
 
     # Refresh the display to show what's been drawn
-    pg.display.flip()
+    with profiler.cpu("flip"):
+        pg.display.flip()
+
+    profiler.end_frame()
+    if currentFrame - last_report > 2.0:
+        print(profiler.report())
+        pg.display.set_caption(f"Raytracing - frame p50 {profiler.percentiles()[('cpu', 'frame')][0]:.1f} ms")
+        last_report = currentFrame
 
 
 # Cleanup
+if profile_trace is not None:
+    profiler.dump(profile_trace)
+profiler.delete()
 glDeleteVertexArrays(1, [vao_obj, vao_quad])
 glDeleteBuffers(1, [vbo_obj, vbo_obj])
+if ebo_obj is not None:
+    glDeleteBuffers(1, [ebo_obj])
+glDeleteBuffers(3, scene_buffers)
+accumulation.delete()
+compute_image.delete()
+gbuffer.delete()
+denoise_stage.delete()
+scaled_target.delete()
+frame_uniforms.delete()
+shader_watcher.close()
 glDeleteProgram(shaderProgram.shader)
 glDeleteProgram(shaderProgram_skybox.shader)
 glDeleteProgram(shaderProgram_sphere.shader)
+glDeleteProgram(shaderProgram_gbuffer.shader)
+glDeleteProgram(shaderProgram_temporal.shader)
+glDeleteProgram(shaderProgram_atrous.shader)
+glDeleteProgram(shaderProgram_compute.shader)
+glDeleteTextures([skybox_id, prefiltered_id])
 
 pg.quit()   # Close the graphics window
 quit()      # Exit the program
\ No newline at end of file
@@ -1,8 +1,103 @@
+import hashlib
+import json
+import os
+
 import numpy as np
 
+# Hash of this file, stored in the mesh cache so caches written by another loader version are ignored
+with open(__file__, "rb") as _source:
+    LOADER_VERSION = hashlib.sha1(_source.read()).hexdigest()
+
+# Arrays stored in the mesh cache, one .npy file each (indices only for indexed meshes)
+CACHE_ARRAYS = ("vertices", "v", "vt", "vn", "indices")
+
+# Attributes stored in the metadata of the mesh cache
+CACHE_PROPERTIES = ("min", "max", "center", "dia",
+                    "size_position", "size_texture", "size_normal", "itemsize", "stride",
+                    "offset_position", "offset_texture", "offset_normal", "n_vertices", "n_indices",
+                    "n_triangles", "surface_area", "group_names", "group_first_triangle", "group_n_triangles",
+                    "group_min", "group_max")
+
+# Cached properties that are float32 arrays
+CACHE_ARRAY_PROPERTIES = ("min", "max", "center", "group_min", "group_max")
+
+# Size in characters of the blocks read by ObjLoader.load_mesh
+CHUNK_SIZE = 1 << 24
+
+
+# Reads a text file in large blocks, yielding only whole lines
+def read_line_chunks(file, chunk_size=CHUNK_SIZE):
+    remainder = ""
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        chunk = remainder + chunk
+        end = chunk.rfind("\n") + 1
+        remainder = chunk[end:]
+        yield chunk[:end]
+    if remainder:
+        yield remainder
+
+
+# Converts lines of n whitespace separated floats into an (n_lines, n) array
+def parse_floats(lines, n):
+    if len(lines) == 0:
+        return np.empty((0, n), dtype=np.float32)
+
+    values = np.fromstring(" ".join(lines), dtype=np.float32, sep=" ")
+    if values.size != len(lines) * n:
+        # some lines carry extra components (e.g. "vt u v w"), keep the first n
+        values = np.array([line.split()[:n] for line in lines], dtype=np.float32)
+    return values.reshape(-1, n)
+
+
+# Converts the corners of face lines into triangle corners (fan triangulation)
+# Returns an (n_corners, 3) array of zero based (v, vt, vn) indices with -1 for missing attributes,
+# or None if the corners do not all use the same format
+def parse_faces(lines):
+    if len(lines) == 0:
+        return np.empty((0, 3), dtype=np.int32)
+
+    words = [line.split() for line in lines]
+    counts = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+    text = " ".join([corner for corner_list in words for corner in corner_list])
+    n_polygon_corners = int(counts.sum())
+
+    # layout of the corners, taken from the first one: v, v/vt, v//vn or v/vt/vn
+    first = words[0][0].split("/")
+    columns = [0]
+    if len(first) >= 2 and first[1] != "":
+        columns.append(1)
+    if len(first) == 3:
+        columns.append(2)
+
+    if text.count("/") != n_polygon_corners * (len(first) - 1):
+        return None
+    if text.count("//") != (n_polygon_corners if len(first) == 3 and first[1] == "" else 0):
+        return None
+
+    values = np.fromstring(text.replace("/", " "), dtype=np.int64, sep=" ")
+    if values.size != n_polygon_corners * len(columns):
+        return None
+    polygon_corners = np.full((n_polygon_corners, 3), -1, dtype=np.int32)
+    polygon_corners[:, columns] = values.reshape(-1, len(columns)) - 1
+
+    if np.all(counts == 3):
+        return polygon_corners
+
+    # fan triangulation: triangle i of a polygon uses its corners 0, i+1, i+2
+    n_triangles = counts - 2
+    first_corner = np.cumsum(counts) - counts
+    polygon = np.repeat(np.arange(len(counts)), n_triangles)
+    i = np.arange(int(n_triangles.sum())) - np.repeat(np.cumsum(n_triangles) - n_triangles, n_triangles)
+    start = first_corner[polygon]
+    triangles = np.stack([start, start + 1 + i, start + 2 + i], axis=1)
+    return polygon_corners[triangles.ravel()]
+
 
 class ObjLoader:
-    def __init__(self, file):
+    def __init__(self, file, use_cache=True, indexed=False):
         '''
         This Objloader class loads a mesh from an obj file.
         The mesh is made up of vertices.
@@ -44,7 +139,25 @@ class ObjLoader:
             a list of vertex normal coordinates
             vn = [ [xn,yn,zn], [xn,yn,zn], [xn,yn,zn], ...]
 
-        :param file:    full path to the obj file
+        Mesh statistics, computed once at load time:
+            self.n_triangles:           number of triangles
+            self.surface_area:          total area of the triangles
+            self.group_names:           names of the o/g groups ("default" for faces before the first group)
+            self.group_first_triangle:  index of the first triangle of each group
+            self.group_n_triangles:     number of triangles of each group
+            self.group_min/group_max:   (n_groups, 3) bounding box of each group
+
+        self.indices:
+            only for indexed meshes (indexed=True). self.vertices then holds every unique
+            vertex once and indices lists the vertices of the triangles
+            indices = [ 0,1,2, 2,3,0, ...]     (uint16 if there are at most 65536 vertices, else uint32)
+
+        The parsed mesh is cached next to the obj file (see cache_path). Later loads of
+        an unchanged file memory-map the cached arrays instead of parsing the text again.
+
+        :param file:        full path to the obj file
+        :param use_cache:   read and write the binary mesh cache
+        :param indexed:     deduplicate the vertices and build an index array
         '''
 
 
@@ -53,16 +166,11 @@ class ObjLoader:
         self.vt = []            # list of vertex texture coordinates
         self.vn = []            # list of vertex normal coordinates
 
-        self.load_mesh(file)
-
         self.center = None
         self.max = None
         self.min = None
         self.dia = None
 
-        self.compute_model_extent(self.v)
-
-
         self.size_position = None
         self.size_texture = None
         self.size_normal = None
@@ -73,17 +181,118 @@ class ObjLoader:
         self.offset_normal = None
         self.n_vertices = None
 
+        self.indexed = indexed
+        self.indices = None
+        self.n_indices = None
+
+        self.group_starts = []  # (name, first corner) of each o/g line, filled by the parser
+        self.n_triangles = None
+        self.surface_area = None
+        self.group_names = None
+        self.group_first_triangle = None
+        self.group_n_triangles = None
+        self.group_min = None
+        self.group_max = None
+
+        if use_cache and self.load_cache(file):
+            return
+
+        self.load_mesh(file)
+        self.compute_model_extent(self.v)
         self.compute_properties_of_vertices()
+        self.compute_statistics()
+
+        if indexed:
+            self.build_index()
+
+        if use_cache:
+            self.save_cache(file)
 
 
     def load_mesh(self, filename):
         '''
         Load a mesh from an obj file.
+
+        The file is read in large chunks. The v/vt/vn lines of a chunk are converted
+        with one numpy call per attribute and the face corners are appended to a
+        preallocated integer array. Once the whole file is read, self.vertices is
+        built with one gather per attribute.
+
+        Files mixing corner formats (e.g. "1/2/3" and "1//3") fall back to load_mesh_lines.
         :param filename:
         :return:
         '''
+        v_chunks, vt_chunks, vn_chunks = [], [], []
+        self.group_starts = []
+        corners = np.empty((1 << 16, 3), dtype=np.int32)     # (v, vt, vn) indices per corner, -1 if missing
+        n_corners = 0
 
+        with open(filename, "r") as file:
+            for text in read_line_chunks(file):
+                # indented records and tabs after the keyword are accepted, as by the split() of load_mesh_lines
+                lines = [line.strip() for line in text.replace("\t", " ").splitlines()]
+
+                v_chunks.append(parse_floats([line[2:] for line in lines if line.startswith("v ")], 3))
+                vt_chunks.append(parse_floats([line[3:] for line in lines if line.startswith("vt ")], 2))
+                vn_chunks.append(parse_floats([line[3:] for line in lines if line.startswith("vn ")], 3))
+
+                # faces are parsed in segments split at the o/g lines, to know where each group starts
+                group_lines = [i for i, line in enumerate(lines) if line.startswith(("o ", "g "))]
+                bounds = [0] + group_lines + [len(lines)]
+                for segment, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+                    # every segment but the first starts at an o/g line
+                    if segment > 0:
+                        self.group_starts.append((lines[start][2:].strip(), n_corners))
+
+                    chunk_corners = parse_faces([line[2:] for line in lines[start:end] if line.startswith("f ")])
+                    if chunk_corners is None:
+                        self.load_mesh_lines(filename)
+                        return
+
+                    # grow the corner array by doubling when it is full
+                    if n_corners + len(chunk_corners) > len(corners):
+                        capacity = max(2 * len(corners), n_corners + len(chunk_corners))
+                        corners = np.resize(corners, (capacity, 3))
+                    corners[n_corners:n_corners + len(chunk_corners)] = chunk_corners
+                    n_corners += len(chunk_corners)
+
+        corners = corners[:n_corners]
+        self.v = np.concatenate(v_chunks)
+        self.vt = np.concatenate(vt_chunks)
+        self.vn = np.concatenate(vn_chunks)
+
+        # every corner must use the same layout to build an interleaved buffer
+        attributes = [(self.v, 0, 3)]
+        for array, column, size in ((self.vt, 1, 2), (self.vn, 2, 3)):
+            present = corners[:, column] >= 0
+            if present.any() and not present.all():
+                self.load_mesh_lines(filename)
+                return
+            if present.any() and len(array) > 0:
+                attributes.append((array, column, size))
+
+        vertices = np.empty((n_corners, sum(size for _, _, size in attributes)), dtype=np.float32)
+        offset = 0
+        for array, column, size in attributes:
+            vertices[:, offset:offset + size] = array[corners[:, column]]
+            offset += size
+
+        self.vertices = vertices.ravel()
+        self.set_vertex_layout([column for _, column, _ in attributes])
+
+    def load_mesh_lines(self, filename):
+        '''
+        Load a mesh from an obj file one line at a time.
+        Slower than load_mesh, but accepts any mix of corner formats.
+        :param filename:
+        :return:
+        '''
+        self.v = []
+        self.vt = []
+        self.vn = []
+        self.group_starts = []
         vertices = []
+        n_corners = 0
 
         with open(filename, "r") as file:
             for line in file:
@@ -97,6 +306,8 @@ class ObjLoader:
                     self.vt.append(list(map(float, words[1:3])))
                 elif words[0] == "vn":
                     self.vn.append(list(map(float, words[1:4])))
+                elif words[0] in ("o", "g"):
+                    self.group_starts.append((" ".join(words[1:]), n_corners))
                 elif words[0] == "f":
                     n_triangle = len(words) - 3
 
@@ -104,12 +315,31 @@ class ObjLoader:
                         self.add_vertex(words[1], self.v, self.vt, self.vn, vertices)
                         self.add_vertex(words[2 + i], self.v, self.vt, self.vn, vertices)
                         self.add_vertex(words[3 + i], self.v, self.vt, self.vn, vertices)
+                    n_corners += 3 * n_triangle
 
         self.vertices = np.array(vertices, dtype=np.float32)
         self.v = np.array(self.v, dtype=np.float32)
         self.vt = np.array(self.vt, dtype=np.float32)
         self.vn = np.array(self.vn, dtype=np.float32)
 
+        # layout of the vertices from the number of floats per corner: v, v/vt, v//vn or v/vt/vn
+        layouts = {3: [0], 5: [0, 1], 6: [0, 2], 8: [0, 1, 2]}
+        n_floats = len(self.vertices) / n_corners if n_corners > 0 else 3
+        if n_floats not in layouts:
+            raise ValueError(f"{filename}: the faces do not all give their corners the same attributes")
+        self.set_vertex_layout(layouts[n_floats])
+
+    def set_vertex_layout(self, columns):
+        '''
+        Record which attributes the rows of self.vertices hold, read by compute_properties_of_vertices.
+        A vt or vn line that no face uses adds nothing to the vertices.
+        :param columns: attributes of each vertex, 0 for v, 1 for vt, 2 for vn
+        :return:
+        '''
+        self.size_position = 3
+        self.size_texture = 2 if 1 in columns else 0
+        self.size_normal = 3 if 2 in columns else 0
+
     def add_vertex(self, corner_description: str,
                    v, vt,
                    vn, vertices) -> None:
@@ -123,22 +353,12 @@ class ObjLoader:
         :return:
         '''
 
+        # v, v/vt, v//vn or v/vt/vn: the attributes are found by their position, empty when missing
         v_vt_vn = corner_description.split("/")
-        v_vt_vn = list(filter(None, v_vt_vn))
-        v_vt_vn = list(map(int, v_vt_vn))
-
-        if len(v_vt_vn) == 1:
-            vertices.extend(v[int(v_vt_vn[0]) - 1])
-        elif len(v_vt_vn) == 2:
-            if len(vn) == 0:
-                vertices.extend(v[int(v_vt_vn[0]) - 1])     # add vertex coordinates to the list
-                vertices.extend(vt[int(v_vt_vn[1]) - 1])    # add texture coordinates to the list
-            elif len(vt) == 0:
-                vertices.extend(v[int(v_vt_vn[0]) - 1])     # add vertex coordinates to the list
-                vertices.extend(vn[int(v_vt_vn[1]) - 1])    # add normal coordinates to the list
-        elif len(v_vt_vn) == 3:
-            vertices.extend(v[int(v_vt_vn[0]) - 1])         # add vertex coordinates to the list
+        vertices.extend(v[int(v_vt_vn[0]) - 1])             # add vertex coordinates to the list
+        if len(v_vt_vn) >= 2 and v_vt_vn[1] != "":
             vertices.extend(vt[int(v_vt_vn[1]) - 1])        # add texture coordinates to the list
+        if len(v_vt_vn) == 3 and v_vt_vn[2] != "":
             vertices.extend(vn[int(v_vt_vn[2]) - 1])        # add normal coordinates to the list
 
 
@@ -149,13 +369,13 @@ class ObjLoader:
         :param positions:
         :return:
         '''
-        self.min = np.array([np.inf, np.inf, np.inf])
-        self.max = np.array([-np.inf, -np.inf, -np.inf])
-
-        for v in positions:
-            v = np.array(v)
-            self.min = np.minimum(self.min, v)
-            self.max = np.maximum(self.max, v)
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        if len(positions) == 0:
+            self.min = np.array([np.inf, np.inf, np.inf])
+            self.max = np.array([-np.inf, -np.inf, -np.inf])
+        else:
+            self.min = positions.min(axis=0)
+            self.max = positions.max(axis=0)
 
         self.dia = np.linalg.norm(self.max - self.min)
         self.center = (self.min + self.max) / 2
@@ -170,10 +390,7 @@ class ObjLoader:
         Compute the properties of the vertices
         :return:
         '''
-        self.size_position = self.v[0].size  # x, y, z
-        self.size_texture = self.vt[0].size  # u, v
-        self.size_normal = self.vn[0].size  # r, g, b
-
+        # size_position (x, y, z), size_texture (u, v) and size_normal (r, g, b) are set by the parser
         self.itemsize = self.vertices.itemsize
 
         self.stride = (self.size_position + self.size_texture + self.size_normal) * self.itemsize
@@ -183,6 +400,150 @@ class ObjLoader:
         self.n_vertices = len(self.vertices) // (
                     self.size_position + self.size_texture + self.size_normal)  # number of vertices
 
+    def compute_statistics(self):
+        '''
+        Compute the triangle count, surface area and per group bounding boxes.
+        Must run before build_index, it reads the positions of the triangle corners from self.vertices.
+        :return:
+        '''
+        n_floats = self.stride // self.itemsize
+        positions = np.asarray(self.vertices).reshape(-1, n_floats)[:, :self.size_position]
+        triangles = positions.reshape(-1, 3, self.size_position).astype(np.float64)
+
+        self.n_triangles = len(triangles)
+        cross = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+        self.surface_area = float(0.5 * np.linalg.norm(cross, axis=1).sum())
+
+        # faces before the first o/g line belong to the "default" group
+        starts = list(self.group_starts)
+        if len(starts) == 0 or starts[0][1] > 0:
+            starts.insert(0, ("default", 0))
+
+        names = [name for name, _ in starts]
+        first = np.array([corner // 3 for _, corner in starts] + [self.n_triangles])
+        counts = np.diff(first)
+
+        # groups without faces have no bounding box
+        keep = counts > 0
+        self.group_names = [name for name, k in zip(names, keep) if k]
+        self.group_first_triangle = first[:-1][keep].tolist()
+        self.group_n_triangles = counts[keep].tolist()
+
+        corner_starts = 3 * first[:-1][keep]
+        if len(corner_starts) > 0:
+            self.group_min = np.minimum.reduceat(positions, corner_starts, axis=0).astype(np.float32)
+            self.group_max = np.maximum.reduceat(positions, corner_starts, axis=0).astype(np.float32)
+        else:
+            self.group_min = np.zeros((0, 3), dtype=np.float32)
+            self.group_max = np.zeros((0, 3), dtype=np.float32)
+
+    def build_index(self):
+        '''
+        Deduplicate the vertices and build the index array.
+        Identical vertices (same v, vt and vn) are found with one np.unique over the rows
+        of self.vertices; the unique vertices keep the order in which they are first used.
+        :return:
+        '''
+        n_floats = self.stride // self.itemsize
+        rows = np.ascontiguousarray(self.vertices).reshape(-1, n_floats)
+        keys = rows.view(np.dtype((np.void, rows.itemsize * n_floats))).ravel()
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+
+        order = np.argsort(first)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+
+        index_type = np.uint16 if len(first) <= 65536 else np.uint32
+        self.vertices = rows[first[order]].ravel()
+        self.indices = rank[inverse.ravel()].astype(index_type)
+        self.n_vertices = len(first)
+        self.n_indices = len(self.indices)
+
+
+    def cache_key(self, filename):
+        '''
+        Identify the obj file the cache was written for
+        :param filename:
+        :return: dict of source path, size, modification time and loader version
+        '''
+        stat = os.stat(filename)
+        return {"source": os.path.abspath(filename),
+                "size": stat.st_size,
+                "mtime": stat.st_mtime_ns,
+                "loader_version": LOADER_VERSION,
+                "indexed": self.indexed}
+
+    def load_cache(self, filename):
+        '''
+        Load the mesh from its binary cache if the cache matches the obj file.
+        The arrays are memory-mapped read only, so they can be uploaded without a copy.
+        :param filename:
+        :return: True if the cache was loaded
+        '''
+        directory = cache_path(filename, self.indexed)
+        try:
+            with open(os.path.join(directory, "meta.json"), "r") as file:
+                meta = json.load(file)
+            if meta["key"] != self.cache_key(filename):
+                return False
+
+            arrays = {name: np.load(os.path.join(directory, name + ".npy"), mmap_mode="r")
+                      for name in CACHE_ARRAYS if name != "indices" or self.indexed}
+        except (OSError, ValueError, KeyError):
+            return False
+
+        for name, array in arrays.items():
+            setattr(self, name, array)
+
+        properties = meta["properties"]
+        for name in CACHE_PROPERTIES:
+            setattr(self, name, properties[name])
+        for name in CACHE_ARRAY_PROPERTIES:
+            setattr(self, name, np.array(getattr(self, name), dtype=np.float32))
+        self.group_min = self.group_min.reshape(-1, 3)
+        self.group_max = self.group_max.reshape(-1, 3)
+
+        return True
+
+    def save_cache(self, filename):
+        '''
+        Write the binary cache of the mesh next to the obj file.
+        Failing to write the cache (e.g. read-only directory) is not an error.
+        :param filename:
+        :return:
+        '''
+        directory = cache_path(filename, self.indexed)
+        meta_file = os.path.join(directory, "meta.json")
+
+        properties = {}
+        for name in CACHE_PROPERTIES:
+            value = getattr(self, name)
+            if isinstance(value, (np.ndarray, np.generic)):
+                value = value.tolist()
+            properties[name] = value
+
+        try:
+            os.makedirs(directory, exist_ok=True)
+            if os.path.exists(meta_file):
+                os.remove(meta_file)
+            for name in CACHE_ARRAYS:
+                if getattr(self, name) is None:
+                    continue
+                np.save(os.path.join(directory, name + ".npy"), np.ascontiguousarray(getattr(self, name)))
+
+            # metadata is written last, so an interrupted write leaves no valid cache behind
+            with open(meta_file + ".tmp", "w") as file:
+                json.dump({"key": self.cache_key(filename), "properties": properties}, file)
+            os.replace(meta_file + ".tmp", meta_file)
+        except OSError:
+            pass
+
+
+# Directory holding the binary cache of an obj file
+def cache_path(filename, indexed=False):
+    if indexed:
+        return filename + ".indexed.cache"
+    return filename + ".cache"
 
 
 if __name__ == '__main__':
@@ -0,0 +1,142 @@
+import numpy as np
+
+# std430 layouts of the structs in shaders/common/raytracing.glsl. vec3 members are aligned to 16 bytes
+# and every struct is padded to a multiple of 16 bytes, so the arrays can be uploaded as they are.
+#
+#     struct Material { vec3 color; float metallic; float roughness; int mat_type; };               32 bytes
+#     struct Sphere   { vec3 center; float radius; int material; };                                 32 bytes
+#     struct Plane    { vec3 center; int material; vec3 size; vec3 normal; };                       48 bytes
+MATERIAL_DTYPE = np.dtype({"names": ["color", "metallic", "roughness", "mat_type"],
+                           "formats": [("<f4", 3), "<f4", "<f4", "<i4"],
+                           "offsets": [0, 12, 16, 20],
+                           "itemsize": 32})
+
+SPHERE_DTYPE = np.dtype({"names": ["center", "radius", "material"],
+                         "formats": [("<f4", 3), "<f4", "<i4"],
+                         "offsets": [0, 12, 16],
+                         "itemsize": 32})
+
+PLANE_DTYPE = np.dtype({"names": ["center", "material", "size", "normal"],
+                        "formats": [("<f4", 3), "<i4", ("<f4", 3), ("<f4", 3)],
+                        "offsets": [0, 12, 16, 32],
+                        "itemsize": 48})
+
+
+class Scene:
+    def __init__(self):
+        '''
+        Spheres, planes and materials traced by shaders/common/raytracing.glsl and cpuRaytracer.
+
+        Each kind of object is kept in a numpy structured array with the std430 layout of the
+        matching GLSL struct, so the arrays are the shader storage buffer contents:
+            self.materials:     MATERIAL_DTYPE (color, metallic, roughness, mat_type)
+            self.spheres:       SPHERE_DTYPE (center, radius, material)
+            self.planes:        PLANE_DTYPE (center, material, size, normal)
+
+        material is the index of the material of a sphere or plane in self.materials.
+
+        self.dirty is set whenever the scene changes, so the buffers are only uploaded again when
+        needed (see graphicsLibrary.update_scene_buffers). Set it after editing the arrays in place:
+            scene.spheres["center"][3] = (0, 1, 0)
+            scene.dirty = True
+        '''
+        self.materials = np.zeros(0, dtype=MATERIAL_DTYPE)
+        self.spheres = np.zeros(0, dtype=SPHERE_DTYPE)
+        self.planes = np.zeros(0, dtype=PLANE_DTYPE)
+        self.dirty = True
+
+    def add_materials(self, colors, metallic, roughness, mat_type=1):
+        '''
+        Add materials in bulk
+        :return: indices of the new materials
+        '''
+        colors = np.asarray(colors, dtype=np.float32).reshape(-1, 3)
+        materials = np.zeros(len(colors), dtype=MATERIAL_DTYPE)
+        materials["color"] = colors
+        materials["metallic"] = metallic
+        materials["roughness"] = roughness
+        materials["mat_type"] = mat_type
+        return self.append("materials", materials)
+
+    def add_spheres(self, centers, radius, material):
+        '''
+        Add spheres in bulk
+        :return: indices of the new spheres
+        '''
+        centers = np.asarray(centers, dtype=np.float32).reshape(-1, 3)
+        spheres = np.zeros(len(centers), dtype=SPHERE_DTYPE)
+        spheres["center"] = centers
+        spheres["radius"] = radius
+        spheres["material"] = material
+        return self.append("spheres", spheres)
+
+    def add_planes(self, centers, size, normal, material):
+        '''
+        Add planes in bulk. Like the shader, planes are horizontal: only the y of the center is used
+        for the intersection and size gives the half extent along x and z.
+        :return: indices of the new planes
+        '''
+        centers = np.asarray(centers, dtype=np.float32).reshape(-1, 3)
+        planes = np.zeros(len(centers), dtype=PLANE_DTYPE)
+        planes["center"] = centers
+        planes["size"] = size
+        planes["normal"] = normal
+        planes["material"] = material
+        return self.append("planes", planes)
+
+    def add_material(self, color, metallic, roughness, mat_type=1):
+        return int(self.add_materials([color], metallic, roughness, mat_type)[0])
+
+    def add_sphere(self, center, radius, material):
+        return int(self.add_spheres([center], radius, material)[0])
+
+    def add_plane(self, center, size, normal, material):
+        return int(self.add_planes([center], size, normal, material)[0])
+
+    def append(self, name, items):
+        array = getattr(self, name)
+        setattr(self, name, np.concatenate([array, items]))
+        self.dirty = True
+        return np.arange(len(array), len(array) + len(items))
+
+    def buffers(self):
+        '''
+        Contents of the material, sphere and plane buffers.
+        Empty arrays are replaced by one object that can never be hit (a sphere of radius 0,
+        a plane of negative size), because a shader storage buffer can not be empty.
+        :return: (materials, spheres, planes) structured arrays
+        '''
+        materials = self.materials
+        spheres = self.spheres
+        planes = self.planes
+
+        if len(materials) == 0:
+            materials = np.zeros(1, dtype=MATERIAL_DTYPE)
+        if len(spheres) == 0:
+            spheres = np.zeros(1, dtype=SPHERE_DTYPE)
+        if len(planes) == 0:
+            planes = np.zeros(1, dtype=PLANE_DTYPE)
+            planes["size"] = -1.0
+
+        return materials, spheres, planes
+
+
+# The 4x4 sphere grid and ground plane that used to be built in main() of the sphere shader
+def default_scene():
+    scene = Scene()
+
+    ground = scene.add_material((1.0, 1.0, 1.0), metallic=0.0, roughness=0.0001, mat_type=1)
+    scene.add_plane((1.5, -1.0, 1.5), size=(5.0, 0.0, 5.0), normal=(0.0, 1.0, 0.0), material=ground)
+
+    i, j = np.meshgrid(np.arange(4), np.arange(4), indexing="ij")
+    i = i.ravel()
+    j = j.ravel()
+    k = (i * 4 + j) / 16.0
+
+    materials = scene.add_materials(np.tile([0.7, 0.7, 0.0], (16, 1)),
+                                    metallic=1.0 - np.clip(k, 0.0, 1.0),       # Decreasing metalness
+                                    roughness=np.clip(k, 0.0001, 1.0),         # Increasing roughness
+                                    mat_type=1)
+    scene.add_spheres(np.stack([i * 1.0, np.full(16, -0.75), j * 1.0], axis=1), radius=0.25, material=materials)
+
+    return scene
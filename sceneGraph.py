@@ -0,0 +1,134 @@
+import time
+
+import numpy as np
+
+
+class SceneGraph:
+    def __init__(self):
+        '''
+        Hierarchy of transforms stored as arrays (parent, depth, local, world, dirty) rather than one object per node.
+        Matrices follow the pyrr convention, world = local @ world of the parent. A node is added after its parent,
+        and update() recomputes the dirty subtrees one depth level at a time with batched matrix multiplies.
+        '''
+        self.parent = np.zeros(0, dtype=np.int32)               # index of the parent node, -1 for the roots
+        self.depth = np.zeros(0, dtype=np.int32)                # number of ancestors
+        self.local = np.zeros((0, 4, 4), dtype=np.float32)      # transform relative to the parent
+        self.world = np.zeros((0, 4, 4), dtype=np.float32)      # transform relative to the world, after update()
+        self.dirty = np.zeros(0, dtype=bool)                    # local transform changed since the last update()
+        self.levels = []                # indices of the nodes of each depth, rebuilt when nodes are added
+
+    @property
+    def n_nodes(self):
+        return len(self.parent)
+
+    def add_nodes(self, parents=-1, transforms=None, count=None):
+        '''
+        Add nodes in bulk.
+        :param parents:     parent index of each new node (or one for all), -1 for roots. A parent can be one of
+                            the new nodes if it comes before its children
+        :param transforms:  (n, 4, 4) local transforms, identity if None
+        :param count:       number of nodes, needed when neither parents nor transforms give it
+        :return: indices of the new nodes
+        '''
+        if transforms is not None:
+            transforms = np.asarray(transforms, dtype=np.float32).reshape(-1, 4, 4)
+            count = len(transforms)
+        elif count is None:
+            count = np.size(parents)
+        parents = np.broadcast_to(np.asarray(parents, dtype=np.int32), (count,))
+        if transforms is None:
+            transforms = np.broadcast_to(np.identity(4, dtype=np.float32), (count, 4, 4))
+
+        first = self.n_nodes
+        ids = np.arange(first, first + count)
+        if np.any(parents >= ids):
+            raise ValueError("A node must be added after its parent")
+
+        self.parent = np.concatenate([self.parent, parents])
+        self.local = np.concatenate([self.local, transforms])
+        self.world = np.concatenate([self.world, transforms])
+        self.dirty = np.concatenate([self.dirty, np.ones(count, dtype=bool)])
+
+        # depth of the new nodes, repeated until the depths of the parents among the new nodes are known
+        depth = np.concatenate([self.depth, np.zeros(count, dtype=np.int32)])
+        children = ids[parents >= 0]
+        while True:
+            new_depth = depth[self.parent[children]] + 1
+            if np.array_equal(new_depth, depth[children]):
+                break
+            depth[children] = new_depth
+        self.depth = depth
+
+        order = np.argsort(self.depth, kind="stable")
+        self.levels = np.split(order, np.cumsum(np.bincount(self.depth))[:-1])
+        return ids
+
+    def add_node(self, parent=-1, local=None):
+        return int(self.add_nodes(parent, None if local is None else [local], count=1)[0])
+
+    def set_local(self, ids, transforms):
+        '''
+        Set the local transforms of nodes, their world transforms (and those of their descendants)
+        are recomputed by the next update()
+        '''
+        self.local[ids] = transforms
+        self.dirty[ids] = True
+
+    def update(self):
+        '''
+        Recompute the world transforms of the dirty nodes and of their descendants.
+        :return: number of nodes whose world transform was recomputed
+        '''
+        if not self.dirty.any():
+            return 0
+
+        n_updated = 0
+        for depth, level in enumerate(self.levels):
+            if depth > 0:
+                # a node moves when its parent moved
+                self.dirty[level] |= self.dirty[self.parent[level]]
+            nodes = level[self.dirty[level]]
+            if len(nodes) == 0:
+                continue
+            if depth == 0:
+                self.world[nodes] = self.local[nodes]
+            else:
+                self.world[nodes] = self.local[nodes] @ self.world[self.parent[nodes]]
+            n_updated += len(nodes)
+
+        self.dirty[:] = False
+        return n_updated
+
+
+if __name__ == '__main__':
+    '''
+    Times the update of a scene graph of 100K animated nodes: 1000 roots with 10 children of 10 children each.
+
+    Usage, the world matrices can be used as model matrices as they are:
+
+        graph = SceneGraph()
+        car = graph.add_node(local=pyrr.matrix44.create_from_translation([0, 0, 5]))
+        wheels = graph.add_nodes(parents=car, transforms=wheel_offsets)
+        ...
+        graph.set_local(car, model_mat)         # moves the wheels too
+        graph.update()
+        shaderProgram["model_matrix"] = graph.world[car]
+        instanced_wheels.transforms = graph.world[wheels]
+    '''
+    graph = SceneGraph()
+    roots = graph.add_nodes(-1, count=1000)
+    children = graph.add_nodes(np.repeat(roots, 10))
+    graph.add_nodes(np.repeat(children, 10))
+    print("Nodes: ", graph.n_nodes)
+
+    start = time.time()
+    graph.update()
+    print("First update: ", time.time() - start)
+
+    transforms = np.tile(np.identity(4, dtype=np.float32), (len(roots), 1, 1))
+    for frame in range(3):
+        transforms[:, 3, 0] = frame
+        start = time.time()
+        graph.set_local(roots, transforms)
+        n_updated = graph.update()
+        print("Frame update: ", n_updated, "nodes in", time.time() - start)
@@ -1,76 +1,413 @@
+import hashlib
+import os
+import re
+import threading
+
 from OpenGL.GL import *
 import OpenGL.GL.shaders
 import numpy as np
 
+# Lines #include "file" of a shader, file is relative to the shader including it
+INCLUDE_PATTERN = re.compile(r'^[ \t]*#include[ \t]+"([^"]+)"[ \t]*$', re.MULTILINE)
+
+# Directory of the linked program binaries (see build_program)
+SHADER_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".shadercache")
+
 def load_shader(shader_file):
+    return str.encode(read_shader_source(shader_file))
+
+# GLSL has no includes, they are replaced by the included files here so the fragment and compute
+# raytracers can share the same code (shaders/common)
+# The shader file and the files it includes are appended to files, if given
+def read_shader_source(shader_file, files=None):
     shader_source = ""
     with open(shader_file) as f:
         shader_source = f.read()
-    f.close()
-    return str.encode(shader_source)
+    if files is not None:
+        files.append(shader_file)
+    directory = os.path.dirname(shader_file)
+    return INCLUDE_PATTERN.sub(lambda match: read_shader_source(os.path.join(directory, match.group(1)), files), shader_source)
 
 def compile_shader(vs, fs):
-    vert_shader = load_shader(vs)
-    frag_shader = load_shader(fs)
-    shader = OpenGL.GL.shaders.compileProgram(OpenGL.GL.shaders.compileShader(vert_shader, GL_VERTEX_SHADER),
-                                              OpenGL.GL.shaders.compileShader(frag_shader, GL_FRAGMENT_SHADER))
-    
-    return shader
+    return build_program(read_stages(((vs, GL_VERTEX_SHADER), (fs, GL_FRAGMENT_SHADER)))[0])
+
+def compile_compute_shader(cs):
+    return build_program(read_stages(((cs, GL_COMPUTE_SHADER),))[0])
+
+# Preprocessed sources of the stages ((file, GL shader type), ...) of a program
+# Returns ((source, GL shader type), ...) and the list of files they were read from, includes too
+def read_stages(stages):
+    files = []
+    sources = tuple((str.encode(read_shader_source(shader_file, files)), shader_type) for shader_file, shader_type in stages)
+    return sources, files
+
+# Key of the cached binary of a program: its sources and the driver that compiled them,
+# binaries are only valid for the exact same GL implementation
+def program_key(sources):
+    key = hashlib.sha1()
+    for name in (GL_VENDOR, GL_RENDERER, GL_VERSION):
+        key.update(glGetString(name) or b"")
+    for source, shader_type in sources:
+        key.update(str(shader_type).encode())
+        key.update(source)
+    return key.hexdigest()
+
+def build_program(sources, use_cache=True):
+    '''
+    Link a program from preprocessed sources.
+    Linked programs are saved with glGetProgramBinary in SHADER_CACHE_DIR and loaded back with glProgramBinary
+    on the next launches, which skips compiling and linking. A missing, stale or rejected binary (e.g. after a
+    driver update) falls back to compiling the sources.
+
+    :param sources:   ((source bytes, GL shader type), ...)
+    :param use_cache: read and write the program binary cache
+    :return: the program
+    '''
+    use_cache = use_cache and glGetIntegerv(GL_NUM_PROGRAM_BINARY_FORMATS) > 0
+    cache_file = os.path.join(SHADER_CACHE_DIR, program_key(sources) + ".bin") if use_cache else None
+
+    if cache_file is not None and os.path.exists(cache_file):
+        program = load_program_binary(cache_file)
+        if program is not None:
+            return program
+
+    shaders = [OpenGL.GL.shaders.compileShader(source, shader_type) for source, shader_type in sources]
+    program = glCreateProgram()
+    for shader in shaders:
+        glAttachShader(program, shader)
+    if cache_file is not None:
+        glProgramParameteri(program, GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL_TRUE)
+    glLinkProgram(program)
+    for shader in shaders:
+        glDetachShader(program, shader)
+        glDeleteShader(shader)
+
+    if glGetProgramiv(program, GL_LINK_STATUS) != GL_TRUE:
+        log = glGetProgramInfoLog(program)
+        glDeleteProgram(program)
+        raise RuntimeError(f"Link failure: {log.decode() if isinstance(log, bytes) else log}")
 
-# def compile_shader(vs, fs, cs):
-#     vert_shader = load_shader(vs)
-#     frag_shader = load_shader(fs)
-#     compute_shader = load_shader(cs)
+    if cache_file is not None:
+        save_program_binary(program, cache_file)
+    return program
 
-#     shader = OpenGL.GL.shaders.compileProgram(OpenGL.GL.shaders.compileShader(vert_shader, GL_VERTEX_SHADER),
-#                                               OpenGL.GL.shaders.compileShader(frag_shader, GL_FRAGMENT_SHADER),
-#                                               OpenGL.GL.shaders.compileShader(compute_shader, GL_COMPUTE_SHADER))
-#     return shader
+# Program from a binary saved by save_program_binary, None if the driver rejects it
+def load_program_binary(cache_file):
+    try:
+        data = np.fromfile(cache_file, dtype=np.uint8)
+    except OSError:
+        return None
+    if data.size <= 4:
+        return None
+
+    program = glCreateProgram()
+    glProgramBinary(program, int(data[:4].view(np.uint32)[0]), data[4:], data.size - 4)
+    if glGetProgramiv(program, GL_LINK_STATUS) != GL_TRUE:
+        glDeleteProgram(program)
+        return None
+    return program
+
+# Binary of a linked program: its format (uint32) followed by the driver data
+# Failing to write the cache (e.g. read-only directory) is not an error
+def save_program_binary(program, cache_file):
+    size = glGetProgramiv(program, GL_PROGRAM_BINARY_LENGTH)
+    if size <= 0:
+        return
+    length = np.zeros(1, dtype=np.int32)
+    binary_format = np.zeros(1, dtype=np.uint32)
+    binary = np.empty(size, dtype=np.uint8)
+    glGetProgramBinary(program, size, length, binary_format, binary)
+
+    try:
+        os.makedirs(SHADER_CACHE_DIR, exist_ok=True)
+        # written to a temporary file first, so an interrupted write leaves no truncated binary behind
+        with open(cache_file + ".tmp", "wb") as file:
+            file.write(binary_format.tobytes())
+            file.write(binary[:length[0]].tobytes())
+        os.replace(cache_file + ".tmp", cache_file)
+    except OSError:
+        pass
+
+
+# Upload function, numpy type and number of values of the uniform types, by GL type
+UNIFORM_TYPES = {
+    GL_FLOAT: (glProgramUniform1fv, np.float32, 1),
+    GL_FLOAT_VEC2: (glProgramUniform2fv, np.float32, 2),
+    GL_FLOAT_VEC3: (glProgramUniform3fv, np.float32, 3),
+    GL_FLOAT_VEC4: (glProgramUniform4fv, np.float32, 4),
+    GL_INT: (glProgramUniform1iv, np.int32, 1),
+    GL_INT_VEC2: (glProgramUniform2iv, np.int32, 2),
+    GL_INT_VEC3: (glProgramUniform3iv, np.int32, 3),
+    GL_INT_VEC4: (glProgramUniform4iv, np.int32, 4),
+    GL_UNSIGNED_INT: (glProgramUniform1uiv, np.uint32, 1),
+    GL_UNSIGNED_INT_VEC2: (glProgramUniform2uiv, np.uint32, 2),
+    GL_UNSIGNED_INT_VEC3: (glProgramUniform3uiv, np.uint32, 3),
+    GL_UNSIGNED_INT_VEC4: (glProgramUniform4uiv, np.uint32, 4),
+    GL_BOOL: (glProgramUniform1iv, np.int32, 1),
+    GL_BOOL_VEC2: (glProgramUniform2iv, np.int32, 2),
+    GL_BOOL_VEC3: (glProgramUniform3iv, np.int32, 3),
+    GL_BOOL_VEC4: (glProgramUniform4iv, np.int32, 4),
+    GL_SAMPLER_1D: (glProgramUniform1iv, np.int32, 1),
+    GL_SAMPLER_2D: (glProgramUniform1iv, np.int32, 1),
+    GL_SAMPLER_3D: (glProgramUniform1iv, np.int32, 1),
+    GL_SAMPLER_CUBE: (glProgramUniform1iv, np.int32, 1),
+    GL_SAMPLER_2D_ARRAY: (glProgramUniform1iv, np.int32, 1),
+    GL_SAMPLER_2D_SHADOW: (glProgramUniform1iv, np.int32, 1),
+    GL_SAMPLER_BUFFER: (glProgramUniform1iv, np.int32, 1),
+    GL_INT_SAMPLER_2D: (glProgramUniform1iv, np.int32, 1),
+    GL_UNSIGNED_INT_SAMPLER_2D: (glProgramUniform1iv, np.int32, 1),
+    GL_IMAGE_2D: (glProgramUniform1iv, np.int32, 1),
+    GL_IMAGE_3D: (glProgramUniform1iv, np.int32, 1),
+    GL_IMAGE_CUBE: (glProgramUniform1iv, np.int32, 1),
+    GL_IMAGE_2D_ARRAY: (glProgramUniform1iv, np.int32, 1),
+}
+
+MATRIX_UNIFORM_TYPES = {
+    GL_FLOAT_MAT2: (glProgramUniformMatrix2fv, np.float32, 4),
+    GL_FLOAT_MAT3: (glProgramUniformMatrix3fv, np.float32, 9),
+    GL_FLOAT_MAT4: (glProgramUniformMatrix4fv, np.float32, 16),
+}
+
+
+class Uniform:
+    def __init__(self, program, location, gl_type):
+        '''
+        Typed setter of one active uniform.
+        Values are uploaded with glProgramUniform*, so the program does not need to be bound,
+        and only when their bytes differ from the last upload.
+        '''
+        self.program = program
+        self.location = location
+        self.gl_type = gl_type
+        self.matrix = gl_type in MATRIX_UNIFORM_TYPES
+        self.setter, self.dtype, self.n_components = MATRIX_UNIFORM_TYPES.get(gl_type) or UNIFORM_TYPES.get(gl_type, (None, None, None))
+        self.last = None
+        self.value = None
+
+    def set(self, value):
+        self.value = value
+        if self.setter is None:
+            # uncommon uniform type, fall back to choosing the upload from the python value.
+            # set_uniform needs the program in use, the program bound by the caller is restored after
+            current_program = glGetIntegerv(GL_CURRENT_PROGRAM)
+            glUseProgram(self.program)
+            set_uniform(self.location, value)
+            glUseProgram(current_program)
+            return
+
+        data = np.ascontiguousarray(value, dtype=self.dtype).ravel()
+        data_bytes = data.tobytes()
+        if data_bytes == self.last:
+            return
+        self.last = data_bytes
+
+        count = max(data.size // self.n_components, 1)
+        if self.matrix:
+            self.setter(self.program, self.location, count, GL_FALSE, data)
+        else:
+            self.setter(self.program, self.location, count, data)
+
+
+# Upload a uniform of the program in use, choosing the glUniform function from the python value
+def set_uniform(location, value):
+    if isinstance(value, (int, np.integer)):
+        glUniform1i(location, value)
+    elif isinstance(value, (float, np.floating)):
+        glUniform1f(location, value)
+    # for bool
+    elif isinstance(value, (bool, np.bool_)):
+        glUniform1i(location, value)
+    elif isinstance(value, (tuple, list)):
+        if len(value) == 3:
+            glUniform3fv(location, 1, value)
+        elif len(value) == 4:
+            glUniform4fv(location, 1, value)
+    elif isinstance(value, (np.ndarray, np.generic)):
+        if value.shape == (4, 4):
+            glUniformMatrix4fv(location, 1, GL_FALSE, value)
+        elif value.shape == (3, 3):
+            glUniformMatrix3fv(location, 1, GL_FALSE, value)
+        elif value.shape == (4,):
+            glUniform4fv(location, 1, value)
+        elif value.shape == (3,):
+            glUniform3fv(location, 1, value)
+        elif value.shape == (2,):
+            glUniform2fv(location, 1, value)
+        elif value.shape == (1,):
+            glUniform1fv(location, 1, value)
+        else:
+            raise ValueError(f"Unsupported matrix shape: {value.shape}")
+    else:
+        raise ValueError(f"Unsupported value type: {type(value)}")
+        # Add more cases for different types of matrices if needed
+    # Add more cases for different uniform types if needed
 
 
 class ShaderProgram:
     def __init__(self, vs, fs):
-        self.shader = compile_shader(vs, fs)
+        self.stages = ((vs, GL_VERTEX_SHADER), (fs, GL_FRAGMENT_SHADER))
+        sources, self.files = read_stages(self.stages)
+        self.shader = build_program(sources)
+        self.uniforms = get_active_uniforms(self.shader)
+
+    def reload(self, sources=None):
+        '''
+        Relink the program from its shader files (or the already read sources), keeping the uniform values set.
+        The program is replaced only if the new one links, a compile error is printed and the old program kept.
+        Has to be called from the thread owning the GL context.
+        :return: True if the program was replaced
+        '''
+        if sources is None:
+            sources, self.files = read_stages(self.stages)
+        try:
+            shader = build_program(sources)
+        except RuntimeError as error:
+            print(f"Reloading {self.stages[-1][0]} failed:\n{error}")
+            return False
+
+        old_shader, old_uniforms = self.shader, self.uniforms
+        self.shader = shader
+        self.uniforms = get_active_uniforms(shader)
+        for name, uniform in self.uniforms.items():
+            old_uniform = old_uniforms.get(name)
+            if old_uniform is not None and old_uniform.value is not None and old_uniform.gl_type == uniform.gl_type:
+                uniform.set(old_uniform.value)
+        glDeleteProgram(old_shader)
+        return True
 
     def __getitem__(self, key):
-        return glGetUniformLocation(self.shader, key)
+        uniform = self.uniforms.get(key)
+        return uniform.location if uniform is not None else -1
 
     def __setitem__(self, key, value):
+        # uniforms that are not used by the shaders are optimized out and ignored, like location -1
+        uniform = self.uniforms.get(key)
+        if uniform is not None:
+            uniform.set(value)
+
+
+class ComputeProgram(ShaderProgram):
+    def __init__(self, cs):
+        '''
+        Compute shader program, with the same uniform access as ShaderProgram:
+            computeProgram["sample_index"] = 3
+            computeProgram.dispatch(width, height)
+
+        The work group size is read from the layout(local_size_x, local_size_y) of the shader,
+        dispatch launches enough groups to cover width x height invocations.
+        '''
+        self.stages = ((cs, GL_COMPUTE_SHADER),)
+        sources, self.files = read_stages(self.stages)
+        self.shader = build_program(sources)
+        self.uniforms = get_active_uniforms(self.shader)
+        self.read_local_size()
+
+    def reload(self, sources=None):
+        if not super().reload(sources):
+            return False
+        self.read_local_size()
+        return True
+
+    def read_local_size(self):
+        self.local_size = np.zeros(3, dtype=np.int32)
+        glGetProgramiv(self.shader, GL_COMPUTE_WORK_GROUP_SIZE, self.local_size)
+
+    def dispatch(self, width, height, depth=1):
         glUseProgram(self.shader)
-        location = self[key]
-
-        if location != -1:
-            if isinstance(value, (int, np.integer)):
-                glUniform1i(location, value)
-            elif isinstance(value, (float, np.floating)):
-                glUniform1f(location, value)
-            # for bool
-            elif isinstance(value, (bool, np.bool_)):
-                glUniform1i(location, value)
-            elif isinstance(value, (tuple, list)):
-                if len(value) == 3:
-                    glUniform3fv(location, 1, value)
-                elif len(value) == 4:
-                    glUniform4fv(location, 1, value)
-            elif isinstance(value, (np.ndarray, np.generic)):
-                if value.shape == (4, 4):
-                    glUniformMatrix4fv(location, 1, GL_FALSE, value)
-                elif value.shape == (3, 3):
-                    glUniformMatrix3fv(location, 1, GL_FALSE, value)
-                elif value.shape == (4,):
-                    glUniform4fv(location, 1, value)
-                elif value.shape == (3,):
-                    glUniform3fv(location, 1, value)
-                elif value.shape == (2,):
-                    glUniform2fv(location, 1, value)
-                elif value.shape == (1,):
-                    glUniform1fv(location, 1, value)
-                else:
-                    raise ValueError(f"Unsupported matrix shape: {value.shape}")
-            else:
-                raise ValueError(f"Unsupported value type: {type(value)}")
-                # Add more cases for different types of matrices if needed
-            # Add more cases for different uniform types if needed
+        glDispatchCompute(-(-width // int(self.local_size[0])),
+                          -(-height // int(self.local_size[1])),
+                          -(-depth // int(self.local_size[2])))
+        # Make the written images visible to the next dispatches and to framebuffer reads (blits)
+        glMemoryBarrier(GL_SHADER_IMAGE_ACCESS_BARRIER_BIT | GL_FRAMEBUFFER_BARRIER_BIT | GL_TEXTURE_FETCH_BARRIER_BIT)
+
+
+class ShaderWatcher:
+    def __init__(self, programs, interval=0.5):
+        '''
+        Reloads programs when one of their shader files (includes too) is saved, without restarting:
+
+            watcher = ShaderWatcher([shaderProgram, shaderProgram_sphere])
+            while running:
+                watcher.poll()
+                ...
+            watcher.close()
+
+        A background thread checks the modification times of the files every interval seconds and reads and
+        preprocesses the changed sources. GL calls can only be made on the thread owning the context, so the
+        compile and link are done by poll() on that thread, and the old program is kept until the new one links.
+
+        :param programs: ShaderProgram or ComputeProgram to watch
+        :param interval: seconds between two checks of the files
+        '''
+        self.programs = list(programs)
+        self.interval = interval
+        self.mtimes = {id(program): self.file_mtimes(program.files) for program in self.programs}
+        self.pending = {}                       # id(program) -> (program, sources) read by the thread
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.watch, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def file_mtimes(files):
+        mtimes = {}
+        for shader_file in files:
+            try:
+                mtimes[shader_file] = os.stat(shader_file).st_mtime_ns
+            except OSError:
+                mtimes[shader_file] = None
+        return mtimes
+
+    def watch(self):
+        while not self.stop.wait(self.interval):
+            for program in self.programs:
+                if self.file_mtimes(self.mtimes[id(program)]) == self.mtimes[id(program)]:
+                    continue
+                try:
+                    sources, files = read_stages(program.stages)
+                except OSError:
+                    continue    # file being written or replaced, checked again next time
+                # the includes may have changed as well
+                self.mtimes[id(program)] = self.file_mtimes(files)
+                with self.lock:
+                    self.pending[id(program)] = (program, sources, files)
+
+    def poll(self):
+        '''
+        Relink the programs whose files changed since the last call, on the calling (GL) thread.
+        :return: the reloaded programs
+        '''
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        reloaded = []
+        for program, sources, files in pending.values():
+            program.files = files
+            if program.reload(sources):
+                reloaded.append(program)
+        return reloaded
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+
+
+# Introspects the active uniforms of a linked program once, returns a dict of Uniform by name
+def get_active_uniforms(program):
+    uniforms = {}
+    for index in range(glGetProgramiv(program, GL_ACTIVE_UNIFORMS)):
+        name, size, gl_type = glGetActiveUniform(program, index)
+        name = name.decode() if isinstance(name, bytes) else name
+        location = glGetUniformLocation(program, name)
+        if location == -1:
+            continue    # uniform of a uniform block
+
+        uniform = Uniform(program, location, gl_type)
+        uniforms[name] = uniform
+        # arrays are reported as "name[0]", they can be set by "name" as well
+        if name.endswith("[0]"):
+            uniforms[name[:-3]] = uniform
+
+    return uniforms
 
 
 if __name__ == '__main__':
@@ -89,19 +426,21 @@ if __name__ == '__main__':
         shaderProgram["model"] = model_mat
         shaderProgram["intensity"] = 0.5
         
-    Every time you set a uniform variable, the shader program will be activated and the uniform variable will be set using the following three steps:
-        1. glUseProgram(shader)
-        2. location = glGetUniformLocation(shader, "uniform_name")
-        3. glUniform*(location, 1, value)
-        
+    The active uniforms of the program are looked up once when it is created (glGetActiveUniform),
+    with their location and type. Setting a uniform variable then only takes one call:
+        glProgramUniform*(shader, location, 1, value)
+
+    and it is skipped when the value is the same as the last one set. The program does not need to be in use.
+
+    Linked programs are cached in SHADER_CACHE_DIR (glGetProgramBinary), later launches load them instead of
+    compiling the shaders again. ShaderWatcher relinks programs when their files are edited.
+
     The line
-        shaderProgram["scale"] = (2, 2, 2) 
-    
+        shaderProgram["scale"] = (2, 2, 2)
+
     is equivalent to:
-    
-        glUseProgram(shader)
-        location = glGetUniformLocation(shader, "scale")
-        glUniform3fv(location, 1, (2, 2, 2))
+
+        glProgramUniform3fv(shader, location_of_scale, 1, (2, 2, 2))
         
         
     '''
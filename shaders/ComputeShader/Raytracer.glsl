@@ -1,63 +1,34 @@
-#version 430
+#version 430 core
 
-struct Sphere {
-    vec3 center;
-    float radius;
-    vec3 color;
-};
-
-struct Camera {
-    vec3 position;
-    vec3 forwards;
-    vec3 right;
-    vec3 up;
-};
-
-struct Ray {
-    vec3 origin;
-    vec3 direction;
-};
-
-layout(local_size_x = 1, local_size_y = 1) in;
+// One invocation per pixel, in 8x8 tiles. ComputeProgram reads the size back to dispatch enough groups
+layout(local_size_x = 8, local_size_y = 8) in;
 layout(rgba32f, binding = 0) uniform image2D image_output;
 
+#include "../common/raytracing.glsl"
 
 void main() {
     ivec2 pixel_coords = ivec2(gl_GlobalInvocationID.xy);
     ivec2 screen_size = imageSize(image_output);
-    float horizontalCoefficient = ((float(pixel_coords.x) * 2 - screen_size.x) / screen_size.x);
-    float verticalCoefficient = ((float(pixel_coords.y) * 2 - screen_size.x) / screen_size.y);
-
-    vec3 pixel = vec3(0.0, 0.0, 0.0);
-
-    Camera camera;
-    camera.position = vec3(0.0);
-    camera.forwards = vec3(1.0, 0.0, 0.0);
-    camera.right = vec3(0.0, 1.0, 0.0);
-    camera.up = vec3(0.0, 0.0, 1.0);
-
-    Sphere sphere;
-    sphere.center = vec3(3.0, 0.0, 0.0);
-    sphere.radius = 1.0;
-    sphere.color = vec3(1.0, 0.3, 0.7);
+    if (pixel_coords.x >= screen_size.x || pixel_coords.y >= screen_size.y)
+        return;
 
-    Ray ray;
-    ray.origin = camera.position;
-    ray.direction = camera.forwards + horizontalCoefficient * camera.right + verticalCoefficient * camera.up;
-
-    float a = dot(ray.direction, ray.direction);
-    float b = 2.0 * dot(ray.direction, ray.origin - sphere.center);
-    float c = dot(ray.origin - sphere.center, ray.origin -sphere.center) - sphere.radius * sphere.radius;
-    float discrimanent = b * b - 4.0 * a * c;
-
-    if(discrimanent > 0)
+    // Center of the pixel, like gl_FragCoord in the fragment path
+    vec2 pixel = vec2(pixel_coords) + 0.5;
+    if (progressive)
     {
-        pixel += sphere.color;
+        // R2 sequence offset so every sample gets different random numbers
+        sample_seed = pixel / resolution + fract(float(sample_index) * vec2(0.7548776662, 0.5698402910));
+        pixel += vec2(rand(sample_seed), rand(sample_seed.yx)) - 0.5;
     }
 
+    vec3 color = pixelColor(pixel);
 
+    // Running mean with the samples accumulated so far, kept in the output image itself
+    if (progressive && sample_index > 0)
+    {
+        vec3 previous = imageLoad(image_output, pixel_coords).rgb;
+        color = mix(previous, color, 1.0 / float(sample_index + 1));
+    }
 
-
-
-    imageStore(image_output, pixel_coords, vec4(pixel, 1.0));
+    imageStore(image_output, pixel_coords, vec4(color, 1.0));
 }
@@ -0,0 +1,19 @@
+// Per-frame camera and light state, shared by all the programs (graphicsLibrary.FrameUniforms, std140 layout of FRAME_DTYPE)
+// Included by every shader that reads it, so the block is declared in this file only
+#ifndef FRAME_GLSL
+#define FRAME_GLSL
+
+layout (std140, binding = 0) uniform Frame{
+    mat4 inViewProjectionMatrix;
+    vec4 light_pos;
+    vec3 eye_pos;
+    float fov;
+    vec3 cameraU;
+    float ambient_intensity;
+    vec3 cameraV;
+    vec3 cameraW;
+    vec3 lightColor;
+    vec2 resolution;
+};
+
+#endif
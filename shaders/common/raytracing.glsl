@@ -0,0 +1,373 @@
+// Raytracing of the scene buffers, shared by the fragment (shaders/sphere/frag.glsl) and compute
+// (shaders/ComputeShader/Raytracer.glsl) paths. Included by shaderLoaderV3, pixelColor(pixel) is the entry point.
+// shaders/gbuffer/frag.glsl caches the first hits, cachedPixelColor then shades them without tracing the camera rays.
+
+#define PI 3.14159
+#define EPSILON 1e-5
+#define INFINITY 1e5
+#define MAX_BOUNCES 10
+#define MIN_REFLECTION 1e-3     // rays stop bouncing once their remaining contribution is below this
+#define MIN_PREFILTERED_ROUGHNESS 0.05      // smoother reflections read the full resolution skybox
+
+#include "frame.glsl"
+//uniform vec3 cameraEye;
+
+uniform samplerCube cubeMapTex;
+// Skybox convolved with the GGX lobe, level k for roughness k / (levels - 1) (see cubemapBaker.py)
+uniform samplerCube prefilteredTex;
+uniform bool use_prefiltered;
+
+//uniform vec3 minBound;
+//uniform vec3 maxBound;
+
+// Progressive accumulation
+uniform bool progressive;           // jitter the samples and blend them with the previous ones
+uniform int sample_index;           // number of samples already accumulated
+
+vec2 sample_seed;
+
+// Scene objects, uploaded from sceneData.Scene (std430 layouts must match the dtypes defined there)
+struct Material{
+      vec3 color;
+      float metallic;
+      float roughness;
+      int mat_type;
+};
+
+struct Sphere{
+      vec3 center;
+      float radius;
+      int material;
+};
+
+struct Plane{
+      vec3 center;
+      int material;
+      vec3 size;
+      vec3 normal;
+};
+
+layout(std430, binding = 1) readonly buffer MaterialBuffer{
+      Material materials[];
+};
+
+layout(std430, binding = 2) readonly buffer SphereBuffer{
+      Sphere spheres[];
+};
+
+layout(std430, binding = 3) readonly buffer PlaneBuffer{
+      Plane planes[];
+};
+
+struct Hit{
+    float d;
+    vec3 point;
+    vec3 normal;
+};
+
+struct Ray{
+    vec3 direction;
+    vec3 origin;
+    float tMin, tMax;
+};
+
+struct AABB {
+      vec3 minP;
+      vec3 maxP;
+};
+
+vec3 pointOnRay(in Ray ray, float t){
+      return (ray.origin + t*ray.direction);
+}
+
+float rand(vec2 seed) {
+    // Simple pseudo-random number generator
+    return fract(sin(dot(seed, vec2(12.9898, 78.233))) * 43758.5453);
+}
+
+// Taken from Raytracing AABB implementation from the professor's GitHub
+Ray getRay(vec2 pixel)
+{
+      Ray ray;
+      ray.origin = eye_pos;
+      float height = 2.*tan(fov/2.);
+      float aspect = resolution.x/resolution.y;
+      float width = height * aspect;
+      vec2 windowDim = vec2(width, height);
+      vec2 pixelSize = windowDim / resolution;
+      vec2 delta = -0.5 * windowDim + pixel * pixelSize;
+      ray.direction = -cameraW + cameraV * delta.y + cameraU * delta.x;
+      ray.tMin = 0.;
+      ray.tMax = INFINITY;
+      return ray;
+}
+
+// Distance along the ray to a sphere, -1 if the ray's line misses it
+float sphereDistance(Sphere sphere, Ray ray)
+{
+      vec3 magnitude = ray.origin - sphere.center;
+      float a = dot(ray.direction, ray.direction);
+      float b = 2 * dot(ray.direction, magnitude);
+      float c = dot(magnitude, magnitude) - sphere.radius * sphere.radius;
+      float delta = b * b - (4.0 * a * c);
+      if (delta > 0)
+      {
+            float t1 = (-b + sqrt(delta)) / (2.0 * a);
+            float t2 = (-b - sqrt(delta)) / (2.0 * a);
+            return min(t1, t2);
+      }
+
+      return -1.0;
+}
+
+// Determines the hit point of a raycast-sphere intersection
+Hit sphereIntersectPoint(Sphere sphere, Ray ray)
+{
+      Hit hit = Hit(-1.0, vec3(0.0), vec3(0));
+      hit.d = sphereDistance(sphere, ray);
+      if (hit.d != -1.0)
+      {
+            hit.point = ray.origin + hit.d * ray.direction;
+            hit.normal = normalize(hit.point - sphere.center);
+      }
+
+      return hit;
+}
+
+// Determines the hit point of a raycast-plane intersection
+Hit planeIntersectPoint(Plane plane, Ray ray)
+{
+      Hit hit = Hit(-1.0, vec3(0.0), vec3(0));
+
+      if (ray.direction.y != 0.0)
+      {
+            hit.d = (plane.center.y - ray.origin.y) / ray.direction.y;
+            hit.point = ray.origin + hit.d * ray.direction;
+            hit.normal = plane.normal;
+
+            vec3 relative_point = abs(hit.point - plane.center);
+            if (relative_point.x > plane.size.x || relative_point.z > plane.size.z)
+                  hit.d = -1.0;
+      }
+
+      return hit;
+}
+
+// Closest hit of the ray among all the planes and spheres, the only intersection query of a bounce.
+// Sphere distances are compared first, the hit point and normal are only computed for the closest one.
+// hit.d is INFINITY when nothing is hit, hit_material is the index of the material in materials[]
+Hit closestHit(Ray ray, out int hit_material, out bool hit_ground)
+{
+      Hit closest = Hit(INFINITY, vec3(0.0), vec3(0.0));
+      hit_ground = false;
+
+      for (int j = 0; j < planes.length(); j++)
+      {
+            Hit hit_plane = planeIntersectPoint(planes[j], ray);
+            if (hit_plane.d > 0.0 && hit_plane.d < closest.d)
+            {
+                  closest = hit_plane;
+                  hit_material = planes[j].material;
+                  hit_ground = true;
+            }
+      }
+
+      int closest_sphere = -1;
+      for (int j = 0; j < spheres.length(); j++)
+      {
+            float d = sphereDistance(spheres[j], ray);
+            if (d >= 0.0 && d < closest.d)
+            {
+                  closest.d = d;
+                  closest_sphere = j;
+            }
+      }
+
+      if (closest_sphere >= 0)
+      {
+            closest = sphereIntersectPoint(spheres[closest_sphere], ray);
+            hit_material = spheres[closest_sphere].material;
+            hit_ground = false;
+      }
+
+      return closest;
+}
+
+// Shadow query: true as soon as one sphere is found in front of the ray, the closest one does not matter
+bool anySphereHit(Ray ray)
+{
+      for (int j = 0; j < spheres.length(); j++)
+      {
+            if (sphereDistance(spheres[j], ray) >= 0.0)
+                  return true;
+      }
+
+      return false;
+}
+
+//The following 3 Funcitons are necessary for PBR feature
+vec3 computeDiffuse(Material mat, vec3 N, vec3 L, vec3 F){
+
+      vec3 ks = F;
+      vec3 Kd = 1-ks;
+
+      return  Kd * (1-mat.metallic) * mat.color * max(dot(N, L), 0);
+}
+
+float geometric_attenuation(Material mat, vec3 N, vec3 V, vec3 L)
+{
+      float alpha = pow(mat.roughness,2);
+      float k = (alpha) / 2;
+
+      // Masking Term
+      float Gv = clamp(dot(V, N), 0., 1.) / (clamp(dot(N, V), 0., 1.) * (1-k) + k);
+      // Shadowing Term
+      float Gl = clamp(dot(L, N), 0., 1.) / (clamp(dot(L, N), 0., 1.) * (1-k) + k);
+      
+      return Gv * Gl;
+}
+
+float microfacet_distribution(Material mat, vec3 N, vec3 H)
+{
+      float alpha = pow(mat.roughness,2);
+      return pow(alpha, 2) / (PI * pow((pow(max(dot(H, N),0),2) * (pow(alpha,2) - 1) + 1),2));
+}
+
+
+vec3 computePBR(Material mat, Ray ray, Hit hit)
+{
+      vec3 N = normalize(hit.normal);
+      vec3 L = normalize(light_pos.xyz - hit.point);
+      vec3 V = normalize(eye_pos-hit.point);
+      vec3 H = normalize(L + V);
+
+      vec3 F0_metal = vec3(0.0);
+      vec3 F0_dielectric = vec3(.04,.04,.04);
+
+      // Metals
+      if(mat.mat_type == 1)       F0_metal = vec3(0.56,0.57,0.58);
+      else if (mat.mat_type == 2) F0_metal = vec3(0.95,0.64,0.54);
+      else if (mat.mat_type == 3) F0_metal = vec3(1.00,0.71,0.29);
+      else if (mat.mat_type == 4) F0_metal = vec3(0.91,0.92,0.92);
+      else if (mat.mat_type == 5) F0_metal = vec3(0.95,0.93,0.88);
+
+      vec3 material_color = F0_metal;
+      vec3 F0 = mix(F0_dielectric,F0_metal,mat.metallic);
+
+      vec3 F = F0 + (1 - F0) * pow( (1-clamp(dot(H,V), 0, 1)), 5 );
+
+      float G = geometric_attenuation(mat, N,V,L);
+
+      float D = microfacet_distribution(mat, N,H);
+
+      vec3 microfacet = F * D * G;
+
+      vec3 diffuseColor = computeDiffuse(mat, N, L, F);
+
+      vec3 ambientColor = ambient_intensity * mat.color;
+
+      vec3 specularColor = microfacet * lightColor;
+
+      return vec3(ambientColor + specularColor + diffuseColor);
+}
+
+// Color of a camera ray whose first hit is already known, the following bounces are traced
+vec3 shadeHit(Ray ray, Hit closest_object, int material_index, bool hit_ground)
+{
+      float reflection = 1.0;
+
+      vec3 color = vec3(0.0);
+      vec3 final_color = vec3(0.0);
+      float shadow_factor = 1.0;
+      float last_roughness = 0.0;         // roughness of the surface the ray was reflected by
+
+      // Number of bounces, until the ray escapes or its contribution is negligible
+      for (int i = 0; i < MAX_BOUNCES && reflection > MIN_REFLECTION; i++)
+      {
+            if (i > 0)
+                  closest_object = closestHit(ray, material_index, hit_ground);
+
+            if (closest_object.d == INFINITY)
+            {
+                  // Rough reflections read the prefiltered levels, which average the whole reflection lobe.
+                  // Progressive samples already scatter the rays over the lobe, they keep the sharp skybox
+                  if (use_prefiltered && !progressive && last_roughness > MIN_PREFILTERED_ROUGHNESS)
+                  {
+                        float lod = last_roughness * float(textureQueryLevels(prefilteredTex) - 1);
+                        color = textureLod(prefilteredTex, ray.direction, lod).rgb;
+                  }
+                  else
+                        color = texture(cubeMapTex, ray.direction).rgb;
+                  final_color += color * shadow_factor * reflection;
+                  break;
+            }
+            Material hit_material = materials[material_index];
+
+            // Slight delta added to hit point to avoid the sphere from hitting itself on next raycast
+            vec3 shifted_point = closest_object.point + closest_object.normal * 0.0001;
+
+            // If the closest object ended up being the ground
+            if (hit_ground)
+            {
+                  // Checking if the current spot on the plane is a shadowed area,
+                  // otherwise the ground keeps the color of the previous bounce
+                  Ray light_check;
+                  light_check.origin = shifted_point;
+                  light_check.direction = normalize(light_pos.xyz - shifted_point);
+                  if (anySphereHit(light_check))
+                  {
+                        shadow_factor = 0.5;
+                        color = vec3(0.0);
+                  }
+            }
+            // Sphere lighting and color
+            else
+            {
+                  color = computePBR(hit_material, ray, closest_object);
+            }
+
+            // Adding the color
+            final_color += color * reflection;
+            reflection *= (1 - hit_material.roughness);
+            last_roughness = hit_material.roughness;
+
+            // Setting up the next ray
+            ray.origin = shifted_point;
+            ray.direction = reflect(ray.direction, closest_object.normal);
+
+            // Progressive samples scatter rough reflections around the mirror direction,
+            // their mean converges to a glossy reflection
+            if (progressive)
+            {
+                  vec2 seed = sample_seed + float(i) * vec2(0.1031, 0.1030);
+                  vec3 jitter = vec3(rand(seed), rand(seed + 0.37), rand(seed + 0.71)) * 2.0 - 1.0;
+                  ray.direction = normalize(normalize(ray.direction) + hit_material.roughness * jitter);
+                  if (dot(ray.direction, closest_object.normal) < 0.0)
+                        ray.direction = reflect(ray.direction, closest_object.normal);
+            }
+      }
+
+      return final_color;
+}
+
+vec3 pixelColor(vec2 pixel)
+{
+      Ray ray = getRay(pixel);
+      int material_index;
+      bool hit_ground;
+      Hit first_hit = closestHit(ray, material_index, hit_ground);
+      return shadeHit(ray, first_hit, material_index, hit_ground);
+}
+
+// Same as pixelColor, with the first hit read from the G-buffer written by shaders/gbuffer/frag.glsl:
+//     position: xyz hit point, w 0 if the ray escaped, 1 for a sphere, 2 for the ground
+//     normal:   xyz normal, w index of the material
+// The camera ray is not traced again, only the shading, the shadow ray and the reflections depend on the light
+vec3 cachedPixelColor(vec2 pixel, vec4 position, vec4 normal)
+{
+      Ray ray = getRay(pixel);
+      Hit first_hit = Hit(INFINITY, position.xyz, normal.xyz);
+      if (position.w != 0.0)
+            first_hit.d = distance(ray.origin, position.xyz);
+      return shadeHit(ray, first_hit, int(normal.w), position.w == 2.0);
+}
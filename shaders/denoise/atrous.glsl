@@ -0,0 +1,74 @@
+#version 430 core
+
+// One iteration of the edge-aware a-trous wavelet filter of the denoiser (graphicsLibrary.Denoiser,
+// same as denoiser.atrous_iteration): a 5x5 B3 spline kernel with holes of step_size pixels, where each
+// neighbor is weighted down when its normal, depth, albedo or color differ from the center pixel
+out vec4 outColor;
+
+in vec3 fragNormal;
+in vec3 fragPosition;
+
+#include "../common/raytracing.glsl"
+
+uniform sampler2D color_input;          // rgb color, a number of frames accumulated by the temporal pass
+uniform sampler2D gbuffer_position;
+uniform sampler2D gbuffer_normal;
+uniform int step_size;
+uniform float sigma_color;              // divided by sqrt(number of frames), longer histories are less noisy
+uniform float sigma_normal;             // exponent of the normal dot product
+uniform float sigma_depth;              // relative to the depth of the center pixel
+uniform float sigma_albedo;
+
+const float KERNEL[5] = float[](1.0 / 16.0, 1.0 / 4.0, 3.0 / 8.0, 1.0 / 4.0, 1.0 / 16.0);
+
+vec3 albedo(vec4 position, vec4 normal)
+{
+      return position.w == 0.0 ? vec3(1.0) : materials[int(normal.w)].color;
+}
+
+void main()
+{
+      ivec2 texel = ivec2(gl_FragCoord.xy);
+      ivec2 size = textureSize(color_input, 0);
+      vec4 center = texelFetch(color_input, texel, 0);
+      vec4 position = texelFetch(gbuffer_position, texel, 0);
+
+      // the skybox is not noisy
+      if (position.w == 0.0)
+      {
+            outColor = center;
+            return;
+      }
+
+      vec3 normal = texelFetch(gbuffer_normal, texel, 0).xyz;
+      vec3 center_albedo = albedo(position, texelFetch(gbuffer_normal, texel, 0));
+      float depth = distance(eye_pos, position.xyz);
+      float color_sigma = sigma_color / sqrt(max(center.a, 1.0));
+
+      vec3 sum = vec3(0.0);
+      float weight_sum = 0.0;
+      for (int dy = -2; dy <= 2; dy++)
+      {
+            for (int dx = -2; dx <= 2; dx++)
+            {
+                  ivec2 q = clamp(texel + ivec2(dx, dy) * step_size, ivec2(0), size - 1);
+                  vec4 q_position = texelFetch(gbuffer_position, q, 0);
+                  if (q_position.w != position.w)
+                        continue;
+                  vec4 q_normal = texelFetch(gbuffer_normal, q, 0);
+                  vec3 q_color = texelFetch(color_input, q, 0).rgb;
+
+                  vec3 color_difference = q_color - center.rgb;
+                  vec3 albedo_difference = albedo(q_position, q_normal) - center_albedo;
+                  float weight = KERNEL[dx + 2] * KERNEL[dy + 2]
+                               * pow(max(dot(normal, q_normal.xyz), 0.0), sigma_normal)
+                               * exp(-abs(distance(eye_pos, q_position.xyz) - depth) / (sigma_depth * depth + 1e-4))
+                               * exp(-dot(albedo_difference, albedo_difference) / (sigma_albedo * sigma_albedo))
+                               * exp(-dot(color_difference, color_difference) / (color_sigma * color_sigma));
+                  sum += q_color * weight;
+                  weight_sum += weight;
+            }
+      }
+
+      outColor = vec4(sum / weight_sum, center.a);
+}
@@ -0,0 +1,51 @@
+#version 430 core
+
+// Temporal accumulation of the denoiser (graphicsLibrary.Denoiser, same as denoiser.reproject):
+// every pixel finds where its first hit was in the previous frame and blends its new sample with the
+// history found there, as long as the history saw the same surface
+layout (location = 0) out vec4 outHistory;      // rgb running mean, a number of frames in it
+layout (location = 1) out vec4 outPosition;     // first hit of the pixel, compared against by the next frame
+
+in vec3 fragNormal;
+in vec3 fragPosition;
+
+#include "../common/raytracing.glsl"
+
+uniform sampler2D current_color;        // new 1 sample per pixel frame
+uniform sampler2D gbuffer_position;     // xyz hit point, w hit type (see shaders/gbuffer/frag.glsl)
+uniform sampler2D history_color;
+uniform sampler2D history_position;
+uniform mat4 previous_view_projection;
+uniform bool history_valid;
+uniform float max_history;              // the new sample gets at least a weight of 1 / max_history
+uniform float position_tolerance;       // relative to the distance to the eye
+
+void main()
+{
+      ivec2 texel = ivec2(gl_FragCoord.xy);
+      // clamped to the displayed range like in denoiser.Denoiser, so single bright samples do not stay in the history
+      vec3 color = clamp(texelFetch(current_color, texel, 0).rgb, 0.0, 1.0);
+      vec4 position = texelFetch(gbuffer_position, texel, 0);
+      outPosition = position;
+
+      float n_frames = 1.0;
+      if (history_valid && position.w != 0.0)
+      {
+            vec4 clip = previous_view_projection * vec4(position.xyz, 1.0);
+            vec2 uv = clip.xy / clip.w * 0.5 + 0.5;
+            if (clip.w > 0.0 && all(greaterThanEqual(uv, vec2(0.0))) && all(lessThan(uv, vec2(1.0))))
+            {
+                  ivec2 previous_texel = ivec2(uv * vec2(textureSize(history_color, 0)));
+                  vec4 previous_position = texelFetch(history_position, previous_texel, 0);
+                  float tolerance = position_tolerance * max(1.0, distance(eye_pos, position.xyz));
+                  if (previous_position.w == position.w && distance(previous_position.xyz, position.xyz) < tolerance)
+                  {
+                        vec4 history = texelFetch(history_color, previous_texel, 0);
+                        n_frames = min(history.a + 1.0, max_history);
+                        color = mix(history.rgb, color, 1.0 / n_frames);
+                  }
+            }
+      }
+
+      outHistory = vec4(color, n_frames);
+}
@@ -0,0 +1,23 @@
+#version 430 core
+
+// First hit of the camera ray of every pixel (graphicsLibrary.GBuffer), shaded later by cachedPixelColor
+layout (location = 0) out vec4 hitPosition;     // xyz hit point, w 0 if the ray escaped, 1 for a sphere, 2 for the ground
+layout (location = 1) out vec4 hitNormal;       // xyz normal, w index of the material
+
+in vec3 fragNormal;
+in vec3 fragPosition;
+
+#include "../common/raytracing.glsl"
+
+void main()
+{
+      int material_index = 0;
+      bool hit_ground;
+      Hit hit = closestHit(getRay(gl_FragCoord.xy), material_index, hit_ground);
+
+      if (hit.d == INFINITY)
+            hitPosition = vec4(0.0);
+      else
+            hitPosition = vec4(hit.point, hit_ground ? 2.0 : 1.0);
+      hitNormal = vec4(hit.normal, float(material_index));
+}
@@ -0,0 +1,24 @@
+#version 420 core
+
+layout (location = 0) in vec3 position;
+layout (location = 1) in vec2 uv;
+layout (location = 2) in vec3 normal;
+// Model matrix of the instance, one vec4 column per location 3 to 6 (graphicsLibrary.InstancedMesh)
+layout (location = 3) in mat4 instance_matrix;
+
+out vec3 fragNormal;
+out vec3 fragPosition;
+
+uniform mat4 view_matrix;
+uniform mat4 projection_matrix;
+
+void main(){
+    // Same as shaders/obj/vert.glsl, with the model matrix of the instance instead of the model_matrix uniform
+    vec4 pos = instance_matrix * vec4(position, 1.0);
+    fragPosition = pos.xyz;
+    gl_Position = projection_matrix * view_matrix * pos;
+
+    mat4 normal_matrix = transpose(inverse(instance_matrix));
+    vec3 new_normal = (normal_matrix*vec4(normal,0)).xyz;
+    fragNormal = normalize(new_normal);
+}
@@ -12,24 +12,17 @@ in vec3 fragPosition;
 uniform vec3 center;
 uniform float radius;
 
+#include "../common/frame.glsl"
+
 //PBR Uniforms
-uniform vec4 light_pos;
-uniform vec3 eye_pos;
-uniform float ambient_intensity;
 uniform float roughness;
 uniform float metallic;
 uniform int mat_type;
-uniform vec3 lightColor;
 uniform vec3 material_color;
 // Raytracing Uniforms
 
 uniform vec3 Background;
-uniform vec2 resolution;
-uniform vec3 cameraU;
-uniform vec3 cameraV;
-uniform vec3 cameraW;
 uniform vec3 cameraEye;
-uniform float fov;
 
 uniform vec3 minBound;
 uniform vec3 maxBound;
@@ -1,7 +1,8 @@
 #version 430 core
 
 layout (binding = 0) uniform samplerCube cubeMapTex;
-uniform mat4 inViewProjectionMatrix;
+
+#include "../common/frame.glsl"
 
 in vec2 clipboxPosition;
 out vec4 outColor;
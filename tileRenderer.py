@@ -0,0 +1,137 @@
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import time
+
+import numpy as np
+
+import cpuRaytracer
+import sceneData
+
+# Worker state, set once per process by _init_worker
+_worker = {}
+
+
+# Splits the image into tiles of tile_size x tile_size pixels, (x0, y0, x1, y1) each
+def make_tiles(width, height, tile_size):
+    tiles = []
+    for y0 in range(0, height, tile_size):
+        for x0 in range(0, width, tile_size):
+            tiles.append((x0, y0, min(x0 + tile_size, width), min(y0 + tile_size, height)))
+    return tiles
+
+
+# Copies an array into a new shared memory block so every worker can map it without pickling
+def share_array(array):
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    shared[...] = array
+    return shm
+
+
+def _init_worker(framebuffer_name, framebuffer_shape, cubemap_name, cubemap_shape,
+                 scene, camera, light, tiles, next_tile, n_bounces):
+    framebuffer_shm = shared_memory.SharedMemory(name=framebuffer_name)
+    _worker["framebuffer_shm"] = framebuffer_shm
+    _worker["framebuffer"] = np.ndarray(framebuffer_shape, dtype=np.float32, buffer=framebuffer_shm.buf)
+
+    _worker["cubemap"] = None
+    if cubemap_name is not None:
+        cubemap_shm = shared_memory.SharedMemory(name=cubemap_name)
+        _worker["cubemap_shm"] = cubemap_shm
+        _worker["cubemap"] = np.ndarray(cubemap_shape, dtype=np.float32, buffer=cubemap_shm.buf)
+
+    _worker["scene"] = scene
+    _worker["camera"] = camera
+    _worker["light"] = light
+    _worker["tiles"] = tiles
+    _worker["next_tile"] = next_tile
+    _worker["n_bounces"] = n_bounces
+
+
+# Each worker keeps taking the next unrendered tile from the shared counter until none are left,
+# so workers stuck on expensive tiles are balanced out by the others taking more of the cheap ones
+def _render_tiles(_):
+    tiles = _worker["tiles"]
+    next_tile = _worker["next_tile"]
+    framebuffer = _worker["framebuffer"]
+
+    n_rendered = 0
+    while True:
+        with next_tile.get_lock():
+            index = next_tile.value
+            next_tile.value += 1
+        if index >= len(tiles):
+            break
+
+        x0, y0, x1, y1 = tiles[index]
+        framebuffer[y0:y1, x0:x1] = cpuRaytracer.render(_worker["scene"], _worker["camera"], _worker["light"],
+                                                        _worker["cubemap"], rect=tiles[index],
+                                                        n_bounces=_worker["n_bounces"])
+        n_rendered += 1
+
+    return n_rendered
+
+
+def render_tiled(scene, camera, light, cubemap=None, tile_size=64, processes=None,
+                 n_bounces=cpuRaytracer.NUM_BOUNCES):
+    '''
+    Render the scene with cpuRaytracer on a pool of processes.
+
+    The image is split into tiles and every worker writes its tiles straight into a
+    shared memory RGB float framebuffer. Tiles are handed out one at a time through a
+    shared counter, so the load stays balanced even when some tiles (reflective spheres)
+    cost much more than others (sky only).
+
+    :param tile_size:   width and height of a tile in pixels
+    :param processes:   number of worker processes, defaults to the number of cores
+    :return:            (height, width, 3) float32 image, bottom row first like cpuRaytracer.render
+    '''
+    width, height = camera.resolution
+    processes = processes or mp.cpu_count()
+    tiles = make_tiles(width, height, tile_size)
+
+    framebuffer_shape = (height, width, 3)
+    framebuffer_shm = shared_memory.SharedMemory(create=True, size=height * width * 3 * 4)
+    cubemap_shm = share_array(np.ascontiguousarray(cubemap, dtype=np.float32)) if cubemap is not None else None
+    next_tile = mp.Value("i", 0)
+
+    try:
+        initargs = (framebuffer_shm.name, framebuffer_shape,
+                    cubemap_shm.name if cubemap_shm is not None else None,
+                    cubemap.shape if cubemap is not None else None,
+                    scene, camera, light, tiles, next_tile, n_bounces)
+        with mp.Pool(processes, initializer=_init_worker, initargs=initargs) as pool:
+            pool.map(_render_tiles, range(processes), chunksize=1)
+
+        image = np.ndarray(framebuffer_shape, dtype=np.float32, buffer=framebuffer_shm.buf).copy()
+    finally:
+        framebuffer_shm.close()
+        framebuffer_shm.unlink()
+        if cubemap_shm is not None:
+            cubemap_shm.close()
+            cubemap_shm.unlink()
+
+    return image
+
+
+if __name__ == '__main__':
+    '''
+    Renders the default scene of sceneData on every core and saves it to cpu_render.png
+    '''
+    from utils import save_image
+
+    width, height = 1920, 1080
+    cube_map_images = ['images/skybox1/right.png', 'images/skybox1/left.png',
+                       'images/skybox1/top.png', 'images/skybox1/bottom.png',
+                       'images/skybox1/front.png', 'images/skybox1/back.png']
+
+    scene = sceneData.default_scene()
+    camera = cpuRaytracer.look_at_camera([0, 0, 3], [0, 0, -1], [0, 1, 0], np.deg2rad(90), (width, height))
+    light = cpuRaytracer.Light([-10, 10, -10], [1.0, 1.0, 1.0], ambient_intensity=0.1)
+    cubemap = cpuRaytracer.load_cubemap(cube_map_images)
+
+    start = time.time()
+    image = render_tiled(scene, camera, light, cubemap)
+    print("Render time: ", time.time() - start, "on", mp.cpu_count(), "processes")
+
+    save_image("cpu_render.png", cpuRaytracer.to_rgb_bytes(image), width, height)
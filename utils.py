@@ -1,6 +1,44 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
 import pygame as pg
+import numpy as np
 def load_image(filename, format="RGB", flip=False):
     img = pg.image.load(filename)
     img_data = pg.image.tobytes(img, format, flip)
     w, h = img.get_size()
-    return img_data, w, h
\ No newline at end of file
+    return img_data, w, h
+
+# Decodes several images at the same time and yields (index in filenames, (img_data, w, h)) as each one is ready,
+# so the caller can already use the first images while the others are decoded.
+# Threads are enough when pygame releases the GIL while decoding, processes=True decodes in other processes
+def iter_load_images(filenames, format="RGB", flip=False, max_workers=None, processes=False):
+    if len(filenames) == 0:
+        return
+    executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with executor(max_workers or len(filenames)) as pool:
+        futures = {pool.submit(load_image, filename, format, flip): index for index, filename in enumerate(filenames)}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+# Decodes several images at the same time, returns [(img_data, w, h)] in the order of filenames
+def load_images(filenames, format="RGB", flip=False, max_workers=None, processes=False):
+    images = [None] * len(filenames)
+    for index, image in iter_load_images(filenames, format, flip, max_workers, processes):
+        images[index] = image
+    return images
+
+def save_image(filename, img_data, w, h, format="RGB"):
+    img = pg.image.frombytes(img_data, (w, h), format)
+    pg.image.save(img, filename)
+
+
+class ChangeTracker:
+    # Remembers a set of values (arrays or numbers) to tell when any of them changes
+    def __init__(self):
+        self.last = None
+
+    def changed(self, *values):
+        key = tuple(np.asarray(value, dtype=np.float64).tobytes() for value in values)
+        changed = key != self.last
+        self.last = key
+        return changed